@@ -0,0 +1,56 @@
+# Measures decoding throughput of every registered image decoder, at full resolution and at a reduced draft size
+#
+# Usage: python benchmark_decoders.py --data_dir ./downloaded_images --decode_size 224
+
+import os
+import time
+import argparse
+
+from PIL import ImageFile
+from utils.dataloaders.decoders import available_decoders, get_decoder
+from utils.dataloaders.data_loader_test import IMG_EXTENSIONS, has_file_allowed_extension
+
+parser = argparse.ArgumentParser(description='benchmarks image decoders on a directory of images')
+parser.add_argument('--data_dir', type=str, help='directory to recursively search for images in')
+parser.add_argument('--decode_size', type=int, default=224, help='smallest side length requested from reduced scale '
+                                                                'decoding')
+parser.add_argument('--n_images', type=int, default=500, help='maximum number of images decoded per setting')
+parser.add_argument('--decoders', type=str, nargs='+', default=None, help='decoders to benchmark, all registered '
+                                                                          'decoders by default')
+args = parser.parse_args()
+
+ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+
+def main():
+    paths = []
+    for root, _, fnames in sorted(os.walk(args.data_dir)):
+        paths.extend(os.path.join(root, fname) for fname in sorted(fnames)
+                     if has_file_allowed_extension(fname, IMG_EXTENSIONS))
+    paths = paths[:args.n_images]
+    if not paths:
+        raise Exception("No images found in {}".format(args.data_dir))
+
+    # read every file once so all settings start from a warm page cache
+    for path in paths:
+        with open(path, 'rb') as f:
+            f.read()
+
+    print('{:<12}{:>12}{:>14}{:>16}'.format('decoder', 'decode_size', 'images/sec', 'mean size'))
+    for name in args.decoders or available_decoders():
+        decoder = get_decoder(name)
+        for draft_size in [None, args.decode_size]:
+            try:
+                since = time.time()
+                sizes = [decoder(path, draft_size=draft_size).size for path in paths]
+                elapsed = time.time() - since
+            except ImportError as e:
+                print('{:<12}unavailable ({})'.format(name, e))
+                break
+            mean_size = '{:.0f}x{:.0f}'.format(sum(ele[0] for ele in sizes) / float(len(sizes)),
+                                               sum(ele[1] for ele in sizes) / float(len(sizes)))
+            print('{:<12}{:>12}{:>14.1f}{:>16}'.format(name, str(draft_size), len(paths) / elapsed, mean_size))
+
+
+if __name__ == '__main__':
+    main()
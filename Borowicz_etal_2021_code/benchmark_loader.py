@@ -0,0 +1,98 @@
+# Measures DataLoader throughput alone, without a model, for each loader setting of utils/dataloaders/loader_config.py
+#
+# Usage: python benchmark_loader.py --training_dir training_set_13_MAY_18 --model_architecture Resnet18
+#                                   --hyperparameter_set A
+
+import os
+import time
+import argparse
+
+import torch
+from torchvision import datasets, transforms
+from PIL import ImageFile
+from utils.model_library import *
+from utils.dataloaders.loader_config import LOADER_DEFAULTS, loader_settings, make_dataloader, uint8_transfer
+
+parser = argparse.ArgumentParser(description='benchmarks dataloader settings on a training set')
+parser.add_argument('--training_dir', type=str, help='training set to load images from, must be a member of '
+                                                     'training_sets')
+parser.add_argument('--model_architecture', type=str, help='model architecture, its input size sets the crop size')
+parser.add_argument('--hyperparameter_set', type=str, help='hyperparameter set with the batch size, number of workers '
+                                                           'and loader settings to compare against')
+parser.add_argument('--split', type=str, default='training', choices=['training', 'validation'],
+                    help='split of the training set to load')
+parser.add_argument('--epochs', type=int, default=2, help='passes over the split per setting, persistent workers only '
+                                                          'pay off from the second one')
+parser.add_argument('--max_batches', type=int, default=100, help='maximum number of batches per pass')
+args = parser.parse_args()
+
+# check for invalid inputs
+if args.model_architecture not in model_archs:
+    raise Exception("Unsupported architecture")
+
+if args.training_dir not in training_sets:
+    raise Exception("Invalid training set")
+
+if args.hyperparameter_set not in hyperparameters:
+    raise Exception("Invalid hyperparameter combination")
+
+ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+
+def benchmark(settings):
+    """
+    :param settings: dict -- loader settings
+    :return: float -- images per second over every pass, including worker start up and normalization
+    """
+    data_transforms = transforms.Compose([
+        transforms.CenterCrop(model_archs[args.model_architecture]['input_size']),
+        transforms.ToTensor(),
+        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+    ])
+    normalize = None
+    if settings['uint8_transfer']:
+        data_transforms, normalize = uint8_transfer(data_transforms)
+    dataset = datasets.ImageFolder(os.path.join('./training_sets', args.training_dir, args.split), data_transforms)
+    dataloader = make_dataloader(dataset, batch_size=hyperparameters[args.hyperparameter_set]['batch_size_train'],
+                                 num_workers=hyperparameters[args.hyperparameter_set]['num_workers_train'],
+                                 settings=settings, shuffle=True)
+    use_gpu = torch.cuda.is_available()
+    if use_gpu and normalize is not None:
+        normalize = normalize.cuda()
+
+    n_images = 0
+    since = time.time()
+    for _ in range(args.epochs):
+        for batch_idx, (inputs, _) in enumerate(dataloader):
+            if batch_idx == args.max_batches:
+                break
+            if use_gpu:
+                inputs = inputs.cuda(non_blocking=True)
+            if normalize is not None:
+                inputs = normalize(inputs)
+            n_images += inputs.size(0)
+    if use_gpu:
+        torch.cuda.synchronize()
+    elapsed = time.time() - since
+    # shut persistent workers down before the next setting starts its own
+    del dataloader
+    return n_images / elapsed
+
+
+def main():
+    # every setting off, each one switched on by itself, and the hyperparameter set's own combination
+    baseline = dict(LOADER_DEFAULTS)
+    settings = [('baseline', baseline)]
+    for key in ['pin_memory', 'persistent_workers', 'uint8_transfer', 'worker_affinity']:
+        settings.append((key, dict(baseline, **{key: True})))
+    settings.append(('prefetch_factor=4', dict(baseline, prefetch_factor=4)))
+    settings.append(('set {}'.format(args.hyperparameter_set),
+                     loader_settings(hyperparameters[args.hyperparameter_set])))
+
+    print('{:<24}{:>14}'.format('setting', 'images/sec'))
+    for name, setting in settings:
+        print('{:<24}{:>14.1f}'.format(name, benchmark(setting)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+# Long-lived local classification service, so crawlers delivering images in small trickles do not pay for imports,
+# model construction and weight loading on every run.
+#
+# Usage: python classify_daemon.py --model_names seal_model --model_architectures Resnet18
+#                                  --training_dirs training_set_13_MAY_18
+#
+#   POST /classify/<model_name>   body: raw image bytes, or JSON {"paths": [...]} for images on this machine
+#   GET  /metrics                 queue depth and per-batch latency of every model
+#   GET  /health
+
+import io
+import json
+import os
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import torch
+from torchvision import transforms
+from PIL import Image, ImageFile
+from utils.model_library import *
+from utils.model_loader import load_model
+from utils.onnx_backend import OnnxClassifier, onnx_path
+from utils.micro_batcher import MicroBatcher
+
+parser = argparse.ArgumentParser(description='serves previously trained models over localhost HTTP, gathering '
+                                             'requests into micro-batches')
+parser.add_argument('--model_names', type=str, nargs='+', help='names of input model files from training')
+parser.add_argument('--model_architectures', type=str, nargs='+', help='architecture of each model, must be members of '
+                                                                       'models dictionary')
+parser.add_argument('--training_dirs', type=str, nargs='+', help='training set of each model, or a single one shared '
+                                                                 'by all models')
+parser.add_argument('--host', type=str, default='127.0.0.1', help='address to listen on')
+parser.add_argument('--port', type=int, default=8765, help='port to listen on')
+parser.add_argument('--max_batch_size', type=int, default=32, help='maximum number of images per forward pass')
+parser.add_argument('--max_latency_ms', type=float, default=20, help='maximum time a request waits for its batch to '
+                                                                     'fill up')
+parser.add_argument('--backend', type=str, default='torch', choices=['torch', 'onnx'],
+                    help='run models with pyTorch or with onnxruntime on the CPU')
+parser.add_argument('--intra_op_threads', type=int, default=0, help='threads used inside an operator, 0 keeps the '
+                                                                    'backend default')
+parser.add_argument('--max_request_mb', type=float, default=50, help='largest accepted request body')
+args = parser.parse_args()
+
+# check for invalid inputs
+if len(args.model_architectures) != len(args.model_names):
+    raise Exception("Expected one architecture per model")
+
+if len(args.training_dirs) == 1:
+    args.training_dirs = args.training_dirs * len(args.model_names)
+elif len(args.training_dirs) != len(args.model_names):
+    raise Exception("Expected one training set per model, or a single shared one")
+
+for arch, training_dir in zip(args.model_architectures, args.training_dirs):
+    if arch not in model_archs:
+        raise Exception("Unsupported architecture")
+
+    if training_dir not in training_sets:
+        raise Exception("Invalid training set")
+
+ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+use_gpu = torch.cuda.is_available() and args.backend == 'torch'
+if args.backend == 'torch' and args.intra_op_threads > 0:
+    torch.set_num_threads(args.intra_op_threads)
+
+
+def image_transforms(input_size):
+    # same preprocessing as predict_images.py
+    return transforms.Compose([
+        transforms.CenterCrop(input_size),
+        transforms.ToTensor(),
+        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+    ])
+
+
+def load_rgb(f):
+    # close the file and decoder buffers right away, the daemon would otherwise pile them up under sustained load
+    with Image.open(f) as img:
+        return img.convert('RGB')
+
+
+# keep every model loaded for the lifetime of the daemon
+services = {}
+for model_name, arch, training_dir in zip(args.model_names, args.model_architectures, args.training_dirs):
+    class_names = sorted([subdir for subdir in os.listdir('./training_sets/{}/training'.format(training_dir))])
+    if args.backend == 'onnx':
+        model = OnnxClassifier(onnx_path(model_name), intra_op_threads=args.intra_op_threads)
+    else:
+        model = load_model(model_name, arch, training_sets[training_dir]['num_classes'], use_gpu=use_gpu)
+    services[model_name] = {'batcher': MicroBatcher(model, class_names, max_batch_size=args.max_batch_size,
+                                                    max_latency_ms=args.max_latency_ms, use_gpu=use_gpu),
+                            'transform': image_transforms(model_archs[arch]['input_size'])}
+    print('Loaded {} ({})'.format(model_name, arch))
+
+
+class ClassifyHandler(BaseHTTPRequestHandler):
+
+    def _reply(self, status, body):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._reply(200, {'status': 'ok', 'models': sorted(services)})
+        elif self.path == '/metrics':
+            self._reply(200, {name: service['batcher'].metrics() for name, service in services.items()})
+        else:
+            self._reply(404, {'error': 'unknown endpoint {}'.format(self.path)})
+
+    def do_POST(self):
+        parts = self.path.strip('/').split('/')
+        if len(parts) != 2 or parts[0] != 'classify' or parts[1] not in services:
+            self._reply(404, {'error': 'expected /classify/<model_name>, models: {}'.format(sorted(services))})
+            return
+
+        length = int(self.headers.get('Content-Length', 0))
+        if length > args.max_request_mb * 2 ** 20:
+            self._reply(413, {'error': 'request body too large'})
+            return
+        body = self.rfile.read(length)
+        service = services[parts[1]]
+
+        try:
+            # decode in the request thread, so images are decoded in parallel while the model runs batches
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                paths = json.loads(body.decode('utf-8'))['paths']
+                images = [load_rgb(path) for path in paths]
+            else:
+                paths = None
+                images = [load_rgb(io.BytesIO(body))]
+            futures = [service['batcher'].submit(service['transform'](image)) for image in images]
+            results = [future.result() for future in futures]
+        except Exception as e:
+            self._reply(400, {'error': repr(e)})
+            return
+
+        if paths is None:
+            self._reply(200, results[0])
+        else:
+            self._reply(200, [dict(result, path=path) for path, result in zip(paths, results)])
+
+    def log_message(self, format, *log_args):
+        # keep the console for startup messages and errors
+        pass
+
+
+def main():
+    server = ThreadingHTTPServer((args.host, args.port), ClassifyHandler)
+    print('Serving {} on http://{}:{}'.format(sorted(services), args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
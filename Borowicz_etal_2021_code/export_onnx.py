@@ -0,0 +1,53 @@
+import torch
+import os
+from utils.model_library import *
+from utils.model_loader import load_model
+from utils.onnx_backend import OnnxClassifier, export_onnx, onnx_path, parity_check
+from utils.quantization import validation_loader
+from PIL import ImageFile
+import argparse
+
+parser = argparse.ArgumentParser(description='exports a previously trained model to ONNX and checks it against pyTorch')
+parser.add_argument('--training_dir', type=str, help='training set the model was trained on, its validation images '
+                                                     'are used for the parity check')
+parser.add_argument('--model_architecture', type=str, help='model architecture, must be a member of models '
+                                                           'dictionary')
+parser.add_argument('--model_name', type=str, help='name of input model file from training, the ONNX model is saved '
+                                                   'next to it')
+parser.add_argument('--opset', type=int, default=13, help='ONNX opset version')
+parser.add_argument('--parity_images', type=int, default=64, help='number of validation images used to compare '
+                                                                  'pyTorch and onnxruntime logits')
+parser.add_argument('--tolerance', type=float, default=1E-3, help='maximum accepted absolute logit difference')
+args = parser.parse_args()
+
+# check for invalid inputs
+if args.model_architecture not in model_archs:
+    raise Exception("Unsupported architecture")
+
+if args.training_dir not in training_sets:
+    raise Exception("Invalid training set")
+
+ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+
+def main():
+    input_size = model_archs[args.model_architecture]['input_size']
+    model = load_model(args.model_name, args.model_architecture, training_sets[args.training_dir]['num_classes'])
+
+    out_file = onnx_path(args.model_name)
+    export_onnx(model, out_file, input_size=input_size, opset_version=args.opset)
+    print('Exported {}'.format(out_file))
+
+    # make sure onnxruntime reproduces the pyTorch logits before the model is used for predictions
+    dataloader = validation_loader(args.training_dir, input_size, batch_size=16, max_images=args.parity_images)
+    parity = parity_check(model, OnnxClassifier(out_file), dataloader)
+    print('Parity on {} images: max abs logit difference {:.2e}, argmax agreement {:.4f}'.format(
+        parity['n_images'], parity['max_abs_diff'], parity['argmax_agreement']))
+    if parity['max_abs_diff'] > args.tolerance:
+        os.remove(out_file)
+        raise Exception("ONNX logits differ from pyTorch by more than {}".format(args.tolerance))
+
+
+if __name__ == '__main__':
+    with torch.no_grad():
+        main()
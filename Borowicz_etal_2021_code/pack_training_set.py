@@ -0,0 +1,101 @@
+# Decodes a training set once and packs it into fixed-size uint8 shards, so train_classifier.py --packed_dir reads
+# pixels through np.memmap instead of decoding every JPEG on every epoch.
+#
+# Usage: python pack_training_set.py --training_dir training_set_13_MAY_18 --model_architecture Resnet18
+
+import json
+import os
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+from torchvision import datasets
+from PIL import Image, ImageFile
+from utils.model_library import *
+from utils.dataloaders.shard_dataset import center_crop_array, packed_size
+from utils.image_validation import SkiplistFilter, load_skiplist
+
+parser = argparse.ArgumentParser(description='packs training and validation images into memory-mappable shards')
+parser.add_argument('--training_dir', type=str, help='training set to pack, must be a member of training_sets')
+parser.add_argument('--model_architecture', type=str, help='model architecture the shards are packed for, its input '
+                                                           'size sets the packed image size')
+parser.add_argument('--size', type=int, default=None, help='side length of packed images, by default large enough for '
+                                                           'the augmentation in train_classifier.py')
+parser.add_argument('--shard_size', type=int, default=1024, help='number of images per shard')
+parser.add_argument('--out_dir', type=str, default='./packed_sets', help='directory the packed set is written to')
+parser.add_argument('--num_workers', type=int, default=8, help='number of decoding processes')
+parser.add_argument('--skiplist', type=str, default=None, help='skiplist written by preflight_images.py, images '
+                                                               'on it are not packed')
+args = parser.parse_args()
+
+# check for invalid inputs
+if args.model_architecture not in model_archs:
+    raise Exception("Unsupported architecture")
+
+if args.training_dir not in training_sets:
+    raise Exception("Invalid training set")
+
+ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+size = args.size or packed_size(model_archs[args.model_architecture]['input_size'])
+
+
+def decode(path):
+    with open(path, 'rb') as f:
+        image = np.asarray(Image.open(f).convert('RGB'))
+    return center_crop_array(image, size)
+
+
+def pack_split(src_dir, out_dir, pool):
+    """
+    :param src_dir: str -- ImageFolder style split directory
+    :param out_dir: str -- packed split directory
+    :param pool: multiprocessing.Pool -- decoding processes
+    """
+    is_valid_file = None
+    if args.skiplist is not None:
+        is_valid_file = SkiplistFilter(load_skiplist(args.skiplist), datasets.folder.IMG_EXTENSIONS)
+    dataset = datasets.ImageFolder(src_dir, is_valid_file=is_valid_file)
+    paths = [path for path, _ in dataset.samples]
+    labels = np.array([target for _, target in dataset.samples], dtype=np.int64)
+    shards = np.arange(len(paths), dtype=np.int32) // args.shard_size
+    offsets = np.arange(len(paths), dtype=np.int32) % args.shard_size
+
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    if os.path.isfile(os.path.join(out_dir, 'meta.json')):
+        os.remove(os.path.join(out_dir, 'meta.json'))
+
+    shard = None
+    for idx, pixels in enumerate(pool.imap(decode, paths, chunksize=16)):
+        if offsets[idx] == 0:
+            if shard is not None:
+                shard.flush()
+            n_images = min(args.shard_size, len(paths) - idx)
+            shard = np.lib.format.open_memmap(os.path.join(out_dir, 'shard_{:05d}.npy'.format(shards[idx])),
+                                              mode='w+', dtype=np.uint8, shape=(n_images, size, size, 3))
+        shard[offsets[idx]] = pixels
+    if shard is not None:
+        shard.flush()
+
+    np.savez(os.path.join(out_dir, 'index.npz'), labels=labels, shards=shards, offsets=offsets)
+    with open(os.path.join(out_dir, 'paths.txt'), 'w') as f:
+        f.write(''.join(path + '\n' for path in paths))
+
+    # written last, so an interrupted packing run is never mistaken for a complete one
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump({'classes': dataset.classes, 'size': size, 'shard_size': args.shard_size}, f)
+    print('{}: packed {} images into {} shards'.format(out_dir, len(paths), int(shards[-1]) + 1 if len(paths) else 0))
+
+
+def main():
+    pool = Pool(args.num_workers)
+    for split in ['training', 'validation']:
+        pack_split(os.path.join('./training_sets', args.training_dir, split),
+                   os.path.join(args.out_dir, args.training_dir, split), pool)
+    pool.close()
+    pool.join()
+
+
+if __name__ == '__main__':
+    main()
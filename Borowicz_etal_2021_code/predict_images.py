@@ -1,11 +1,24 @@
 import torch
 from torch.autograd import Variable
-from torchvision import transforms, models
+from torchvision import transforms
 from utils.dataloaders.data_loader_test import ImageFolderTest
+from utils.dataloaders.decoders import available_decoders, make_loader
+from utils.dataloaders.dataset_index import DatasetIndex
+from utils.image_validation import load_skiplist
+from utils.dataloaders.transforms_tile import TileTransform, collate_tiles, reduce_tiles
+from utils.dataloaders.loader_config import loader_settings, make_dataloader, uint8_transfer
 import os
 from utils.model_library import *
+from utils.model_loader import load_model, weights_path
+from utils.ensemble import Ensemble
+from utils.quantization import load_quantized_model
+from utils.onnx_backend import OnnxClassifier, onnx_path
+from utils.result_writer import ResultWriter
+from utils.inference_manifest import CompletedManifest
+from utils.prediction_cache import PredictionCache, file_digests, model_fingerprint
+from utils.logit_store import LogitStore
 import torch.nn as nn
-import pandas as pd
+import torch.nn.functional as F
 from PIL import ImageFile
 import argparse
 
@@ -18,6 +31,71 @@ parser.add_argument('--hyperparameter_set', type=str, help='combination of hyper
 parser.add_argument('--model_name', type=str, help='name of input model file from training, this name will also be used'
                                                    'in subsequent steps of the pipeline')
 parser.add_argument('--data_dir', type=str, help='directory with images to be classified')
+parser.add_argument('--output_file', type=str, default='./classified_images/classified.csv',
+                    help='.csv file where predicted labels are written')
+parser.add_argument('--flush_every', type=int, default=4096, help='maximum number of predictions kept in memory '
+                                                                  'before they are appended to output_file')
+parser.add_argument('--resume', action='store_true', help='skip images that a previous, interrupted run with the same '
+                                                          'model already classified')
+parser.add_argument('--manifest', type=str, default=None, help='file listing finished images, defaults to output_file '
+                                                               'with a .manifest extension')
+parser.add_argument('--cache_file', type=str, default=None, help='SQLite prediction cache keyed by image content and '
+                                                                 'model weights, shared across crawls and runs')
+parser.add_argument('--cache_max_entries', type=int, default=1000000, help='maximum number of cached predictions, '
+                                                                           'least recently used ones are evicted')
+parser.add_argument('--save_probs', type=str, default=None, help='directory where softmax probabilities and top-k '
+                                                                 'classes are stored for every image')
+parser.add_argument('--top_k', type=int, default=3, help='number of most likely classes stored with --save_probs')
+parser.add_argument('--probs_dtype', type=str, default='float16', choices=['float16', 'float32'],
+                    help='dtype of probabilities stored with --save_probs')
+parser.add_argument('--dataset_index', type=str, default=None, help='SQLite file indexing --data_dir, only directories '
+                                                                     'changed since the last run are listed again')
+parser.add_argument('--skiplist', type=str, default=None, help='skiplist written by preflight_images.py, images '
+                                                               'on it are left out')
+parser.add_argument('--decoder', type=str, default='default', choices=['default'] + available_decoders(),
+                    help='image decoder, default follows torchvision\'s image backend')
+parser.add_argument('--decode_size', type=int, default=None, help='decode JPEGs at the smallest reduced scale whose '
+                                                                  'sides are still at least this many pixels, this '
+                                                                  'changes the pixel scale the model sees, so only use '
+                                                                  'it with models trained on images of that scale')
+parser.add_argument('--tiled', action='store_true', help='classify overlapping tiles covering the whole image instead '
+                                                         'of a single center crop')
+parser.add_argument('--tile_overlap', type=float, default=0.25, help='minimum fraction of a tile shared with its '
+                                                                     'neighbour in --tiled mode')
+parser.add_argument('--tile_reduce', type=str, default='max', choices=['max', 'mean'],
+                    help='how tile probabilities are combined into an image-level prediction in --tiled mode')
+parser.add_argument('--max_tiles_per_forward', type=int, default=512, help='maximum number of tiles in a single '
+                                                                           'forward pass in --tiled mode')
+parser.add_argument('--ensemble_models', type=str, nargs='+', default=None, help='additional models averaged with '
+                                                                               '--model_name, each batch is decoded '
+                                                                               'once and run through every model')
+parser.add_argument('--ensemble_architectures', type=str, nargs='+', default=None, help='architecture of each of '
+                                                                                        '--ensemble_models')
+parser.add_argument('--ensemble_weights', type=float, nargs='+', default=None, help='weight of --model_name followed by '
+                                                                                    'each of --ensemble_models, equal '
+                                                                                    'by default')
+parser.add_argument('--ensemble_combine', type=str, default='probs', choices=['probs', 'logits'],
+                    help='whether ensemble members are combined by averaging probabilities or logits')
+parser.add_argument('--quantize', type=str, default=None, choices=['dynamic', 'static'],
+                    help='run int8 quantized models on the CPU, quantizing and caching them next to the weights on '
+                         'first use')
+parser.add_argument('--calibration_images', type=int, default=256, help='number of validation images used to '
+                                                                        'calibrate --quantize static')
+parser.add_argument('--backend', type=str, default='torch', choices=['torch', 'onnx'],
+                    help='run models with pyTorch or with onnxruntime on the CPU, the latter requires exporting them '
+                         'with export_onnx.py first')
+parser.add_argument('--intra_op_threads', type=int, default=0, help='threads used inside an operator, 0 keeps the '
+                                                                    'backend default')
+parser.add_argument('--inter_op_threads', type=int, default=0, help='threads used to run independent operators in '
+                                                                    'parallel, 0 keeps the backend default')
+parser.add_argument('--species_model_name', type=str, default=None, help='second stage model, classifies the species '
+                                                                         'of images the first model labels with one '
+                                                                         'of --positive_classes')
+parser.add_argument('--species_model_architecture', type=str, default=None, help='architecture of the second stage '
+                                                                                 'model')
+parser.add_argument('--species_training_dir', type=str, default=None, help='training set of the second stage model')
+parser.add_argument('--positive_classes', type=str, nargs='+', default=None, help='first stage classes that are sent '
+                                                                                  'on to the second stage model')
 
 
 args = parser.parse_args()
@@ -29,105 +107,302 @@ if args.model_architecture not in model_archs:
 if args.training_dir not in training_sets:
     raise Exception("Invalid training set")
 
+ensemble = args.ensemble_models is not None
+if ensemble:
+    if args.ensemble_architectures is None or len(args.ensemble_architectures) != len(args.ensemble_models):
+        raise Exception("--ensemble_architectures needs one architecture per ensemble model")
 
-ImageFile.LOAD_TRUNCATED_IMAGES = True
+    for arch in args.ensemble_architectures:
+        if arch not in model_archs:
+            raise Exception("Unsupported ensemble architecture")
 
-# normalize input images
-arch_input_size = model_archs[args.model_architecture]['input_size']
-data_transforms = transforms.Compose([
-        transforms.CenterCrop(arch_input_size),
-        transforms.ToTensor(),
-        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
-])
+        if model_archs[arch]['input_size'] != model_archs[args.model_architecture]['input_size']:
+            raise Exception("Ensemble models need the same input size to share decoded images")
 
-# create dataloader instance
-dataset = ImageFolderTest(args.data_dir, data_transforms)
-batch_size = hyperparameters[args.hyperparameter_set]['batch_size_test']
-num_workers = hyperparameters[args.hyperparameter_set]['num_workers_val']
-dataloader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, num_workers=num_workers)
+    if args.ensemble_weights is not None and len(args.ensemble_weights) != len(args.ensemble_models) + 1:
+        raise Exception("--ensemble_weights needs one weight for --model_name and one per ensemble model")
 
+if args.backend == 'onnx' and args.quantize is not None:
+    raise Exception("--quantize is only supported with the torch backend")
 
-img_exts = ['.jpg', '.jpeg', '.png', '.ppm', '.bmp', '.pgm']
-class_names = sorted([subdir for subdir in os.listdir('./training_sets/{}/training'.format(args.training_dir))])
-data_dir = args.data_dir
+cascade = args.species_model_name is not None
+if cascade:
+    if args.species_model_architecture not in model_archs:
+        raise Exception("Unsupported species model architecture")
 
-use_gpu = torch.cuda.is_available()
+    if args.species_training_dir not in training_sets:
+        raise Exception("Invalid species training set")
 
-# create an image catalog to keep track of labels
-classified = pd.DataFrame()
+    if model_archs[args.species_model_architecture]['input_size'] != model_archs[args.model_architecture]['input_size']:
+        raise Exception("Both cascade stages need the same input size to share decoded images")
 
-# add images to the catalog
-idx = 0
-for path, _, files in os.walk(data_dir):
-    for filename in files:
-        # extract x and y from filename and run affine transformation
-        filename_lower = filename.lower()
-        if not (any(filename_lower.endswith(ext) for ext in img_exts)):
-            print('{} is not a valid image file.'.format(filename))
-            continue
+    if not args.positive_classes:
+        raise Exception("--positive_classes is required with --species_model_name")
 
-        row = {'label': None, 'file': filename}
-        classified = classified.append(row, ignore_index=True)
-        idx += 1
+    if args.tiled or args.cache_file is not None:
+        raise Exception("Cascade mode does not support --tiled or --cache_file")
 
 
-# classify images with CNN
-def main():
-    # create model instance
-    num_classes = training_sets[args.training_dir]['num_classes']
-
-    # loading the pretrained model and adding new classes to it
-    if args.model_architecture == "Resnet18":
-        model_ft = models.resnet18(num_classes=num_classes)
-
-    elif args.model_architecture == "Resnet34":
-        model_ft = models.resnet34(num_classes=num_classes)
-
-    elif args.model_architecture == "Resnet50":
-        model_ft = models.resnet50(num_classes=num_classes)
-
-    elif args.model_architecture == "Squeezenet11":
-        model_ft = models.squeezenet1_1(num_classes=num_classes)
-
-    elif args.model_architecture == "Densenet121":
-        model_ft = models.densenet121(num_classes=num_classes)
+ImageFile.LOAD_TRUNCATED_IMAGES = True
 
-    elif args.model_architecture == "Densenet169":
-        model_ft = models.densenet169(num_classes=num_classes)
+# normalize input images
+arch_input_size = model_archs[args.model_architecture]['input_size']
+if args.tiled:
+    # each image is decoded and normalized once, then cut into tiles as a tensor
+    data_transforms = transforms.Compose([
+            transforms.ToTensor(),
+            transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
+            TileTransform(arch_input_size, overlap=args.tile_overlap)
+    ])
+else:
+    data_transforms = transforms.Compose([
+            transforms.CenterCrop(arch_input_size),
+            transforms.ToTensor(),
+            transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+    ])
+
+# tiles are padded after normalization, so only center crops are handed over as uint8
+loader_config = loader_settings(hyperparameters[args.hyperparameter_set])
+normalize = None
+if loader_config['uint8_transfer'] and not args.tiled:
+    data_transforms, normalize = uint8_transfer(data_transforms)
 
-    elif args.model_architecture == "Alexnet":
-        model_ft = models.alexnet(num_classes=num_classes)
+class_names = sorted([subdir for subdir in os.listdir('./training_sets/{}/training'.format(args.training_dir))])
+if cascade:
+    species_names = sorted([subdir for subdir in
+                            os.listdir('./training_sets/{}/training'.format(args.species_training_dir))])
+    if not set(args.positive_classes).issubset(class_names):
+        raise Exception("Positive classes must be members of {}".format(class_names))
+data_dir = args.data_dir
 
+# quantized kernels and the onnxruntime backend only run on the CPU
+use_gpu = torch.cuda.is_available() and args.quantize is None and args.backend == 'torch'
+if use_gpu and normalize is not None:
+    normalize = normalize.cuda()
+if args.backend == 'torch':
+    if args.intra_op_threads > 0:
+        torch.set_num_threads(args.intra_op_threads)
+    if args.inter_op_threads > 0:
+        torch.set_num_interop_threads(args.inter_op_threads)
+
+
+def classify(model, inputs, tile_counts=None):
+    """
+    :param model: pyTorch model in evaluation mode
+    :param inputs: torch.Tensor -- batch of images, uint8 ones are normalized here, or of tiles in --tiled mode
+    :param tile_counts: torch.LongTensor -- number of tiles per image in --tiled mode
+    :return: torch.Tensor -- (n_images, n_classes) class probabilities
+    """
+    # wrap them in Variable
+    if use_gpu:
+        inputs = Variable(inputs.cuda(non_blocking=True))
     else:
-        model_ft = models.vgg16_bn(num_classes=num_classes)
+        inputs = Variable(inputs)
+    if normalize is not None:
+        inputs = normalize(inputs)
+
+    # do a forward pass to get predictions, tiles from all images in the batch go through the model together
+    with torch.no_grad():
+        if tile_counts is not None:
+            outputs = torch.cat([model(chunk) for chunk in torch.split(inputs, args.max_tiles_per_forward)])
+            return reduce_tiles(F.softmax(outputs, dim=1), tile_counts, reduction=args.tile_reduce)
+        return F.softmax(model(inputs), dim=1)
+
+
+def model_file(model_name):
+    """
+    :return: str -- file the model runs from, its ONNX export with --backend onnx, else the weights saved by
+             train_classifier.py
+    """
+    if args.backend == 'onnx':
+        return onnx_path(model_name)
+    return weights_path(model_name)
+
+
+def load_trained_model(model_name, model_architecture, training_dir):
+    """
+    :return: torch.nn.Module -- trained model in evaluation mode, int8 quantized with --quantize or an onnxruntime
+             session with --backend onnx
+    """
+    num_classes = training_sets[training_dir]['num_classes']
+    if args.backend == 'onnx':
+        if not os.path.isfile(onnx_path(model_name)):
+            raise Exception("{} not found, export it with export_onnx.py".format(onnx_path(model_name)))
+        return OnnxClassifier(onnx_path(model_name), intra_op_threads=args.intra_op_threads,
+                              inter_op_threads=args.inter_op_threads)
+
+    if args.quantize is None:
+        return load_model(model_name, model_architecture, num_classes, use_gpu=use_gpu)
+
+    model, report = load_quantized_model(model_name, model_architecture, training_dir, arch_input_size, num_classes,
+                                         mode=args.quantize, calibration_images=args.calibration_images,
+                                         batch_size=hyperparameters[args.hyperparameter_set]['batch_size_val'],
+                                         num_workers=hyperparameters[args.hyperparameter_set]['num_workers_val'])
+    print('{} int8 ({}): validation accuracy {:.4f} vs {:.4f} fp32 (delta {:+.4f})'.format(
+        model_name, args.quantize, report['int8_accuracy'], report['fp32_accuracy'], report['accuracy_delta']))
+    return model
 
-    # check for GPU support and set model to evaluation mode
-    use_gpu = torch.cuda.is_available()
-    if use_gpu:
-        model_ft.cuda()
-    model_ft.eval()
 
-    # load saved model weights from pt_train.py
-    model_ft.load_state_dict(torch.load("./saved_models/{}/{}.tar".format(args.model_name, args.model_name)))
+# classify images with CNN
+def main():
+    # create model instance and load saved model weights from train_classifier.py
+    model_ft = load_trained_model(args.model_name, args.model_architecture, args.training_dir)
+    model_name = args.model_name
+    model_architecture = args.model_architecture
+
+    # every ensemble member classifies the same decoded batch
+    if ensemble:
+        members = [model_ft] + [load_trained_model(name, arch, args.training_dir)
+                                for name, arch in zip(args.ensemble_models, args.ensemble_architectures)]
+        model_ft = Ensemble(members, weights=args.ensemble_weights, combine=args.ensemble_combine)
+        if use_gpu:
+            model_ft = model_ft.cuda()
+        model_name = '+'.join([args.model_name] + args.ensemble_models)
+        model_architecture = '+'.join([args.model_architecture] + args.ensemble_architectures)
+
+    # the second stage model only sees images the first one labels as positives
+    if cascade:
+        species_model = load_trained_model(args.species_model_name, args.species_model_architecture,
+                                           args.species_training_dir)
+        positive_idx = torch.LongTensor([class_names.index(ele) for ele in args.positive_classes])
+        manifest_model = '{}>{}'.format(model_name, args.species_model_name)
+        manifest_arch = '{}>{}'.format(model_architecture, args.species_model_architecture)
+        columns = ['label', 'species', 'file', 'path']
+    else:
+        manifest_model = model_name
+        manifest_arch = model_architecture
+        columns = ['label', 'file', 'path']
+
+    # keep track of finished images so interrupted runs can be resumed
+    manifest_file = args.manifest or os.path.splitext(args.output_file)[0] + '.manifest'
+    manifest = CompletedManifest(manifest_file, manifest_model, manifest_arch, resume=args.resume)
+
+    # stream labels to the output file as batches are classified, recording finished images once they are on disk
+    writer = ResultWriter(args.output_file, columns=columns, key='path', chunk_size=args.flush_every,
+                          append=args.resume, on_flush=manifest.add)
+
+    # keep class probabilities so predictions can be re-thresholded without another forward pass
+    store = None
+    species_store = None
+    if args.save_probs is not None:
+        store = LogitStore(args.save_probs, class_names, dtype=args.probs_dtype, top_k=args.top_k, append=args.resume)
+        if cascade:
+            species_store = LogitStore(os.path.join(args.save_probs, 'species'), species_names,
+                                       dtype=args.probs_dtype, top_k=args.top_k, append=args.resume)
+
+    # create dataloader instance over the images that are still left to do
+    completed = manifest.completed.union(writer.index)
+    if store is not None:
+        # rows lost from the store after a crash are classified again
+        completed = completed.intersection(store.paths)
+    index = None
+    if args.dataset_index is not None:
+        index = DatasetIndex(args.dataset_index, args.data_dir)
+    dataset = ImageFolderTest(args.data_dir, data_transforms, exclude=completed,
+                              loader=make_loader(args.decoder, draft_size=args.decode_size), index=index,
+                              skiplist=load_skiplist(args.skiplist))
+    if index is not None:
+        index.close()
+    if args.resume:
+        print('Resuming: {} images already classified, {} left'.format(len(completed), len(dataset)))
+    batch_size = hyperparameters[args.hyperparameter_set]['batch_size_test']
+    num_workers = hyperparameters[args.hyperparameter_set]['num_workers_val']
+
+    # look up duplicates of already classified photos by content, only decoding and classifying cache misses
+    cache = None
+    if args.cache_file is not None:
+        # tiled predictions differ from center crop ones for the same weights
+        fingerprint = model_fingerprint(model_file(args.model_name))
+        if args.quantize is not None:
+            fingerprint += ':int8:' + args.quantize
+        if args.backend == 'onnx':
+            fingerprint += ':onnx'
+        if args.decode_size is not None:
+            fingerprint += ':draft:{}'.format(args.decode_size)
+        if ensemble:
+            fingerprint = ':'.join([fingerprint] + [model_fingerprint(model_file(name))
+                                                    for name in args.ensemble_models] +
+                                   [str(float(ele)) for ele in model_ft.weights] + [args.ensemble_combine])
+        if args.tiled:
+            fingerprint += ':tiled:{}:{}:{}'.format(arch_input_size, args.tile_overlap, args.tile_reduce)
+        cache = PredictionCache(args.cache_file, fingerprint, max_entries=args.cache_max_entries)
+        paths = [path for path, _ in dataset.samples]
+        digests = dict(zip(paths, file_digests(paths, num_threads=max(num_workers, 4))))
+        hits = cache.lookup(digests.values(), with_probs=store is not None)
+        hit_paths = [path for path in paths if digests[path] in hits]
+        writer.write({'label': hits[digests[path]][0], 'file': os.path.basename(path), 'path': path}
+                     for path in hit_paths)
+        if store is not None and hit_paths:
+            store.write(hit_paths, [hits[digests[path]][1] for path in hit_paths])
+        misses = [idx for idx, path in enumerate(paths) if digests[path] not in hits]
+        print('Prediction cache: {} hits, {} images left to classify'.format(len(paths) - len(misses), len(misses)))
+        dataset = torch.utils.data.Subset(dataset, misses)
+
+    dataloader = make_dataloader(dataset, batch_size=batch_size, num_workers=num_workers, settings=loader_config,
+                                 collate_fn=collate_tiles if args.tiled else None)
+
+    # first stage positives wait here until there are enough of them for a full second stage batch
+    pending_inputs = []
+    pending_rows = []
+
+    def classify_species(n_images):
+        inputs = torch.cat(pending_inputs)
+        rows = pending_rows[:]
+        del pending_inputs[:], pending_rows[:]
+        if len(rows) > n_images:
+            pending_inputs.append(inputs[n_images:])
+            pending_rows.extend(rows[n_images:])
+            inputs, rows = inputs[:n_images], rows[:n_images]
+
+        probs = classify(species_model, inputs)
+        _, preds = torch.max(probs, 1)
+        for row, pred in zip(rows, preds):
+            row['species'] = species_names[int(pred)]
+        if species_store is not None:
+            species_store.write([row['path'] for row in rows], probs.cpu().numpy())
+        writer.write(rows)
 
     # classify images in dataloader
     for data in dataloader:
         # get the inputs
-        inputs, _, file_names = data
-
-        # wrap them in Variable
-        if use_gpu:
-            inputs = Variable(inputs.cuda())
+        if args.tiled:
+            inputs, _, paths, tile_counts = data
+            probs = classify(model_ft, inputs, tile_counts=tile_counts)
+        else:
+            inputs, _, paths = data
+            probs = classify(model_ft, inputs)
+
+        _, preds = torch.max(probs, 1)
+        labels = [class_names[int(label)] for label in preds]
+        rows = [{'label': label, 'file': os.path.basename(path), 'path': path} for label, path in zip(labels, paths)]
+        if store is not None:
+            store.write(paths, probs.cpu().numpy())
+        if cache is not None:
+            cache.add((digests[path], label, prob) for label, path, prob in zip(labels, paths, probs.cpu().numpy()))
+
+        if cascade:
+            # send positives on to the second stage, reusing the already decoded images
+            positive = (preds.cpu().unsqueeze(1) == positive_idx.unsqueeze(0)).any(1)
+            for row, is_positive in zip(rows, positive):
+                if not is_positive:
+                    row['species'] = None
+            writer.write(row for row, is_positive in zip(rows, positive) if not is_positive)
+            if positive.any():
+                pending_inputs.append(inputs[positive])
+                pending_rows.extend(row for row, is_positive in zip(rows, positive) if is_positive)
+            while len(pending_rows) >= batch_size:
+                classify_species(batch_size)
         else:
-            inputs = Variable(inputs)
+            writer.write(rows)
 
-        # do a forward pass to get predictions
-        outputs = model_ft(inputs)
-        _, preds = torch.max(outputs.data, 1)
-        for idx, label in enumerate([int(ele) for ele in preds]):
-            classified.loc[classified['file'] == file_names[idx], 'label'] = class_names[label]
+    if cascade and pending_rows:
+        classify_species(len(pending_rows))
 
-        classified.to_csv('./classified_images/classified.csv', index=False)
+    for ele in [store, species_store, cache]:
+        if ele is not None:
+            ele.close()
+    writer.close()
+    manifest.close()
 
 
 if __name__ == '__main__':
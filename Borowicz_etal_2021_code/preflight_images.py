@@ -0,0 +1,44 @@
+# Verifies and fully decodes every image below a directory once, in parallel, before training or inference. Failures
+# go into a skiplist that predict_images.py, train_classifier.py, validate_classifier.py and pack_training_set.py
+# accept with --skiplist, and are optionally moved to a quarantine directory.
+#
+# Usage: python preflight_images.py --data_dir ./downloaded_images --skiplist ./preflight/skiplist.txt
+#                                   --quarantine_dir ./quarantine
+
+import argparse
+
+from torchvision import datasets
+
+from utils.image_validation import Skiplist, is_skipped, list_files, quarantine, validate_images
+
+parser = argparse.ArgumentParser(description='validates images in parallel, recording failures in a skiplist')
+parser.add_argument('--data_dir', type=str, help='directory to recursively search for images in')
+parser.add_argument('--skiplist', type=str, default='./preflight/skiplist.txt', help='skiplist failures are appended '
+                                                                                   'to, images already on it are not '
+                                                                                   'checked again')
+parser.add_argument('--quarantine_dir', type=str, default=None, help='directory failed images are moved to, they stay '
+                                                                     'in place if not given')
+parser.add_argument('--num_workers', type=int, default=8, help='number of validation processes')
+args = parser.parse_args()
+
+
+def main():
+    skiplist = Skiplist(args.skiplist)
+    # only files the dataloaders would load, detections.csv and other non-image files are left alone
+    paths = [path for path in list_files(args.data_dir, extensions=datasets.folder.IMG_EXTENSIONS)
+             if not is_skipped(path, skiplist.paths)]
+    print('Validating {} images in {}'.format(len(paths), args.data_dir))
+
+    n_failed = 0
+    for path, reason in validate_images(paths, num_workers=args.num_workers):
+        skiplist.add(path, reason)
+        if args.quarantine_dir is not None:
+            path = quarantine(path, args.data_dir, args.quarantine_dir)
+        print('preflight: {} - {}'.format(reason, path))
+        n_failed += 1
+    skiplist.close()
+    print('preflight: {} of {} images failed, skiplist: {}'.format(n_failed, len(paths), args.skiplist))
+
+
+if __name__ == '__main__':
+    main()
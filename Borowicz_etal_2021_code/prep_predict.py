@@ -1,6 +1,6 @@
 # Tyler Estro - Stony Brook University 02/06/18
 #
-# Recursively removes files incompatible with PIL.Image.open or don'taken
+# Recursively quarantines files that can not be fully decoded with PIL.Image or don't
 # contain metadata.
 # Depends on images being located in ./downloaded_images directory
 #
@@ -8,32 +8,38 @@
 
 # note: i'd like to add duplicate image detection as well
 
-import os
 import piexif
-from PIL import Image
-
-for path, subdirs, files in os.walk('./downloaded_images'):
-    for filename in files:
-        f = os.path.join(path, filename)
-        # PIL.Image.open test
-        try:
-            image = Image.open(f)
-        except:
-            print('prep_predict: PIL.Image.open failed - Removed: ' + f)
-            os.system("rm \"" + f + "\"")
-            continue
-        # piexif metadata test
-        try:
-            exif_dict = piexif.load(f)
-        except:
-            print('prep_predict: PiExif can not find EXIF data - Removed: ' + f)
-            os.system("rm \"" + f + "\"")
-            continue
-        if not all(k in exif_dict['GPS'] for k in (piexif.GPSIFD.GPSLatitude, piexif.GPSIFD.GPSLatitudeRef)) \
-                or not all(k in exif_dict['GPS'] for k in (piexif.GPSIFD.GPSLongitude, piexif.GPSIFD.GPSLongitudeRef)) \
-                or (not piexif.ExifIFD.DateTimeOriginal in exif_dict["Exif"] and not piexif.GPSIFD.GPSDateStamp in
-                    exif_dict["GPS"]):
-            print('prep_predict: Insufficient Metadata - Removed: ' + f)
-            os.system("rm \"" + f + "\"")
-            continue
-print("prep_predict: Removal of incompatible files completed")
+from utils.image_validation import Skiplist, check_image, list_files, quarantine, validate_images
+
+
+def check_photo(f):
+    # PIL.Image decoding test
+    reason = check_image(f)
+    if reason is not None:
+        return 'PIL.Image decoding failed ({})'.format(reason)
+    # piexif metadata test
+    try:
+        exif_dict = piexif.load(f)
+    except:
+        return 'PiExif can not find EXIF data'
+    if not all(k in exif_dict['GPS'] for k in (piexif.GPSIFD.GPSLatitude, piexif.GPSIFD.GPSLatitudeRef)) \
+            or not all(k in exif_dict['GPS'] for k in (piexif.GPSIFD.GPSLongitude, piexif.GPSIFD.GPSLongitudeRef)) \
+            or (not piexif.ExifIFD.DateTimeOriginal in exif_dict["Exif"] and not piexif.GPSIFD.GPSDateStamp in
+                exif_dict["GPS"]):
+        return 'Insufficient Metadata'
+    return None
+
+
+def main():
+    # bad files are moved aside rather than deleted, and listed with the reason in the quarantine's skiplist
+    skiplist = Skiplist('./quarantine/downloaded_images/skiplist.txt')
+    for f, reason in validate_images(list_files('./downloaded_images'), check=check_photo):
+        skiplist.add(f, reason)
+        quarantine(f, './downloaded_images', './quarantine/downloaded_images')
+        print('prep_predict: {} - Quarantined: {}'.format(reason, f))
+    skiplist.close()
+    print("prep_predict: Removal of incompatible files completed")
+
+
+if __name__ == '__main__':
+    main()
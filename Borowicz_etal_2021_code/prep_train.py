@@ -1,22 +1,25 @@
 # Tyler Estro - Stony Brook University 02/06/18
 #
-# Recursively removes files that can not be opened with PIL.Image
+# Recursively quarantines files that can not be fully decoded with PIL.Image
 # Assumes training images are located in ./nn_images
 #
 # Usage: python prep_train.py
 
 # note: i'd like to add duplicate image detection as well
 
-import os
-from PIL import Image
+from utils.image_validation import Skiplist, list_files, quarantine, validate_images
 
-for path, subdirs, files in os.walk('./nn_images'):
-    for filename in files:
-        f = os.path.join(path, filename)
-        try:
-            image = Image.open(f)
-        except:
-            print('prep_train: PIL.Image.open failed - Removed: ' + f)
-            os.system("rm \"" + f + "\"")
-            continue
-print("prep_train: Removal of incompatible files completed")
+
+def main():
+    # bad files are moved aside rather than deleted, and listed with the reason in the quarantine's skiplist
+    skiplist = Skiplist('./quarantine/nn_images/skiplist.txt')
+    for f, reason in validate_images(list_files('./nn_images')):
+        skiplist.add(f, reason)
+        quarantine(f, './nn_images', './quarantine/nn_images')
+        print('prep_train: {} - Quarantined: {}'.format(reason, f))
+    skiplist.close()
+    print("prep_train: Removal of incompatible files completed")
+
+
+if __name__ == '__main__':
+    main()
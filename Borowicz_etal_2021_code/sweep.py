@@ -0,0 +1,227 @@
+# Trains every combination of architectures and hyperparameter sets with train_classifier.py, running as many jobs
+# side by side as the CPU core budget allows. The training set is packed once with pack_training_set.py and shared by
+# all jobs, runs falling clearly behind the others are stopped early, and validation metrics and wall-clock time of
+# every run are collected in one results table.
+#
+# Usage: python sweep.py --training_dir training_set_13_MAY_18 --total_cores 64 --cores_per_job 8
+#
+# Every job gets its own set of cores (threads and loader workers included) and writes its log and epoch metrics to
+# <sweep_dir>/<job name>/.
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from utils.model_library import *
+from utils.dataloaders.shard_dataset import packed_size
+
+parser = argparse.ArgumentParser(description='trains combinations of architectures and hyperparameter sets in '
+                                             'parallel')
+parser.add_argument('--training_dir', type=str, help='training set, must be a member of training_sets')
+parser.add_argument('--model_architectures', type=str, nargs='+', default=sorted(model_archs),
+                    help='architectures to train, all of model_archs by default')
+parser.add_argument('--hyperparameter_sets', type=str, nargs='+', default=sorted(hyperparameters),
+                    help='hyperparameter sets to train with, all of hyperparameters by default')
+parser.add_argument('--pretrained', type=str, default='True', help='whether or not the models will be loaded with '
+                                                                   'pretrained weights')
+parser.add_argument('--total_cores', type=int, default=None, help='cores used by the whole sweep, all available by '
+                                                                  'default')
+parser.add_argument('--cores_per_job', type=int, default=8, help='cores of every training job, threads and loader '
+                                                                 'workers included')
+parser.add_argument('--packed_dir', type=str, default='./packed_sets', help='directory of the shared packed training '
+                                                                            'set, packed first if missing')
+parser.add_argument('--sweep_dir', type=str, default='./sweep', help='directory for job logs, metrics and results')
+parser.add_argument('--prune_after', type=int, default=3, help='epochs every run trains before it can be pruned')
+parser.add_argument('--prune_margin', type=float, default=0.05, help='runs whose best validation accuracy is this far '
+                                                                     'below the median of the other runs at the same '
+                                                                     'epoch are stopped')
+parser.add_argument('--prune_min_runs', type=int, default=3, help='number of other runs that must have reached the '
+                                                                  'same epoch before pruning')
+parser.add_argument('--poll_interval', type=float, default=5, help='seconds between checks of the running jobs')
+args = parser.parse_args()
+
+# check for invalid inputs
+for arch in args.model_architectures:
+    if arch not in model_archs:
+        raise Exception("Unsupported architecture {}".format(arch))
+
+for hyperparameter_set in args.hyperparameter_sets:
+    if hyperparameter_set not in hyperparameters:
+        raise Exception("Invalid hyperparameter combination {}".format(hyperparameter_set))
+
+if args.training_dir not in training_sets:
+    raise Exception("Invalid training set")
+
+
+class SweepJob(object):
+    """
+    :param model_architecture: str -- member of model_archs
+    :param hyperparameter_set: str -- member of hyperparameters
+    """
+
+    def __init__(self, model_architecture, hyperparameter_set):
+        self.model_architecture = model_architecture
+        self.hyperparameter_set = hyperparameter_set
+        self.name = 'sweep_{}_{}_{}'.format(args.training_dir, model_architecture, hyperparameter_set)
+        self.job_dir = os.path.join(args.sweep_dir, self.name)
+        self.metrics_file = os.path.join(self.job_dir, 'metrics.jsonl')
+        self.process = None
+        self.cores = None
+        self.log = None
+        self.started = None
+        self.wall_time = None
+        self.status = 'pending'
+        # validation accuracy and loss of every completed epoch
+        self.val_accuracy = []
+        self.val_loss = []
+
+    def start(self, cores):
+        if not os.path.isdir(self.job_dir):
+            os.makedirs(self.job_dir)
+        if os.path.exists(self.metrics_file):
+            os.remove(self.metrics_file)
+        self.cores = cores
+        self.log = open(os.path.join(self.job_dir, 'train.log'), 'w')
+
+        # torch and its loader workers stay on the cores of the job, with one intra-op thread per core
+        env = dict(os.environ, OMP_NUM_THREADS=str(len(cores)), MKL_NUM_THREADS=str(len(cores)))
+        self.process = subprocess.Popen([sys.executable, 'train_classifier.py', '--training_dir', args.training_dir,
+                                         '--model_architecture', self.model_architecture,
+                                         '--hyperparameter_set', self.hyperparameter_set, '--output_name', self.name,
+                                         '--pretrained', args.pretrained, '--packed_dir', args.packed_dir,
+                                         '--metrics_file', self.metrics_file],
+                                        stdout=self.log, stderr=subprocess.STDOUT, env=env,
+                                        preexec_fn=lambda: os.sched_setaffinity(0, cores))
+        self.started = time.time()
+        self.status = 'running'
+
+    def read_metrics(self):
+        if not os.path.exists(self.metrics_file):
+            return
+        with open(self.metrics_file, 'r') as f:
+            # the last line may still be written to
+            metrics = [json.loads(line) for line in f if line.endswith('\n')]
+        metrics = [m for m in metrics if m['phase'] == 'validation']
+        self.val_accuracy = [m['accuracy'] for m in metrics]
+        self.val_loss = [m['loss'] for m in metrics]
+
+    def finish(self, status):
+        if self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+        self.log.close()
+        self.read_metrics()
+        self.wall_time = time.time() - self.started
+        self.status = status
+
+    def result(self):
+        return {'model_architecture': self.model_architecture, 'hyperparameter_set': self.hyperparameter_set,
+                'status': self.status, 'epochs': len(self.val_accuracy),
+                'best_val_accuracy': max(self.val_accuracy) if self.val_accuracy else np.nan,
+                'final_val_accuracy': self.val_accuracy[-1] if self.val_accuracy else np.nan,
+                'final_val_loss': self.val_loss[-1] if self.val_loss else np.nan,
+                'wall_time': self.wall_time, 'cores': len(self.cores)}
+
+
+def prepare_packed_set():
+    # one packed set, large enough for every architecture of the sweep, is shared by all jobs
+    sizes = {arch: packed_size(model_archs[arch]['input_size']) for arch in args.model_architectures}
+    largest = max(sizes, key=sizes.get)
+    meta_files = [os.path.join(args.packed_dir, args.training_dir, x, 'meta.json') for x in ['training', 'validation']]
+    if all(os.path.exists(meta_file) for meta_file in meta_files):
+        with open(meta_files[0], 'r') as f:
+            if json.load(f)['size'] >= sizes[largest]:
+                return
+    print('Packing {} for {}'.format(args.training_dir, largest))
+    code = subprocess.call([sys.executable, 'pack_training_set.py', '--training_dir', args.training_dir,
+                            '--model_architecture', largest, '--out_dir', args.packed_dir,
+                            '--num_workers', str(args.total_cores)])
+    if code != 0:
+        raise Exception("Packing {} failed".format(args.training_dir))
+
+
+def should_prune(job, jobs):
+    """
+    Median stopping rule: stops a run whose best validation accuracy so far is clearly below the median of what the
+    other runs had reached after the same number of epochs.
+    """
+    epoch = len(job.val_accuracy)
+    if epoch < args.prune_after:
+        return False
+    others = [max(other.val_accuracy[:epoch]) for other in jobs
+              if other is not job and len(other.val_accuracy) >= epoch]
+    if len(others) < args.prune_min_runs:
+        return False
+    return max(job.val_accuracy) < np.median(others) - args.prune_margin
+
+
+def write_results(jobs, results_file):
+    results = pd.DataFrame([job.result() for job in jobs if job.status in ['done', 'pruned', 'failed']])
+    if len(results) > 0:
+        results = results.sort_values('best_val_accuracy', ascending=False)
+    results.to_csv(results_file, index=False)
+    return results
+
+
+def main():
+    available = sorted(os.sched_getaffinity(0))
+    if args.total_cores is None:
+        args.total_cores = len(available)
+    cores_per_job = min(args.cores_per_job, args.total_cores)
+    # disjoint core sets, one per concurrently running job
+    slots = [set(available[start:start + cores_per_job])
+             for start in range(0, min(args.total_cores, len(available)) - cores_per_job + 1, cores_per_job)]
+    if not slots:
+        raise Exception("Not enough cores for a single job")
+
+    if not os.path.isdir(args.sweep_dir):
+        os.makedirs(args.sweep_dir)
+    results_file = os.path.join(args.sweep_dir, 'results_{}.csv'.format(args.training_dir))
+    prepare_packed_set()
+
+    jobs = [SweepJob(arch, hyperparameter_set) for arch in args.model_architectures
+            for hyperparameter_set in args.hyperparameter_sets]
+    pending = list(jobs)
+    running = []
+    print('Sweeping {} runs, {} at a time with {} cores each'.format(len(jobs), len(slots), cores_per_job))
+
+    since = time.time()
+    while pending or running:
+        while pending and slots:
+            job = pending.pop(0)
+            job.start(slots.pop(0))
+            running.append(job)
+            print('started {} on cores {}'.format(job.name, sorted(job.cores)))
+
+        time.sleep(args.poll_interval)
+
+        for job in list(running):
+            job.read_metrics()
+            code = job.process.poll()
+            if code is not None:
+                job.finish('done' if code == 0 else 'failed')
+            elif should_prune(job, jobs):
+                job.finish('pruned')
+            else:
+                continue
+            running.remove(job)
+            slots.append(job.cores)
+            write_results(jobs, results_file)
+            print('{} {} after {} epochs, best validation accuracy: {:.4f}, {:.0f}s'.format(
+                job.name, job.status, len(job.val_accuracy), max(job.val_accuracy or [np.nan]), job.wall_time))
+
+    time_elapsed = time.time() - since
+    print('Sweep complete in {}h {:.0f}m {:.0f}s'.format(
+        time_elapsed // 3600, (time_elapsed % 3600) // 60, time_elapsed % 60))
+    print(write_results(jobs, results_file).to_string(index=False))
+    print('results: {}'.format(results_file))
+
+
+if __name__ == '__main__':
+    main()
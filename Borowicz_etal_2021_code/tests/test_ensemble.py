@@ -0,0 +1,32 @@
+# Run from Borowicz_etal_2021_code with: python -m pytest tests
+
+import pytest
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from utils.ensemble import Ensemble
+
+
+@pytest.mark.parametrize('combine', ['probs', 'logits'])
+def test_members_on_other_device(combine):
+    # the meta device stands in for a GPU, the wrapper and its weights stay on the CPU like in predict_images.py
+    members = [nn.Linear(4, 3).to('meta') for _ in range(2)]
+    model = Ensemble(members, weights=[1., 3.], combine=combine)
+    outputs = model(torch.zeros(2, 4, device='meta'))
+    assert outputs.device.type == 'meta'
+    assert outputs.shape == (2, 3)
+
+
+@pytest.mark.parametrize('combine', ['probs', 'logits'])
+def test_weighted_average(combine):
+    members = [nn.Linear(4, 3) for _ in range(2)]
+    model = Ensemble(members, weights=[1., 3.], combine=combine)
+    inputs = torch.randn(5, 4)
+    with torch.no_grad():
+        outputs = [member(inputs) for member in members]
+        if combine == 'logits':
+            expected = F.softmax(0.25 * outputs[0] + 0.75 * outputs[1], dim=1)
+        else:
+            expected = 0.25 * F.softmax(outputs[0], dim=1) + 0.75 * F.softmax(outputs[1], dim=1)
+        assert torch.allclose(F.softmax(model(inputs), dim=1), expected, atol=1e-6)
@@ -3,13 +3,27 @@ import torch.nn as nn
 import torch.optim as optim
 from torch.optim import lr_scheduler
 import numpy as np
-from torchvision import datasets, models, transforms
+from torchvision import datasets, transforms
 from torch.autograd import Variable
 import os
 import argparse
+import json
+import sys
 from tensorboardX import SummaryWriter
 import time
 from utils.model_library import *
+from utils.dataloaders.shard_dataset import PackedImageFolder, packed_size
+from utils.dataloaders.dataset_index import DatasetIndex, IndexedImageFolder
+from utils.dataloaders.transforms_batch import BatchAugment
+from utils.dataloaders.loader_config import loader_settings, make_dataloader, uint8_transfer
+from utils.image_validation import SkiplistFilter, load_skiplist
+from utils.dataloaders.samplers import StratifiedBatchSampler
+from utils.dataloaders.tensor_cache import CachedDataset
+from utils.distributed import all_reduce_sum, barrier, broadcast_values, cleanup_distributed, gather_values, \
+    init_distributed, launch_local
+from utils.model_loader import build_pretrained_model
+from utils.step_timer import StepTimer, loader_queue_depth, rss_mb, worker_rss_mb
+from utils.checkpoints import get_rng_states, latest_checkpoint, load_checkpoint, save_checkpoint, set_rng_states
 from PIL import ImageFile
 import warnings
 
@@ -23,6 +37,44 @@ parser.add_argument('--output_name', type=str, help='name of output file from tr
                                                     'subsequent steps of the pipeline')
 parser.add_argument('--pretrained', type=str, default='True', help='whether or not the model will be loaded with '
                                                                    'pretrained weights')
+parser.add_argument('--packed_dir', type=str, default=None, help='directory written by pack_training_set.py, images '
+                                                                 'are read from its pre-decoded shards instead of '
+                                                                 'training_sets')
+parser.add_argument('--dataset_index', type=str, default=None, help='SQLite file indexing the training set, only '
+                                                                     'directories changed since the last run are '
+                                                                     'listed again')
+parser.add_argument('--batch_augment', action='store_true', help='workers only crop images and hand over uint8 '
+                                                                 'tensors, augmentation and normalization run on '
+                                                                 'whole batches as tensor ops')
+parser.add_argument('--skiplist', type=str, default=None, help='skiplist written by preflight_images.py, images on it '
+                                                               'are left out, packed sets are filtered when packing')
+parser.add_argument('--sampler', type=str, default='weighted', choices=['weighted', 'stratified'],
+                    help='weighted draws images with replacement with class balanced weights, stratified gives every '
+                         'batch an equal class mix without repeating images of a class before all of them were seen')
+parser.add_argument('--seed', type=int, default=None, help='random seed of the batch order and loader worker '
+                                                          'augmentation, drawn for every run by default')
+parser.add_argument('--val_cache_mb', type=float, default=0, help='megabytes of shared memory for caching transformed '
+                                                                   'validation images, so only the first epoch decodes '
+                                                                   'them')
+parser.add_argument('--nprocs', type=int, default=1, help='number of data-parallel training processes started on this '
+                                                          'machine, use torchrun instead for several machines')
+parser.add_argument('--master_port', type=int, default=29500, help='free port for connecting the processes started '
+                                                                   'with --nprocs')
+parser.add_argument('--resume', action='store_true', help='continue from the newest checkpoint of the run in '
+                                                          'saved_models/<output_name>/checkpoints')
+parser.add_argument('--checkpoint_every', type=int, default=1, help='epochs between checkpoints, the last epoch is '
+                                                                    'always checkpointed, 0 to disable checkpoints')
+parser.add_argument('--keep_checkpoints', type=int, default=2, help='number of newest checkpoints kept, 0 to keep '
+                                                                    'all of them')
+parser.add_argument('--init_weights', type=str, default=None, help='weights to start from instead of the pretrained '
+                                                                   'ones, e.g. a head trained by train_head.py')
+parser.add_argument('--metrics_file', type=str, default=None, help='file epoch metrics are appended to as json lines, '
+                                                                   'e.g. for sweep.py')
+parser.add_argument('--profile', action='store_true', help='time data loading, host to device copies, forward, '
+                                                           'backward and optimizer steps of the training loop and '
+                                                           'log them to tensorboard')
+parser.add_argument('--profile_every', type=int, default=20, help='training steps between logged step timings, '
+                                                                  'epoch summaries cover every step')
 
 args = parser.parse_args()
 
@@ -42,9 +94,40 @@ ImageFile.LOAD_TRUNCATED_IMAGES = True
 # we get an RGB warning, but the loader properly converts to RGB -after- this
 warnings.filterwarnings('ignore', module='PIL')
 
+# data-parallel training: this process only starts the training processes, which rerun the script with their rank set
+if args.nprocs > 1 and 'RANK' not in os.environ:
+    sys.exit(launch_local(args.nprocs, args.master_port))
+
+# gradients are all-reduced between processes, started by --nprocs or torchrun, each working on its own share of
+# every epoch
+world_size, rank, local_rank, local_world_size = init_distributed('gloo')
+distributed = world_size > 1
+
+checkpoint_dir = 'saved_models/{}/checkpoints'.format(args.output_name)
+resume_state = None
+if args.resume:
+    resume_path = latest_checkpoint(checkpoint_dir)
+    if resume_path is None:
+        raise Exception("No checkpoint to resume from in {}".format(checkpoint_dir))
+    resume_state = load_checkpoint(resume_path)
+    for key in ['training_dir', 'model_architecture', 'hyperparameter_set']:
+        if resume_state['args'][key] != getattr(args, key):
+            raise Exception("Checkpoint was trained with --{} {}".format(key, resume_state['args'][key]))
+    if rank == 0:
+        print('Resuming from {}'.format(resume_path))
+
 # Data augmentation and normalization for training
 # Just normalization for validation
 arch_input_size = model_archs[args.model_architecture]['input_size']
+brightness = np.random.choice([0, 1]) * 0.05
+contrast = np.random.choice([0, 1]) * 0.05
+if resume_state is not None:
+    brightness, contrast = resume_state['augmentation']['brightness'], resume_state['augmentation']['contrast']
+seed = args.seed if args.seed is not None else int(np.random.randint(2 ** 31))
+# every process has to augment with the same settings and draw batches with the same seed
+brightness, contrast, seed = broadcast_values([brightness, contrast, seed])
+if rank == 0 and resume_state is None:
+    print('Seed: {}'.format(seed))
 
 data_transforms = {
     'training': transforms.Compose([
@@ -53,8 +136,7 @@ data_transforms = {
         transforms.RandomRotation(180, expand=True),
         transforms.CenterCrop(arch_input_size * 1.5),
         transforms.RandomResizedCrop(size=arch_input_size, scale=(0.8, 1), ratio=(0.95, 1.05)),
-        transforms.ColorJitter(brightness=np.random.choice([0, 1]) * 0.05,
-                               contrast=np.random.choice([0, 1]) * 0.05),
+        transforms.ColorJitter(brightness=brightness, contrast=contrast),
         transforms.ToTensor(),
         transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
     ]),
@@ -65,109 +147,288 @@ data_transforms = {
     ]),
 }
 
-data_dir = "./training_sets/{}".format(args.training_dir)
-image_datasets = {x: datasets.ImageFolder(os.path.join(data_dir, x),
-                                          data_transforms[x])
-                  for x in ['training', 'validation']}
+loader_config = loader_settings(hyperparameters[args.hyperparameter_set])
+
+# batch_size_train is the batch size over all processes, so the learning rate schedule holds for any number of them
+batch_size_train = hyperparameters[args.hyperparameter_set]['batch_size_train'] // world_size
+if batch_size_train < 1:
+    raise Exception("Batch size {} is smaller than the number of processes".format(
+        hyperparameters[args.hyperparameter_set]['batch_size_train']))
+num_workers_train = hyperparameters[args.hyperparameter_set]['num_workers_train']
+num_workers_val = hyperparameters[args.hyperparameter_set]['num_workers_val']
+if distributed:
+    # loading processes of the node are split between the training processes
+    num_workers_train = max(num_workers_train // local_world_size, 1)
+    num_workers_val = max(num_workers_val // local_world_size, 1)
+
+# tensor ops applied to whole batches in the main process, after collation
+batch_transforms = {'training': None, 'validation': None}
+if args.batch_augment:
+    # batch level augmentation with the same settings as the per image pipeline above
+    batch_transforms = {'training': BatchAugment(arch_input_size, augment=True, brightness=brightness,
+                                                 contrast=contrast),
+                        'validation': BatchAugment(arch_input_size, augment=False)}
+    # workers only crop, packed images are handed over as uint8 tensors already
+    to_uint8 = [] if args.packed_dir is not None else [transforms.PILToTensor()]
+    data_transforms = {'training': transforms.Compose([transforms.CenterCrop(packed_size(arch_input_size))] +
+                                                      to_uint8),
+                       'validation': transforms.Compose([transforms.CenterCrop(arch_input_size)] + to_uint8)}
+elif loader_config['uint8_transfer']:
+    # workers hand over uint8 images, normalized after collation
+    for x in ['training', 'validation']:
+        data_transforms[x], batch_transforms[x] = uint8_transfer(data_transforms[x])
+
+if args.packed_dir is not None:
+    # pre-decoded images, shared between workers through the page cache
+    data_dir = os.path.join(args.packed_dir, args.training_dir)
+    image_datasets = {x: PackedImageFolder(os.path.join(data_dir, x), data_transforms[x],
+                                           to_pil=not args.batch_augment)
+                      for x in ['training', 'validation']}
+    if image_datasets['training'].size < packed_size(arch_input_size):
+        raise Exception("Packed images are too small for {} augmentation, repack with --model_architecture {}".format(
+            args.model_architecture, args.model_architecture))
+elif args.dataset_index is not None:
+    data_dir = "./training_sets/{}".format(args.training_dir)
+    image_datasets = {}
+    # a single process brings the index up to date, the others read it afterwards
+    if rank == 0:
+        for x in ['training', 'validation']:
+            DatasetIndex(args.dataset_index, os.path.join(data_dir, x)).close()
+    barrier()
+    for x in ['training', 'validation']:
+        index = DatasetIndex(args.dataset_index, os.path.join(data_dir, x), refresh=False)
+        image_datasets[x] = IndexedImageFolder(index, data_transforms[x], skiplist=load_skiplist(args.skiplist))
+        index.close()
+else:
+    data_dir = "./training_sets/{}".format(args.training_dir)
+    is_valid_file = None
+    if args.skiplist is not None:
+        is_valid_file = SkiplistFilter(load_skiplist(args.skiplist), datasets.folder.IMG_EXTENSIONS)
+    image_datasets = {x: datasets.ImageFolder(os.path.join(data_dir, x),
+                                              data_transforms[x], is_valid_file=is_valid_file)
+                      for x in ['training', 'validation']}
 
-dataset_sizes = {x: len(image_datasets[x]) for x in ['training', 'validation']}
 class_names = image_datasets['training'].classes
 num_classes = len(class_names)
 
+# every process validates its own share of the images
+if distributed:
+    image_datasets['validation'] = torch.utils.data.Subset(image_datasets['validation'],
+                                                           range(rank, len(image_datasets['validation']), world_size))
+
+# validation transforms are deterministic, so decoded images can be kept for later epochs
+if args.val_cache_mb > 0:
+    image_datasets['validation'] = CachedDataset(image_datasets['validation'], args.val_cache_mb)
+    if rank == 0:
+        print('Caching {} of {} validation images'.format(image_datasets['validation'].capacity,
+                                                          len(image_datasets['validation'])))
+
+dataset_sizes = {x: len(image_datasets[x]) for x in ['training', 'validation']}
+
 
 # Force minibatches to have an equal representation amongst classes during training with a weighted sampler
 def make_weights_for_balanced_classes(images, nclasses):
-    count = [0] * nclasses
-    for item in images:
-        count[item[1]] += 1
-    weight_per_class = [0.] * nclasses
-    N = float(sum(count))
-    for i in range(nclasses):
-        weight_per_class[i] = N / float(count[i])
-    weight = [0] * len(images)
-    for idx, val in enumerate(images):
-        weight[idx] = weight_per_class[val[1]]
-    return weight
-
-
-# For unbalanced dataset we create a weighted sampler
-weights = make_weights_for_balanced_classes(image_datasets['training'].imgs, num_classes)
-weights = torch.DoubleTensor(weights)
-sampler = torch.utils.data.sampler.WeightedRandomSampler(weights, len(weights))
-
-
-# change batch size ot match number of GPU's being used?
-dataloaders = {"training": torch.utils.data.DataLoader(image_datasets["training"],
-                                                       batch_size=
-                                                       hyperparameters[args.hyperparameter_set]['batch_size_train'],
-                                                       sampler=sampler, num_workers=
-                                                       hyperparameters[args.hyperparameter_set]['num_workers_train']),
-               "validation": torch.utils.data.DataLoader(image_datasets["validation"],
-                                                         batch_size=
-                                                         hyperparameters[args.hyperparameter_set]['batch_size_val'],
-                                                         num_workers=
-                                                         hyperparameters[args.hyperparameter_set]['num_workers_val'])
+    targets = np.array([item[1] for item in images], dtype=np.int64)
+    count = np.bincount(targets, minlength=nclasses)
+    weight_per_class = float(count.sum()) / np.maximum(count, 1)
+    return weight_per_class[targets].tolist()
+
+
+# generators for drawing images and loader worker seeds, apart from the global one and different in every process
+sampler_generator = torch.Generator()
+sampler_generator.manual_seed(seed + rank)
+loader_generator = torch.Generator()
+loader_generator.manual_seed(seed + world_size + rank)
+
+# For unbalanced dataset we either stratify every batch or create a weighted sampler
+sampler = None
+batch_sampler = None
+if args.sampler == 'stratified':
+    # batches are split between processes by the sampler
+    batch_sampler = StratifiedBatchSampler(image_datasets['training'].targets, batch_size=batch_size_train,
+                                           class_weights=[1] * num_classes, seed=seed)
+    dataset_sizes['training'] = len(batch_sampler) * batch_sampler.batch_size
+else:
+    weights = make_weights_for_balanced_classes(image_datasets['training'].imgs, num_classes)
+    weights = torch.DoubleTensor(weights)
+    # draws are independent, so every process draws its share of the epoch on its own
+    sampler = torch.utils.data.sampler.WeightedRandomSampler(weights, len(weights) // world_size,
+                                                             generator=sampler_generator)
+    dataset_sizes['training'] = len(sampler)
+
+
+# with worker_affinity, the persistent workers of both loaders, and of every process on the node, get their own cores
+core_offset = local_rank * (num_workers_train + num_workers_val)
+dataloaders = {"training": make_dataloader(image_datasets["training"], batch_size=batch_size_train,
+                                          num_workers=num_workers_train, settings=loader_config,
+                                          core_offset=core_offset, sampler=sampler, batch_sampler=batch_sampler,
+                                          generator=loader_generator),
+               "validation": make_dataloader(image_datasets["validation"],
+                                            batch_size=hyperparameters[args.hyperparameter_set]['batch_size_val'],
+                                            num_workers=num_workers_val, settings=loader_config,
+                                            core_offset=core_offset + num_workers_train, generator=loader_generator)
                }
 
 
 use_gpu = torch.cuda.is_available()
+if use_gpu:
+    # one GPU per process on each node
+    torch.cuda.set_device(local_rank % torch.cuda.device_count())
+    batch_transforms = {x: batch_transforms[x].cuda() if batch_transforms[x] is not None else None
+                        for x in batch_transforms}
+
+
+def get_checkpoint(model, optimizer, scheduler, epoch, global_step):
+    """
+    :return: dict -- state for resuming after epoch, random number generator states of every process included
+    """
+    rng_states = gather_values({'global': get_rng_states(), 'sampler': sampler_generator.get_state(),
+                                'loader': loader_generator.get_state()})
+    return {'epoch': epoch, 'global_step': global_step,
+            'model': model.module.state_dict() if distributed else model.state_dict(),
+            'optimizer': optimizer.state_dict(), 'scheduler': scheduler.state_dict(),
+            'sampler': batch_sampler.state_dict() if batch_sampler is not None else None,
+            'rng': rng_states, 'augmentation': {'brightness': brightness, 'contrast': contrast},
+            'args': vars(args)}
+
+
+def log_step(writer, step_times, n_images, queue_depth, loader_iter, global_step):
+    """
+    Writes the timings of a training step, loader queue depth and memory use to tensorboard.
+    """
+    for section, seconds in step_times.items():
+        writer.add_scalar('step_timing/{}_ms'.format(section), 1000. * seconds, global_step=global_step)
+    writer.add_scalar('step_timing/images_per_sec', n_images / max(sum(step_times.values()), 1e-9),
+                      global_step=global_step)
+    if queue_depth is not None:
+        writer.add_scalar('loader/queue_depth', queue_depth, global_step=global_step)
+    writer.add_scalar('memory/rss_mb', rss_mb(), global_step=global_step)
+    writer.add_scalar('memory/worker_rss_mb', worker_rss_mb(loader_iter), global_step=global_step)
 
 
 def train_model(model, criterion, optimizer, scheduler, num_epochs=25):
     since = time.time()
 
-    # create summary writer for tensorboardX
-    writer = SummaryWriter()
+    # create summary writer for tensorboardX, all processes report the same epoch metrics
+    writer = SummaryWriter() if rank == 0 else None
+    # only the training loop is timed
+    timers = {'training': StepTimer(enabled=args.profile, sync_cuda=use_gpu), 'validation': StepTimer(enabled=False)}
     # keep track of training iterations
     global_step = 0
-
-    for epoch in range(num_epochs):
-        print('Epoch {}/{}'.format(epoch + 1, num_epochs))
-        print('-' * 10)
+    start_epoch = 0
+
+    # model, optimizer and scheduler are restored in main
+    if resume_state is not None:
+        start_epoch = resume_state['epoch']
+        global_step = resume_state['global_step']
+        if batch_sampler is not None:
+            batch_sampler.load_state_dict(resume_state['sampler'])
+        # processes added since the checkpoint keep their fresh generators
+        if rank < len(resume_state['rng']):
+            rng_states = resume_state['rng'][rank]
+            set_rng_states(rng_states['global'])
+            sampler_generator.set_state(rng_states['sampler'])
+            loader_generator.set_state(rng_states['loader'])
+
+    for epoch in range(start_epoch, num_epochs):
+        if batch_sampler is not None:
+            batch_sampler.set_epoch(epoch)
+        if rank == 0:
+            print('Epoch {}/{}'.format(epoch + 1, num_epochs))
+            print('-' * 10)
 
         # Each epoch has a training and validation phase
         for phase in ['training', 'validation']:
             if phase == 'training':
                 scheduler.step()
                 model.train(True)  # Set model to training mode
+                net = model
             else:
                 model.train(False)  # Set model to evaluate mode
+                # processes may get different numbers of validation batches, so the local copy validates, without the
+                # buffer broadcasts of DistributedDataParallel
+                net = model.module if distributed else model
 
             running_loss = 0.0
             running_corrects = 0
+            running_samples = 0
 
             # Iterate over data.
-            for data in dataloaders[phase]:
+            timer = timers[phase]
+            timer.start_epoch()
+            loader_iter = iter(dataloaders[phase])
+            for data in loader_iter:
+                timer.mark('data')
                 # get the inputs
                 inputs, labels = data
 
                 # wrap them in Variable
                 if use_gpu:
-                    inputs = Variable(inputs.cuda())
-                    labels = Variable(labels.cuda())
+                    inputs = Variable(inputs.cuda(non_blocking=True))
+                    labels = Variable(labels.cuda(non_blocking=True))
                 else:
                     inputs, labels = Variable(inputs), Variable(labels)
+                timer.mark('copy')
+
+                if batch_transforms[phase] is not None:
+                    inputs = batch_transforms[phase](inputs)
+                timer.mark('transform')
 
                 # zero the parameter gradients
                 optimizer.zero_grad()
+                timer.mark('optimizer')
 
                 # forward
-                outputs = model(inputs)
-                _, preds = torch.max(outputs.data, 1)
-                loss = criterion(outputs, labels)
+                with torch.set_grad_enabled(phase == 'training'):
+                    outputs = net(inputs)
+                    _, preds = torch.max(outputs.data, 1)
+                    loss = criterion(outputs, labels)
+                timer.mark('forward')
 
                 # backward + optimize only if in training phase
                 if phase == 'training':
                     loss.backward()
+                    timer.mark('backward')
                     optimizer.step()
+                    timer.mark('optimizer')
                     global_step += 1
 
                 # statistics
-                running_loss += loss.item() * inputs.size(1)
+                running_loss += loss.item() * labels.size(0)
                 running_corrects += torch.sum(preds == labels.data).item()
+                running_samples += labels.size(0)
+                timer.mark('metrics')
+
+                if timer.enabled:
+                    queue_depth = loader_queue_depth(loader_iter)
+                    step_times = timer.end_step(labels.size(0), queue_depth)
+                    if writer is not None and global_step % args.profile_every == 0:
+                        log_step(writer, step_times, labels.size(0), queue_depth, loader_iter, global_step)
+                    # queue depth, memory readings and tensorboard writes are not data loading time
+                    timer.resume()
+
+            # totals over all processes
+            running_loss, running_corrects, running_samples = all_reduce_sum([running_loss, running_corrects,
+                                                                              running_samples])
+            epoch_loss = running_loss / max(running_samples, 1)
+            epoch_acc = running_corrects / max(running_samples, 1)
+            if rank != 0:
+                continue
+
+            timing = timer.epoch_summary()
+            if timing is not None:
+                for key, value in timing.items():
+                    writer.add_scalar('epoch_timing/{}'.format(key), value, global_step=global_step)
+                print('{} timing: {:.0f} images/s, {:.0%} waiting for data, ms per step: {}'.format(
+                    phase, timing['images_per_sec'], timing['data_wait_fraction'],
+                    ', '.join('{} {:.1f}'.format(key[:-3], value) for key, value in timing.items()
+                              if key.endswith('_ms'))))
+
+            if args.metrics_file is not None:
+                with open(args.metrics_file, 'a') as f:
+                    f.write(json.dumps({'epoch': epoch + 1, 'phase': phase, 'loss': epoch_loss, 'accuracy': epoch_acc,
+                                        'global_step': global_step, 'time': time.time() - since}) + '\n')
 
-            epoch_loss = running_loss / dataset_sizes[phase]
-            epoch_acc = running_corrects / dataset_sizes[phase]
             if phase == 'validation':
                 writer.add_scalar('validation_loss', epoch_loss, global_step=global_step)
                 writer.add_scalar('validation_accuracy', epoch_acc, global_step=global_step)
@@ -185,34 +446,24 @@ def train_model(model, criterion, optimizer, scheduler, num_epochs=25):
                 print('training time: {}h {:.0f}m {:.0f}s\n'.format(time_elapsed // 3600, (time_elapsed % 3600) // 60,
                                                                     time_elapsed % 60))
 
+        if args.checkpoint_every > 0 and ((epoch + 1) % args.checkpoint_every == 0 or epoch + 1 == num_epochs):
+            checkpoint = get_checkpoint(model, optimizer, scheduler, epoch + 1, global_step)
+            if rank == 0:
+                save_checkpoint(checkpoint, checkpoint_dir, epoch + 1, keep=args.keep_checkpoints)
+
     time_elapsed = time.time() - since
-    print('Training complete in {}h {:.0f}m {:.0f}s'.format(
-        time_elapsed // 3600, (time_elapsed % 3600) // 60, time_elapsed % 60))
+    if rank == 0:
+        print('Training complete in {}h {:.0f}m {:.0f}s'.format(
+            time_elapsed // 3600, (time_elapsed % 3600) // 60, time_elapsed % 60))
 
     # save the model, keeping haulout and single seal models in separate folders
-    torch.save(model.state_dict(), 'saved_models/{}/{}.tar'.format(args.output_name, args.output_name))
+    if rank == 0:
+        state_dict = model.module.state_dict() if distributed else model.state_dict()
+        torch.save(state_dict, 'saved_models/{}/{}.tar'.format(args.output_name, args.output_name))
 
     return model
 
 
-def get_partial_weights(model_dict, pretrained_dict):
-    """
-    :param model_dict: python dictionary for CNN features with empty weights {feature: weight}
-    :param pretrained_dict: python dictionary with CNN features and pretrained weights {feature: weight}
-    :return: python dictionary with the weights that can be loaded to model_dict and empty weights for features that
-    cannot be loaded.
-    """
-    pretrained_features = {par: val for par, val in pretrained_dict.items() if val.size() ==
-                           model_dict[par].size()}
-
-
-    for key in model_dict:
-        if key not in pretrained_features:
-            pretrained_features[key] = model_dict[key]
-
-    return pretrained_features
-
-
 def main():
     # check pretrained flag
     if args.pretrained == 'True':
@@ -221,65 +472,25 @@ def main():
         pretrained = False
 
     # loading the pretrained model and adding new classes to it
-    if args.model_architecture == "Resnet18":
-        model_ft = models.resnet18(pretrained=pretrained)
-        num_ftrs = model_ft.fc.in_features
-        model_ft.fc = nn.Linear(num_ftrs, num_classes)
-
-    elif args.model_architecture == "Resnet34":
-        model_ft = models.resnet34(pretrained=pretrained)
-        num_ftrs = model_ft.fc.in_features
-        model_ft.fc = nn.Linear(num_ftrs, num_classes)
-
-    elif args.model_architecture == "Resnet50":
-        model_ft = models.resnet50(pretrained=pretrained)
-        num_ftrs = model_ft.fc.in_features
-        model_ft.fc = nn.Linear(num_ftrs, num_classes)
-
-    elif args.model_architecture == "Squeezenet11":
-        model_ft = models.squeezenet1_1(pretrained=False, num_classes=num_classes)
-        features = model_ft.state_dict()
-        pretrained_features = get_partial_weights(features, models.squeezenet1_1(pretrained=pretrained).state_dict())
-        model_ft.load_state_dict(pretrained_features)
-
-    elif args.model_architecture == "Densenet121":
-        model_ft = models.densenet121(pretrained=False, num_classes=num_classes)
-        features = model_ft.state_dict()
-        pretrained_features = get_partial_weights(features, models.densenet121(pretrained=pretrained).state_dict())
-        model_ft.load_state_dict(pretrained_features)
-
-    elif args.model_architecture == "Densenet169":
-        model_ft = models.densenet169(pretrained=False, num_classes=num_classes)
-        features = model_ft.state_dict()
-        pretrained_features = get_partial_weights(features, models.densenet121(pretrained=pretrained).state_dict())
-        model_ft.load_state_dict(pretrained_features)
-
-    elif args.model_architecture == "Alexnet":
-        model_ft = models.alexnet(pretrained=False, num_classes=num_classes)
-        features = model_ft.state_dict()
-        pretrained_features = get_partial_weights(features, models.alexnet(pretrained=pretrained).state_dict())
-        model_ft.load_state_dict(pretrained_features)
-
-    elif args.model_architecture == "VGG16":
-        model_ft = models.vgg16_bn(pretrained=False, num_classes=num_classes)
-        features = model_ft.state_dict()
-        pretrained_features = get_partial_weights(features, models.vgg16_bn(pretrained=pretrained).state_dict())
-        model_ft.load_state_dict(pretrained_features)
+    model_ft = build_pretrained_model(args.model_architecture, num_classes, pretrained)
+    if args.init_weights is not None:
+        model_ft.load_state_dict(torch.load(args.init_weights, map_location='cpu'))
 
     # define criterion for loss function
     criterion = nn.CrossEntropyLoss()
 
     if use_gpu:
-        # i think we can set parallel GPU usage here. will test
-        # http://pytorch.org/docs/master/nn.html
-        # http://pytorch.org/docs/master/nn.html#dataparallel-layers-multi-gpu-distributed
-        # The batch size should be larger than the number of GPUs used.
-        # It should also be an integer multiple of the number of GPUs so that
-        # each chunk is the same size (so that each GPU processes the same number of samples).
-        # model_ft = nn.DataParallel(model_ft).cuda()
         model_ft = model_ft.cuda()
         criterion = criterion.cuda()
 
+    if resume_state is not None:
+        model_ft.load_state_dict(resume_state['model'])
+
+    if distributed:
+        # starts from the weights of rank 0 and averages gradients between processes during backward
+        model_ft = nn.parallel.DistributedDataParallel(model_ft, device_ids=[torch.cuda.current_device()] if use_gpu
+                                                       else None)
+
     # Observe that all parameters are being optimized
     optimizer_ft = optim.Adam(model_ft.parameters(), lr=hyperparameters[args.hyperparameter_set]['learning_rate'])
 
@@ -287,9 +498,14 @@ def main():
     exp_lr_scheduler = lr_scheduler.StepLR(optimizer_ft, step_size=hyperparameters[args.hyperparameter_set]['step_size']
                                            , gamma=hyperparameters[args.hyperparameter_set]['gamma'])
 
+    if resume_state is not None:
+        optimizer_ft.load_state_dict(resume_state['optimizer'])
+        exp_lr_scheduler.load_state_dict(resume_state['scheduler'])
+
     # start training
     model_ft = train_model(model_ft, criterion, optimizer_ft, exp_lr_scheduler,
                            num_epochs=hyperparameters[args.hyperparameter_set]['epochs'])
+    cleanup_distributed()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,240 @@
+# Trains only the final layer of a pretrained architecture. The frozen backbone runs once over a fixed set of augmented
+# views of the training set, its penultimate layer embeddings are cached in ./cache/embeddings and the head is trained
+# on them, which takes seconds per epoch. The result is saved like a train_classifier.py model, and --fine_tune
+# continues with full training from it.
+#
+# Usage: python train_head.py --training_dir training_set_13_MAY_18 --model_architecture Resnet50
+#                             --hyperparameter_set C --output_name head_r50 --fine_tune
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from torch.optim import lr_scheduler
+from torchvision import datasets, transforms
+from PIL import ImageFile
+import warnings
+
+from utils.model_library import *
+from utils.model_loader import build_pretrained_model, weights_path
+from utils.embedding_cache import HEAD_MODULES, build_embeddings, get_head, load_embeddings, set_head
+from utils.dataloaders.loader_config import loader_settings, make_dataloader, uint8_transfer
+from utils.dataloaders.samplers import StratifiedBatchSampler
+
+parser = argparse.ArgumentParser(description='trains the final layer of a CNN on cached embeddings of its frozen '
+                                             'pretrained backbone')
+parser.add_argument('--training_dir', type=str, help='base directory to recursively search for images in')
+parser.add_argument('--model_architecture', type=str, help='model architecture, must be a member of models '
+                                                           'dictionary')
+parser.add_argument('--hyperparameter_set', type=str, help='combination of hyperparameters used, must be a member of '
+                                                           'hyperparameters dictionary')
+parser.add_argument('--output_name', type=str, help='name of output file from training, this name will also be used in '
+                                                    'subsequent steps of the pipeline')
+parser.add_argument('--pretrained', type=str, default='True', help='whether or not the backbone will be loaded with '
+                                                                   'pretrained weights')
+parser.add_argument('--n_views', type=int, default=4, help='number of augmented views of every training image cached')
+parser.add_argument('--seed', type=int, default=0, help='random seed of the augmentation draws and head training')
+parser.add_argument('--cache_dir', type=str, default='./cache/embeddings', help='directory holding embedding caches')
+parser.add_argument('--rebuild_cache', action='store_true', help='compute the embeddings again, e.g. after the '
+                                                                 'training set changed')
+parser.add_argument('--head_epochs', type=int, default=50, help='number of epochs over the cached embeddings')
+parser.add_argument('--head_batch_size', type=int, default=256, help='embeddings per batch when training the head')
+parser.add_argument('--fine_tune', action='store_true', help='train the whole model with train_classifier.py '
+                                                             'afterwards, starting from the trained head')
+args = parser.parse_args()
+
+# check for invalid inputs
+if args.model_architecture not in model_archs:
+    raise Exception("Unsupported architecture")
+
+if args.model_architecture not in HEAD_MODULES:
+    raise Exception("{} has no linear head to train, use train_classifier.py".format(args.model_architecture))
+
+if args.training_dir not in training_sets:
+    raise Exception("Invalid training set")
+
+if args.hyperparameter_set not in hyperparameters:
+    raise Exception("Invalid hyperparameter combination")
+
+# image transforms seem to cause truncated images, so we need this
+ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+# we get an RGB warning, but the loader properly converts to RGB -after- this
+warnings.filterwarnings('ignore', module='PIL')
+
+# the same augmentation as train_classifier.py, with draws fixed by the seed
+np.random.seed(args.seed)
+arch_input_size = model_archs[args.model_architecture]['input_size']
+brightness = np.random.choice([0, 1]) * 0.05
+contrast = np.random.choice([0, 1]) * 0.05
+
+data_transforms = {
+    'training': transforms.Compose([
+        transforms.RandomHorizontalFlip(),
+        transforms.RandomVerticalFlip(),
+        transforms.RandomRotation(180, expand=True),
+        transforms.CenterCrop(arch_input_size * 1.5),
+        transforms.RandomResizedCrop(size=arch_input_size, scale=(0.8, 1), ratio=(0.95, 1.05)),
+        transforms.ColorJitter(brightness=brightness, contrast=contrast),
+        transforms.ToTensor(),
+        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+    ]),
+    'validation': transforms.Compose([
+        transforms.CenterCrop(arch_input_size),
+        transforms.ToTensor(),
+        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+    ]),
+}
+
+hyperparameter_set = hyperparameters[args.hyperparameter_set]
+loader_config = loader_settings(hyperparameter_set)
+batch_transforms = {'training': None, 'validation': None}
+if loader_config['uint8_transfer']:
+    for x in ['training', 'validation']:
+        data_transforms[x], batch_transforms[x] = uint8_transfer(data_transforms[x])
+
+data_dir = "./training_sets/{}".format(args.training_dir)
+image_datasets = {x: datasets.ImageFolder(os.path.join(data_dir, x), data_transforms[x])
+                  for x in ['training', 'validation']}
+class_names = image_datasets['training'].classes
+num_classes = len(class_names)
+
+# validation images are not augmented, a single view is enough
+n_views = {'training': args.n_views, 'validation': 1}
+batch_sizes = {'training': hyperparameter_set['batch_size_train'], 'validation': hyperparameter_set['batch_size_val']}
+num_workers = {'training': hyperparameter_set['num_workers_train'], 'validation': hyperparameter_set['num_workers_val']}
+
+use_gpu = torch.cuda.is_available()
+if use_gpu:
+    batch_transforms = {x: batch_transforms[x].cuda() if batch_transforms[x] is not None else None
+                        for x in batch_transforms}
+
+
+def cache_name(phase):
+    return '{}_{}_{}_{}_views{}_seed{}'.format(args.training_dir, args.model_architecture, phase,
+                                               'pretrained' if args.pretrained == 'True' else 'scratch',
+                                               n_views[phase], args.seed)
+
+
+def get_embeddings(backbone, phase):
+    """
+    :param backbone: torch.nn.Module -- model with its head replaced by nn.Identity()
+    :param phase: str -- 'training' or 'validation'
+    :return: tuple -- memory-mapped embeddings and targets of the phase, computed if not cached yet
+    """
+    n_images = len(image_datasets[phase])
+    cached = load_embeddings(args.cache_dir, cache_name(phase))
+    if cached is not None and not args.rebuild_cache and len(cached[1]) == n_views[phase] * n_images:
+        return cached
+
+    def view_loader(view):
+        # every view gets its own fixed augmentation draws, in the workers or in this process
+        torch.manual_seed(args.seed * 1000 + view)
+        generator = torch.Generator()
+        generator.manual_seed(args.seed * 1000 + view)
+        return make_dataloader(image_datasets[phase], batch_size=batch_sizes[phase], num_workers=num_workers[phase],
+                               settings=loader_config, shuffle=False, generator=generator)
+
+    since = time.time()
+    cached = build_embeddings(backbone, view_loader, n_images, n_views[phase], args.cache_dir, cache_name(phase),
+                              normalize=batch_transforms[phase], use_gpu=use_gpu)
+    print('{} embeddings of {} {} images cached in {:.0f}s'.format(len(cached[1]), n_images, phase,
+                                                                   time.time() - since))
+    return cached
+
+
+def evaluate(head, criterion, embeddings, targets, chunk_size=4096):
+    """
+    :return: tuple -- loss and accuracy of the head on the embeddings
+    """
+    running_loss = 0.0
+    running_corrects = 0
+    with torch.no_grad():
+        for start in range(0, len(targets), chunk_size):
+            inputs = torch.from_numpy(np.asarray(embeddings[start:start + chunk_size], dtype=np.float32))
+            labels = torch.from_numpy(targets[start:start + chunk_size])
+            if use_gpu:
+                inputs, labels = inputs.cuda(), labels.cuda()
+            outputs = head(inputs)
+            running_loss += criterion(outputs, labels).item() * len(labels)
+            running_corrects += torch.sum(torch.argmax(outputs, 1) == labels).item()
+    return running_loss / len(targets), running_corrects / len(targets)
+
+
+def train_head(head, embeddings, targets, val_embeddings, val_targets, num_epochs):
+    criterion = nn.CrossEntropyLoss()
+    optimizer = optim.Adam(head.parameters(), lr=hyperparameter_set['learning_rate'])
+    scheduler = lr_scheduler.StepLR(optimizer, step_size=hyperparameter_set['step_size'],
+                                    gamma=hyperparameter_set['gamma'])
+    # the same class balanced batches as train_classifier.py
+    batch_sampler = StratifiedBatchSampler(targets, batch_size=args.head_batch_size, class_weights=[1] * num_classes,
+                                           seed=args.seed)
+    torch.manual_seed(args.seed)
+
+    since = time.time()
+    for epoch in range(num_epochs):
+        batch_sampler.set_epoch(epoch)
+        head.train(True)
+        for batch in batch_sampler:
+            # sorted rows read the memory-mapped embeddings in file order
+            rows = np.sort(batch)
+            inputs = torch.from_numpy(np.asarray(embeddings[rows], dtype=np.float32))
+            labels = torch.from_numpy(targets[rows])
+            if use_gpu:
+                inputs, labels = inputs.cuda(), labels.cuda()
+
+            optimizer.zero_grad()
+            loss = criterion(head(inputs), labels)
+            loss.backward()
+            optimizer.step()
+        scheduler.step()
+
+        head.train(False)
+        if (epoch + 1) % 10 == 0 or epoch + 1 == num_epochs:
+            train_loss, train_acc = evaluate(head, criterion, embeddings, targets)
+            val_loss, val_acc = evaluate(head, criterion, val_embeddings, val_targets)
+            print('Epoch {}/{} training Loss: {:.4f} Acc: {:.4f} validation Loss: {:.4f} Acc: {:.4f}'.format(
+                epoch + 1, num_epochs, train_loss, train_acc, val_loss, val_acc))
+
+    print('Head trained in {:.1f}s'.format(time.time() - since))
+    return head
+
+
+def main():
+    model = build_pretrained_model(args.model_architecture, num_classes, args.pretrained == 'True')
+
+    # frozen backbone, the head is trained on its cached outputs
+    head = get_head(model, args.model_architecture)
+    set_head(model, args.model_architecture, nn.Identity())
+    if use_gpu:
+        model = model.cuda()
+        head = head.cuda()
+    embeddings, targets = get_embeddings(model, 'training')
+    val_embeddings, val_targets = get_embeddings(model, 'validation')
+
+    head = train_head(head, embeddings, targets, val_embeddings, val_targets, args.head_epochs)
+
+    # saved like train_classifier.py models, so the pipeline and --init_weights can load it
+    set_head(model, args.model_architecture, head)
+    output_file = weights_path(args.output_name)
+    if not os.path.isdir(os.path.dirname(output_file)):
+        os.makedirs(os.path.dirname(output_file))
+    torch.save(model.cpu().state_dict(), output_file)
+    print('Saved {}'.format(output_file))
+
+    if args.fine_tune:
+        # all layers from here on, the pretrained weights are part of the saved model already
+        sys.exit(subprocess.call([sys.executable, 'train_classifier.py', '--training_dir', args.training_dir,
+                                  '--model_architecture', args.model_architecture,
+                                  '--hyperparameter_set', args.hyperparameter_set, '--output_name', args.output_name,
+                                  '--pretrained', 'False', '--init_weights', output_file]))
+
+
+if __name__ == '__main__':
+    main()
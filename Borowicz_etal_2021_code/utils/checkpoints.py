@@ -0,0 +1,101 @@
+# Epoch checkpoints for resuming training runs
+#
+# Checkpoints are written to a temporary file next to the final one and renamed into place, so a crash while saving
+# leaves the previous checkpoints untouched and never a truncated one. Only the newest ones are kept.
+
+import glob
+import os
+import random
+import re
+
+import numpy as np
+import torch
+
+_CHECKPOINT_PATTERN = re.compile(r'checkpoint_epoch_(\d+)\.tar$')
+
+
+def checkpoint_path(checkpoint_dir, epoch):
+    """
+    :param checkpoint_dir: str -- directory holding the checkpoints of a run
+    :param epoch: int -- number of epochs completed
+    :return: str -- path of the checkpoint
+    """
+    return os.path.join(checkpoint_dir, 'checkpoint_epoch_{:03d}.tar'.format(epoch))
+
+
+def list_checkpoints(checkpoint_dir):
+    """
+    :param checkpoint_dir: str -- directory holding the checkpoints of a run
+    :return: list -- (epoch, path) tuples, oldest first
+    """
+    checkpoints = []
+    for path in glob.glob(os.path.join(checkpoint_dir, 'checkpoint_epoch_*.tar')):
+        match = _CHECKPOINT_PATTERN.search(os.path.basename(path))
+        if match is not None:
+            checkpoints.append((int(match.group(1)), path))
+    return sorted(checkpoints)
+
+
+def latest_checkpoint(checkpoint_dir):
+    """
+    :param checkpoint_dir: str -- directory holding the checkpoints of a run
+    :return: str -- path of the newest checkpoint, None if there is none
+    """
+    checkpoints = list_checkpoints(checkpoint_dir)
+    return checkpoints[-1][1] if checkpoints else None
+
+
+def save_checkpoint(state, checkpoint_dir, epoch, keep=2):
+    """
+    Atomically writes a checkpoint and deletes the ones beyond the newest keep.
+
+    :param state: dict -- everything needed to resume, see train_classifier.py
+    :param checkpoint_dir: str -- directory holding the checkpoints of a run, created if missing
+    :param epoch: int -- number of epochs completed
+    :param keep: int -- number of checkpoints to keep, all of them if 0
+    :return: str -- path of the checkpoint
+    """
+    if not os.path.isdir(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+    path = checkpoint_path(checkpoint_dir, epoch)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+    if keep > 0:
+        for _, old_path in list_checkpoints(checkpoint_dir)[:-keep]:
+            os.remove(old_path)
+    return path
+
+
+def load_checkpoint(path):
+    """
+    :param path: str -- checkpoint written by save_checkpoint
+    :return: dict -- checkpoint state, tensors on the CPU
+    """
+    # checkpoints hold numpy and python RNG states next to the tensors
+    return torch.load(path, map_location='cpu', weights_only=False)
+
+
+def get_rng_states():
+    """
+    :return: dict -- states of the python, numpy, torch and CUDA random number generators of this process
+    """
+    states = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        states['cuda'] = torch.cuda.get_rng_state_all()
+    return states
+
+
+def set_rng_states(states):
+    """
+    :param states: dict -- output of get_rng_states
+    """
+    random.setstate(states['python'])
+    np.random.set_state(states['numpy'])
+    torch.set_rng_state(states['torch'])
+    if 'cuda' in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states['cuda'])
@@ -2,10 +2,10 @@
 
 import torch.utils.data as data
 
-from PIL import Image
-
 import os
 import os.path
+from utils.dataloaders.decoders import make_loader
+from utils.image_validation import is_skipped
 
 
 def has_file_allowed_extension(filename, extensions):
@@ -26,9 +26,8 @@ def find_classes(dir):
     return classes, class_to_idx
 
 
-def make_dataset(dir, class_to_idx, extensions):
+def make_dataset(dir, class_to_idx, extensions, exclude=None, skiplist=None):
     images = []
-    file_names = []
     dir = os.path.expanduser(dir)
     for target in sorted(os.listdir(dir)):
         d = os.path.join(dir, target)
@@ -39,11 +38,12 @@ def make_dataset(dir, class_to_idx, extensions):
             for fname in sorted(fnames):
                 if has_file_allowed_extension(fname, extensions):
                     path = os.path.join(root, fname)
+                    if (exclude is not None and path in exclude) or is_skipped(path, skiplist):
+                        continue
                     item = (path, class_to_idx[target])
                     images.append(item)
-                    file_names.append(fname)
 
-    return [images, file_names]
+    return images
 
 
 class DatasetFolder(data.Dataset):
@@ -63,16 +63,27 @@ class DatasetFolder(data.Dataset):
             E.g, ``transforms.RandomCrop`` for images.
         target_transform (callable, optional): A function/transform that takes
             in the target and transforms it.
+        exclude (container, optional): Sample paths to leave out, e.g. images
+            that an interrupted run already classified.
+        index (DatasetIndex, optional): Persistent index of root to read the
+            file list from instead of walking the directory tree.
+        skiplist (set, optional): Absolute paths of images that failed
+            pre-flight validation, see utils/image_validation.py.
      Attributes:
         classes (list): List of the class names.
         class_to_idx (dict): Dict with items (class_name, class_index).
         samples (list): List of (sample path, class_index) tuples
     """
 
-    def __init__(self, root, loader, extensions, transform=None, target_transform=None):
-        classes, class_to_idx = find_classes(root)
-        samples, file_names = make_dataset(root, class_to_idx, extensions)
-        if len(samples) == 0:
+    def __init__(self, root, loader, extensions, transform=None, target_transform=None, exclude=None, index=None,
+                 skiplist=None):
+        if index is not None:
+            classes, class_to_idx = index.find_classes()
+            samples = index.make_dataset(class_to_idx, extensions, exclude=exclude, skiplist=skiplist)
+        else:
+            classes, class_to_idx = find_classes(root)
+            samples = make_dataset(root, class_to_idx, extensions, exclude=exclude, skiplist=skiplist)
+        if len(samples) == 0 and not exclude:
             raise(RuntimeError("Found 0 files in subfolders of: " + root + "\n"
                                "Supported extensions are: " + ",".join(extensions)))
 
@@ -83,7 +94,6 @@ class DatasetFolder(data.Dataset):
         self.classes = classes
         self.class_to_idx = class_to_idx
         self.samples = samples
-        self.file_names = file_names
 
         self.transform = transform
         self.target_transform = target_transform
@@ -93,17 +103,17 @@ class DatasetFolder(data.Dataset):
         Args:
             index (int): Index
         Returns:
-            tuple: (sample, target) where target is class_index of the target class.
+            tuple: (sample, target, path) where target is class_index of the target class and path is the sample's
+                file path, which stays unique when crawlers reuse file names across folders.
         """
         path, target = self.samples[index]
-        file_name = self.file_names[index]
         sample = self.loader(path)
         if self.transform is not None:
             sample = self.transform(sample)
         if self.target_transform is not None:
             target = self.target_transform(target)
 
-        return sample, target, file_name
+        return sample, target, path
 
     def __len__(self):
         return len(self.samples)
@@ -122,28 +132,9 @@ class DatasetFolder(data.Dataset):
 IMG_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.ppm', '.bmp', '.pgm', '.tif']
 
 
-def pil_loader(path):
-    # open path as file to avoid ResourceWarning (https://github.com/python-pillow/Pillow/issues/835)
-    with open(path, 'rb') as f:
-        img = Image.open(f)
-        return img.convert('RGB')
-
-
-def accimage_loader(path):
-    import accimage
-    try:
-        return accimage.Image(path)
-    except IOError:
-        # Potentially a decoding problem, fall back to PIL.Image
-        return pil_loader(path)
-
-
 def default_loader(path):
-    from torchvision import get_image_backend
-    if get_image_backend() == 'accimage':
-        return accimage_loader(path)
-    else:
-        return pil_loader(path)
+    # follows torchvision's image backend, see utils/dataloaders/decoders.py for other decoders
+    return make_loader('default')(path)
 
 
 class ImageFolderTest(DatasetFolder):
@@ -161,14 +152,20 @@ class ImageFolderTest(DatasetFolder):
         target_transform (callable, optional): A function/transform that takes in the
             target and transforms it.
         loader (callable, optional): A function to load an image given its path.
+        exclude (container, optional): Image paths to leave out of the dataset.
+        index (DatasetIndex, optional): Persistent index of root, see
+            utils/dataloaders/dataset_index.py.
+        skiplist (set, optional): Absolute paths of images to leave out, see
+            utils/image_validation.py.
      Attributes:
         classes (list): List of the class names.
         class_to_idx (dict): Dict with items (class_name, class_index).
         imgs (list): List of (image path, class_index) tuples
     """
     def __init__(self, root, transform=None, target_transform=None,
-                 loader=default_loader):
+                 loader=default_loader, exclude=None, index=None, skiplist=None):
         super(ImageFolderTest, self).__init__(root, loader, IMG_EXTENSIONS,
                                               transform=transform,
-                                              target_transform=target_transform)
+                                              target_transform=target_transform,
+                                              exclude=exclude, index=index, skiplist=skiplist)
         self.imgs = self.samples
\ No newline at end of file
@@ -6,7 +6,9 @@ from PIL import Image
 
 import os
 import os.path
-import pandas as pd
+from utils.dataloaders.decoders import make_loader
+from utils.dataloaders.detection_store import DetectionLocations
+from utils.image_validation import is_skipped
 import numpy as np
 
 
@@ -28,12 +30,8 @@ def find_classes(dir):
     return classes, class_to_idx
 
 
-def make_dataset(dir, class_to_idx, extensions):
-    images = []
-    locations = []
+def walk_dataset(dir, extensions):
     dir = os.path.expanduser(dir)
-    #TODO add relative path to detections.csv
-    det_df = pd.read_csv('./training_sets/training_set_vanilla/detections.csv')
     for target in sorted(os.listdir(dir)):
         d = os.path.join(dir, target)
         if not os.path.isdir(d):
@@ -42,18 +40,24 @@ def make_dataset(dir, class_to_idx, extensions):
         for root, _, fnames in sorted(os.walk(d)):
             for fname in sorted(fnames):
                 if has_file_allowed_extension(fname, extensions):
-                    path = os.path.join(root, fname)
-                    images.append((path, class_to_idx[target]))
-                    # get locations
-                    locs = det_df.loc[int(fname.split('.')[0]), 'locations']
-                    if type(locs) == str:
-                        locs = [int(ele) for ele in locs.split("_")]
-                        locs = np.array([(locs[i+1], locs[i]) for i in range(0, len(locs)-1, 2)]).reshape(-1, 2)
-                    else:
-                        locs = []
-                    locations.append(locs)
+                    yield os.path.join(root, fname), target, fname
 
-    return [images, locations]
+
+def make_dataset(dir, class_to_idx, extensions, index=None, skiplist=None):
+    images = []
+    location_rows = []
+    if index is not None:
+        files = [(path, target, fname) for path, target, fname, _, _ in index.files(extensions)]
+    else:
+        files = walk_dataset(dir, extensions)
+    for path, target, fname in files:
+        if target not in class_to_idx or is_skipped(path, skiplist):
+            continue
+        images.append((path, class_to_idx[target]))
+        # images are named after their row in detections.csv
+        location_rows.append(int(fname.split('.')[0]))
+
+    return [images, np.array(location_rows, dtype=np.int64)]
 
 
 class DatasetFolder(data.Dataset):
@@ -73,13 +77,23 @@ class DatasetFolder(data.Dataset):
             E.g, ``transforms.RandomCrop`` for images.
         target_transform (callable, optional): A function/transform that takes
             in the target and transforms it.
+        detections_file (string): detections.csv with the seal locations of
+            every image, parsed once into a cache next to it.
+        index (DatasetIndex, optional): Persistent index of root to read the
+            file list from instead of walking the directory tree.
+        skiplist (set, optional): Absolute paths of images that failed
+            pre-flight validation, see utils/image_validation.py.
      Attributes:
         samples (list): List of (sample path, class_index) tuples
     """
 
-    def __init__(self, root, loader, extensions, shape_transform=None, int_transform=None, img_dim=450):
-        classes, class_to_idx = find_classes(root)
-        samples, locations = make_dataset(root, class_to_idx, extensions)
+    def __init__(self, root, loader, extensions, shape_transform=None, int_transform=None, img_dim=450, index=None,
+                 detections_file='./training_sets/training_set_vanilla/detections.csv', skiplist=None):
+        if index is not None:
+            classes, class_to_idx = index.find_classes()
+        else:
+            classes, class_to_idx = find_classes(root)
+        samples, location_rows = make_dataset(root, class_to_idx, extensions, index=index, skiplist=skiplist)
         if len(samples) == 0:
             raise(RuntimeError("Found 0 files in subfolders of: " + root + "\n"
                                "Supported extensions are: " + ",".join(extensions)))
@@ -92,7 +106,10 @@ class DatasetFolder(data.Dataset):
         self.img_dim = img_dim
 
         self.samples = samples
-        self.locations = locations
+        self.locations = DetectionLocations(detections_file)
+        self.location_rows = location_rows
+        if len(location_rows) and location_rows.max() >= len(self.locations):
+            raise Exception("{} has no detections row for some images in {}".format(detections_file, root))
 
         self.shape_transform = shape_transform
         self.int_transform = int_transform
@@ -106,20 +123,24 @@ class DatasetFolder(data.Dataset):
         """
 
         path, target = self.samples[index]
-        locs = self.locations[index]
+        locs = self.locations[int(self.location_rows[index])]
         sample = self.loader(path)
-        hit_value = 255
 
-        locations = np.zeros([self.img_dim, self.img_dim], dtype=np.uint8)
-        for ele in locs:
-            locations[ele[0], ele[1]] = hit_value
-        locations = Image.fromarray(locations)
+        if getattr(self.shape_transform, 'points', False):
+            # locations are transformed as coordinates, no mask needed
+            sample, locations = self.shape_transform(sample, locs)
+            count = np.float32(len(locations))
+        else:
+            hit_value = 255
 
-        sample = self.loader(path)
-        if self.shape_transform is not None:
-            sample, locations = self.shape_transform(sample, locations)
+            locations = np.zeros([self.img_dim, self.img_dim], dtype=np.uint8)
+            locations[locs[:, 0], locs[:, 1]] = hit_value
+            locations = Image.fromarray(locations)
 
-        count = np.float32(np.sum(np.not_equal(locations.numpy(), 0)))
+            if self.shape_transform is not None:
+                sample, locations = self.shape_transform(sample, locations)
+
+            count = np.float32(np.sum(np.not_equal(locations.numpy(), 0)))
 
         if self.int_transform is not None:
             sample = self.int_transform(sample)
@@ -143,28 +164,9 @@ class DatasetFolder(data.Dataset):
 IMG_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.ppm', '.bmp', '.pgm', '.tif']
 
 
-def pil_loader(path):
-    # open path as file to avoid ResourceWarning (https://github.com/python-pillow/Pillow/issues/835)
-    with open(path, 'rb') as f:
-        img = Image.open(f)
-        return img.convert('RGB')
-
-
-def accimage_loader(path):
-    import accimage
-    try:
-        return accimage.Image(path)
-    except IOError:
-        # Potentially a decoding problem, fall back to PIL.Image
-        return pil_loader(path)
-
-
 def default_loader(path):
-    from torchvision import get_image_backend
-    if get_image_backend() == 'accimage':
-        return accimage_loader(path)
-    else:
-        return pil_loader(path)
+    # follows torchvision's image backend, see utils/dataloaders/decoders.py for other decoders
+    return make_loader('default')(path)
 
 
 class ImageFolderTrainDet(DatasetFolder):
@@ -182,15 +184,25 @@ class ImageFolderTrainDet(DatasetFolder):
         target_transform (callable, optional): A function/transform that takes in the
             target and transforms it.
         loader (callable, optional): A function to load an image given its path.
+        index (DatasetIndex, optional): Persistent index of root, see
+            utils/dataloaders/dataset_index.py.
+        detections_file (string): detections.csv with the seal locations of
+            every image.
+        skiplist (set, optional): Absolute paths of images to leave out, see
+            utils/image_validation.py.
      Attributes:
         classes (list): List of the class names.
         class_to_idx (dict): Dict with items (class_name, class_index).
         imgs (list): List of (image path, class_index) tuples
     """
     def __init__(self, root, shape_transform=None, int_transform=None,
-                 loader=default_loader):
+                 loader=default_loader, index=None,
+                 detections_file='./training_sets/training_set_vanilla/detections.csv', skiplist=None):
         super(ImageFolderTrainDet, self).__init__(root, loader, IMG_EXTENSIONS,
                                                   shape_transform=shape_transform,
-                                                  int_transform=int_transform)
+                                                  int_transform=int_transform,
+                                                  index=index,
+                                                  detections_file=detections_file,
+                                                  skiplist=skiplist)
         self.imgs = self.samples
 
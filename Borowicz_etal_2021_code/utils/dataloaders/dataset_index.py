@@ -0,0 +1,218 @@
+# Persistent index of the files under ImageFolder style directories, so scripts do not os.walk large crawl
+# directories on every start
+#
+# The index is a SQLite file holding, for every indexed root:
+#   dirs   -- every directory below the root with its mtime and subdirectories
+#   files  -- every file with its class (first directory below the root), size and mtime
+#
+# refresh() stats every directory but only lists the ones whose mtime changed since the last refresh, since adding,
+# removing or renaming a file changes the mtime of its directory. Files rewritten in place keep their directory mtime,
+# refresh(full=True) re-lists and re-stats everything.
+
+import os
+import sqlite3
+import time
+
+import torch.utils.data as data
+
+from utils.dataloaders.decoders import make_loader
+from utils.image_validation import is_skipped
+
+# directories changed this close to a refresh may change again within the same mtime tick, so they are re-listed on
+# the next refresh
+_RACY_SECONDS = 2.0
+
+
+def _has_file_allowed_extension(filename, extensions):
+    filename_lower = filename.lower()
+    return any(filename_lower.endswith(ext) for ext in extensions)
+
+
+class DatasetIndex(object):
+    """
+    :param index_file: str -- SQLite file holding the index, created if missing
+    :param root: str -- ImageFolder style root directory, root/<class>/.../<image>
+    :param refresh: bool -- whether to bring the index up to date with the file system right away
+    """
+
+    def __init__(self, index_file, root, refresh=True):
+        index_dir = os.path.dirname(os.path.abspath(index_file))
+        if not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
+
+        self.index_file = index_file
+        self.root = os.path.expanduser(root)
+        self.conn = sqlite3.connect(index_file)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS dirs (root TEXT, path TEXT, mtime REAL, subdirs TEXT, '
+                          'PRIMARY KEY (root, path))')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS files (root TEXT, dir TEXT, name TEXT, class TEXT, '
+                          'size INTEGER, mtime REAL, PRIMARY KEY (root, dir, name))')
+        self.conn.commit()
+
+        if refresh:
+            self.refresh()
+
+    def refresh(self, full=False):
+        """
+        Brings the index up to date, listing only directories whose mtime changed unless full is set.
+
+        :param full: bool -- re-list every directory and re-stat every file
+        :return: int -- number of directories listed
+        """
+        known = {path: (mtime, subdirs.split('\n') if subdirs else [])
+                 for path, mtime, subdirs in self.conn.execute('SELECT path, mtime, subdirs FROM dirs WHERE root = ?',
+                                                               (self.root,))}
+        started = time.time()
+        seen = set()
+        listed = 0
+        stack = ['']
+        with self.conn:
+            while stack:
+                rel_dir = stack.pop()
+                abs_dir = os.path.join(self.root, rel_dir) if rel_dir else self.root
+                try:
+                    mtime = os.stat(abs_dir).st_mtime
+                except OSError:
+                    continue
+                seen.add(rel_dir)
+
+                if not full and rel_dir in known and known[rel_dir][0] == mtime:
+                    stack.extend(known[rel_dir][1])
+                    continue
+
+                subdirs = []
+                files = []
+                for entry in os.scandir(abs_dir):
+                    if entry.is_dir():
+                        # like os.walk, symlinked directories are only followed at the class level
+                        if not rel_dir or not entry.is_symlink():
+                            subdirs.append(os.path.join(rel_dir, entry.name) if rel_dir else entry.name)
+                    elif rel_dir:
+                        try:
+                            stat = entry.stat()
+                        except OSError:
+                            continue
+                        files.append((self.root, rel_dir, entry.name, rel_dir.split(os.sep)[0], stat.st_size,
+                                      stat.st_mtime))
+                listed += 1
+
+                if started - mtime < _RACY_SECONDS:
+                    mtime = -1.0
+                self.conn.execute('DELETE FROM files WHERE root = ? AND dir = ?', (self.root, rel_dir))
+                self.conn.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)', files)
+                self.conn.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?)',
+                                  (self.root, rel_dir, mtime, '\n'.join(subdirs)))
+                stack.extend(subdirs)
+
+            # drop directories that disappeared, together with their files
+            for rel_dir in set(known) - seen:
+                self.conn.execute('DELETE FROM dirs WHERE root = ? AND path = ?', (self.root, rel_dir))
+                self.conn.execute('DELETE FROM files WHERE root = ? AND dir = ?', (self.root, rel_dir))
+        return listed
+
+    def find_classes(self):
+        """
+        :return: tuple -- sorted class names and dict with items (class_name, class_index), as find_classes
+        """
+        row = self.conn.execute('SELECT subdirs FROM dirs WHERE root = ? AND path = ?', (self.root, '')).fetchone()
+        if row is None:
+            raise Exception("{} is not indexed, or does not exist".format(self.root))
+        classes = sorted(subdir for subdir in row[0].split('\n') if subdir)
+        class_to_idx = {classes[i]: i for i in range(len(classes))}
+        return classes, class_to_idx
+
+    def files(self, extensions):
+        """
+        :param extensions: list -- allowed file extensions
+        :return: list -- (path, class_name, file_name, size, mtime) tuples in the order make_dataset walks them
+        """
+        rows = self.conn.execute('SELECT class, dir, name, size, mtime FROM files WHERE root = ?', (self.root,))
+        rows = sorted(row for row in rows if _has_file_allowed_extension(row[2], extensions))
+        return [(os.path.join(self.root, rel_dir, name), target, name, size, mtime)
+                for target, rel_dir, name, size, mtime in rows]
+
+    def make_dataset(self, class_to_idx, extensions, exclude=None, skiplist=None):
+        """
+        Same output as make_dataset in data_loader_test.py, without walking the file system.
+
+        :return: list -- (path, class_index) tuples
+        """
+        images = []
+        for path, target, _, _, _ in self.files(extensions):
+            if target not in class_to_idx or (exclude is not None and path in exclude) or is_skipped(path, skiplist):
+                continue
+            images.append((path, class_to_idx[target]))
+        return images
+
+    def close(self):
+        self.conn.close()
+
+    def __getstate__(self):
+        # dataloader workers get the root only, the connection stays in the main process
+        state = self.__dict__.copy()
+        state['conn'] = None
+        return state
+
+
+class IndexedImageFolder(data.Dataset):
+    """
+    Drop-in replacement for torchvision's ImageFolder that reads its file list from a DatasetIndex.
+
+    Args:
+        index (DatasetIndex): Index of the root directory.
+        transform (callable, optional): A function/transform that takes in a PIL image and returns a transformed
+            version.
+        target_transform (callable, optional): A function/transform that takes in the target and transforms it.
+        loader (callable, optional): A function to load an image given its path.
+        skiplist (set, optional): Absolute paths of images to leave out, see utils/image_validation.py.
+     Attributes:
+        classes (list): List of the class names.
+        class_to_idx (dict): Dict with items (class_name, class_index).
+        imgs (list): List of (image path, class_index) tuples
+    """
+
+    extensions = ['.jpg', '.jpeg', '.png', '.ppm', '.bmp', '.pgm', '.tif', '.tiff', '.webp']
+
+    def __init__(self, index, transform=None, target_transform=None, loader=None, skiplist=None):
+        classes, class_to_idx = index.find_classes()
+        samples = index.make_dataset(class_to_idx, self.extensions, skiplist=skiplist)
+        if len(samples) == 0:
+            raise(RuntimeError("Found 0 files in subfolders of: " + index.root + "\n"
+                               "Supported extensions are: " + ",".join(self.extensions)))
+
+        self.root = index.root
+        self.loader = loader if loader is not None else make_loader('default')
+        self.classes = classes
+        self.class_to_idx = class_to_idx
+        self.samples = samples
+        self.imgs = samples
+        self.targets = [target for _, target in samples]
+
+        self.transform = transform
+        self.target_transform = target_transform
+
+    def __getitem__(self, index):
+        """
+        Args:
+            index (int): Index
+        Returns:
+            tuple: (sample, target) where target is class_index of the target class.
+        """
+        path, target = self.samples[index]
+        sample = self.loader(path)
+        if self.transform is not None:
+            sample = self.transform(sample)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        return sample, target
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __repr__(self):
+        fmt_str = 'Dataset ' + self.__class__.__name__ + '\n'
+        fmt_str += '    Number of datapoints: {}\n'.format(self.__len__())
+        fmt_str += '    Root Location: {}\n'.format(self.root)
+        tmp = '    Transforms (if any): '
+        fmt_str += '{0}{1}\n'.format(tmp, self.transform.__repr__().replace('\n', '\n' + ' ' * len(tmp)))
+        return fmt_str
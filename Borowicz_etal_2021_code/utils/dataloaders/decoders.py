@@ -0,0 +1,96 @@
+# Pluggable image decoders for the dataloaders, including reduced-resolution JPEG decoding
+#
+# Every decoder takes a path and an optional draft_size and returns an RGB image. With a draft_size, JPEGs may be
+# decoded at a reduced scale (1/2, 1/4 or 1/8, done in the DCT domain) as long as both sides of the result stay at
+# least draft_size pixels, which is much cheaper than decoding at full resolution and downscaling afterwards. Decoders
+# ignore draft_size for formats that cannot be decoded at reduced scale.
+
+import functools
+
+from PIL import Image
+
+_decoders = {}
+
+
+def register_decoder(name):
+    """
+    Decorator adding a decoder function f(path, draft_size=None) to the registry under name.
+    """
+    def register(decoder):
+        _decoders[name] = decoder
+        return decoder
+    return register
+
+
+def get_decoder(name):
+    if name not in _decoders:
+        raise Exception("Unknown decoder {}, available decoders: {}".format(name, sorted(_decoders)))
+    return _decoders[name]
+
+
+def available_decoders():
+    return sorted(_decoders)
+
+
+@register_decoder('pil')
+def pil_loader(path, draft_size=None):
+    # open path as file to avoid ResourceWarning (https://github.com/python-pillow/Pillow/issues/835)
+    with open(path, 'rb') as f:
+        img = Image.open(f)
+        if draft_size is not None and img.format == 'JPEG':
+            # picks the smallest DCT scale that keeps both sides at least draft_size
+            img.draft('RGB', (draft_size, draft_size))
+        return img.convert('RGB')
+
+
+@register_decoder('accimage')
+def accimage_loader(path, draft_size=None):
+    import accimage
+    try:
+        return accimage.Image(path)
+    except IOError:
+        # Potentially a decoding problem, fall back to PIL.Image
+        return pil_loader(path, draft_size=draft_size)
+
+
+_turbojpeg = []
+
+
+@register_decoder('turbojpeg')
+def turbojpeg_loader(path, draft_size=None):
+    # libjpeg-turbo through PyTurboJPEG, falls back to PIL for other formats
+    if not _turbojpeg:
+        from turbojpeg import TurboJPEG, TJPF_RGB
+        _turbojpeg.extend([TurboJPEG(), TJPF_RGB])
+    jpeg, pixel_format = _turbojpeg
+
+    with open(path, 'rb') as f:
+        buf = f.read()
+    if buf[:2] != b'\xff\xd8':
+        return pil_loader(path, draft_size=draft_size)
+
+    scaling_factor = None
+    if draft_size is not None:
+        width, height = jpeg.decode_header(buf)[:2]
+        # smallest supported scale that keeps both sides at least draft_size
+        for num, den in sorted(jpeg.scaling_factors, key=lambda ele: ele[0] / float(ele[1])):
+            if num <= den and min(width, height) * num >= draft_size * den:
+                scaling_factor = (num, den)
+                break
+    try:
+        return Image.fromarray(jpeg.decode(buf, pixel_format=pixel_format, scaling_factor=scaling_factor))
+    except (IOError, OSError):
+        # Potentially a decoding problem, fall back to PIL.Image
+        return pil_loader(path, draft_size=draft_size)
+
+
+def make_loader(name='default', draft_size=None):
+    """
+    :param name: str -- registered decoder, or 'default' to follow torchvision's image backend
+    :param draft_size: int, optional -- smallest side length the decoded image needs, None decodes at full resolution
+    :return: callable -- picklable loader taking a path, for use in dataloader workers
+    """
+    if name == 'default':
+        from torchvision import get_image_backend
+        name = 'accimage' if get_image_backend() == 'accimage' else 'pil'
+    return functools.partial(get_decoder(name), draft_size=draft_size)
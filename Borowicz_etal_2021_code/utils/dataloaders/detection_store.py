@@ -0,0 +1,104 @@
+# Seal locations from a detections.csv, parsed once into a ragged int16 array store cached next to the csv
+#
+# detections.csv has one row per training image, the row number being the image file name, and a 'locations' column
+# of underscore separated x_y_x_y... pixel coordinates, empty for images without seals. The cache holds:
+#   <csv name>_offsets.npy  -- (n_rows + 1,) int64, locations of row i are coords[offsets[i]:offsets[i + 1]]
+#   <csv name>_coords.npy   -- (n_locations, 2) int16 (row, col) coordinates
+# both memory-mapped when read, so dataloader workers share them through the page cache.
+
+import os
+
+import numpy as np
+import pandas as pd
+
+
+def parse_locations(locs):
+    """
+    :param locs: str or float -- x_y_x_y... coordinates, NaN for images without detections
+    :return: np.array -- (N, 2) int16 (row, col) coordinates
+    """
+    if not isinstance(locs, str) or not locs:
+        return np.zeros([0, 2], dtype=np.int16)
+    xy = np.array(locs.split('_'), dtype=np.int64)
+    # an odd trailing value has no partner and is dropped
+    xy = xy[:len(xy) // 2 * 2].reshape(-1, 2)
+    if len(xy) and (xy.min() < np.iinfo(np.int16).min or xy.max() > np.iinfo(np.int16).max):
+        raise Exception("Detection coordinates do not fit into int16")
+    return xy[:, ::-1].astype(np.int16)
+
+
+def cache_paths(csv_file):
+    stem = os.path.splitext(csv_file)[0]
+    return stem + '_offsets.npy', stem + '_coords.npy'
+
+
+def build_detection_cache(csv_file):
+    """
+    Parses every row of csv_file and writes the offsets and coords arrays next to it, replacing stale ones atomically.
+
+    :param csv_file: str -- detections.csv with a 'locations' column
+    :return: tuple -- offsets and coords file names
+    """
+    det_df = pd.read_csv(csv_file)
+    if not isinstance(det_df.index, pd.RangeIndex):
+        raise Exception("Expected {} rows to be numbered by image file name".format(csv_file))
+
+    locations = [parse_locations(locs) for locs in det_df['locations']]
+    offsets = np.zeros(len(locations) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(ele) for ele in locations])
+    coords = np.concatenate(locations) if locations else np.zeros([0, 2], dtype=np.int16)
+
+    offsets_file, coords_file = cache_paths(csv_file)
+    for out_file, array in [(coords_file, coords), (offsets_file, offsets)]:
+        tmp_file = out_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp_file, out_file)
+    return offsets_file, coords_file
+
+
+class DetectionLocations(object):
+    """
+    Read-only ragged store of the seal locations in a detections.csv, built on first use and rebuilt when the csv is
+    newer than the cache.
+
+    :param csv_file: str -- detections.csv with a 'locations' column
+    """
+
+    def __init__(self, csv_file):
+        self.csv_file = csv_file
+        offsets_file, coords_file = cache_paths(csv_file)
+        csv_mtime = os.path.getmtime(csv_file)
+        if not all(os.path.isfile(ele) and os.path.getmtime(ele) >= csv_mtime for ele in [offsets_file, coords_file]):
+            build_detection_cache(csv_file)
+
+        # opened lazily, so every worker process maps the arrays itself
+        self._offsets = None
+        self._coords = None
+
+    def _open(self):
+        offsets_file, coords_file = cache_paths(self.csv_file)
+        self._offsets = np.load(offsets_file, mmap_mode='r')
+        self._coords = np.load(coords_file, mmap_mode='r')
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_offsets'] = None
+        state['_coords'] = None
+        return state
+
+    def __getitem__(self, row):
+        """
+        :param row: int -- detections.csv row, i.e. image file name
+        :return: np.array -- (N, 2) int16 (row, col) coordinates
+        """
+        if self._offsets is None:
+            self._open()
+        if not 0 <= row < len(self._offsets) - 1:
+            raise KeyError(row)
+        return np.asarray(self._coords[self._offsets[row]:self._offsets[row + 1]])
+
+    def __len__(self):
+        if self._offsets is None:
+            self._open()
+        return len(self._offsets) - 1
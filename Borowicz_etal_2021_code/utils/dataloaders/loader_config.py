@@ -0,0 +1,75 @@
+# DataLoader construction from the loader settings of a hyperparameter set in utils/model_library.py
+#
+#   pin_memory          -- page-locked batches for faster, asynchronous host to GPU copies, ignored without a GPU
+#   persistent_workers  -- keep worker processes alive between epochs instead of forking new ones every epoch
+#   prefetch_factor     -- batches loaded in advance by each worker
+#   uint8_transfer      -- workers hand over uint8 images, normalized in the main process
+#   worker_affinity     -- pin every worker to its own CPU core, with a single intra-op thread
+
+import functools
+import os
+
+import torch
+from torchvision import transforms
+
+from utils.dataloaders.transforms_batch import BatchNormalize
+
+# for hyperparameter sets that do not list every loader setting, those of a plain DataLoader
+LOADER_DEFAULTS = {'pin_memory': False, 'persistent_workers': False, 'prefetch_factor': 2, 'uint8_transfer': False,
+                   'worker_affinity': False}
+
+
+def loader_settings(hyperparameter_set):
+    """
+    :param hyperparameter_set: dict -- member of the hyperparameters dictionary
+    :return: dict -- loader settings, defaults filled in
+    """
+    return {key: hyperparameter_set.get(key, value) for key, value in LOADER_DEFAULTS.items()}
+
+
+def uint8_transfer(transform):
+    """
+    Moves the ToTensor and Normalize steps at the end of a Compose out of the workers.
+
+    :param transform: transforms.Compose -- per image transform ending in ToTensor and Normalize
+    :return: tuple -- worker transform ending in PILToTensor and the BatchNormalize to apply to collated batches, or the
+             unchanged transform and None if it does not end in ToTensor and Normalize
+    """
+    steps = transform.transforms
+    if len(steps) < 2 or not isinstance(steps[-2], transforms.ToTensor) or \
+            not isinstance(steps[-1], transforms.Normalize):
+        return transform, None
+    normalize = steps[-1]
+    return transforms.Compose(steps[:-2] + [transforms.PILToTensor()]), BatchNormalize(normalize.mean, normalize.std)
+
+
+def set_worker_affinity(worker_id, offset=0):
+    # one core per worker out of the cores this process may run on, so workers do not migrate or oversubscribe,
+    # starting at offset so the workers of different loaders get different cores
+    if hasattr(os, 'sched_setaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+        os.sched_setaffinity(0, {cores[(offset + worker_id) % len(cores)]})
+    torch.set_num_threads(1)
+
+
+def make_dataloader(dataset, batch_size, num_workers, settings, core_offset=0, **kwargs):
+    """
+    :param dataset: torch.utils.data.Dataset
+    :param batch_size: int -- number of images per batch
+    :param num_workers: int -- number of loading processes
+    :param settings: dict -- loader settings, see loader_settings
+    :param core_offset: int -- first core pinned with worker_affinity, pass the worker count of the loaders created
+                        before so loaders alive at the same time do not share cores
+    :param kwargs: other DataLoader arguments, e.g. sampler or collate_fn
+    :return: torch.utils.data.DataLoader
+    """
+    if kwargs.get('batch_sampler') is not None:
+        # batches come from the batch sampler, DataLoader rejects any other batch size
+        batch_size = 1
+    if num_workers > 0:
+        kwargs['persistent_workers'] = settings['persistent_workers']
+        kwargs['prefetch_factor'] = settings['prefetch_factor']
+        if settings['worker_affinity']:
+            kwargs['worker_init_fn'] = functools.partial(set_worker_affinity, offset=core_offset)
+    return torch.utils.data.DataLoader(dataset, batch_size=batch_size, num_workers=num_workers,
+                                       pin_memory=settings['pin_memory'] and torch.cuda.is_available(), **kwargs)
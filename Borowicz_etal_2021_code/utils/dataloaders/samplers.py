@@ -0,0 +1,138 @@
+# Class-balanced batch sampling for unbalanced training sets
+#
+# Every batch gets a fixed class mix, equal by default, and each class is drawn from a stream of back to back
+# permutations of its images, so no image repeats before every other image of its class was seen. The stream of a
+# class depends on the seed alone and every epoch continues where the previous one stopped: rare classes are cycled
+# through several times per epoch, common classes over several epochs.
+
+import numpy as np
+import torch.distributed as dist
+
+# permutations of a class stream are generated in blocks of about this many indices, so rare classes do not need a
+# random number generator per permutation
+_BLOCK_SIZE = 2 ** 16
+
+
+class StratifiedBatchSampler(object):
+    """
+    Batch sampler for DataLoader(batch_sampler=...), yielding lists of dataset indices.
+
+    :param targets: list -- class index of every image in the dataset
+    :param batch_size: int -- images per batch and replica
+    :param num_batches: int, optional -- batches per epoch and replica, by default one pass worth of images
+    :param class_weights: list, optional -- share of each class in every batch, equal for non-empty classes by default
+    :param num_replicas: int, optional -- number of processes training together, from torch.distributed by default
+    :param rank: int, optional -- rank of this process among them, from torch.distributed by default
+    :param seed: int -- random seed, must be the same on every replica
+    """
+
+    def __init__(self, targets, batch_size, num_batches=None, class_weights=None, num_replicas=None, rank=None,
+                 seed=0):
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+        if not 0 <= rank < num_replicas:
+            raise Exception("Invalid rank {} for {} replicas".format(rank, num_replicas))
+
+        self.targets = np.asarray(targets, dtype=np.int64)
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+        num_classes = len(class_weights) if class_weights is not None else int(self.targets.max()) + 1
+        # indices of every class, grouped with a single sort
+        order = np.argsort(self.targets, kind='stable')
+        class_sizes = np.bincount(self.targets, minlength=num_classes)
+        self.class_indices = np.split(order, np.cumsum(class_sizes)[:-1])
+
+        weights = np.ones(num_classes) if class_weights is None else np.asarray(class_weights, dtype=np.float64)
+        weights = np.where(class_sizes > 0, weights, 0)
+        if weights.sum() <= 0:
+            raise Exception("No images in classes with a positive weight")
+        self.class_weights = weights / weights.sum()
+
+        if num_batches is None:
+            num_batches = max(len(self.targets) // (batch_size * num_replicas), 1)
+        self.num_batches = num_batches
+
+    def set_epoch(self, epoch):
+        """
+        Reseeds the sampler, call before every epoch so each one draws different batches.
+        """
+        self.epoch = epoch
+
+    def state_dict(self):
+        """
+        :return: dict -- what determines the upcoming batches, for checkpoints
+        """
+        return {'seed': self.seed, 'epoch': self.epoch}
+
+    def load_state_dict(self, state):
+        self.seed = state['seed']
+        self.epoch = state['epoch']
+
+    def _class_counts(self, rng, total_batches):
+        # whole shares of every batch, the remaining slots go to classes picked with probability proportional to
+        # their fractional share (weighted sampling without replacement through u ** (1 / w) keys)
+        expected = self.batch_size * self.class_weights
+        counts = np.tile(np.floor(expected).astype(np.int64), (total_batches, 1))
+        remainder = self.batch_size - counts[0].sum()
+        if remainder > 0:
+            fraction = expected - np.floor(expected)
+            with np.errstate(divide='ignore'):
+                keys = rng.random_sample(counts.shape) ** (1.0 / fraction)
+            extra = np.argsort(-keys, axis=1)[:, :remainder]
+            np.add.at(counts, (np.repeat(np.arange(total_batches), remainder), extra.ravel()), 1)
+        return counts
+
+    def _class_stream(self, c, start, n_draws):
+        # draws start to start + n_draws of the stream of class c, its permutations come from generators seeded with
+        # the seed, class and block of permutations, so any part of the stream can be rebuilt
+        indices = self.class_indices[c]
+        n = len(indices)
+        first, last = start // n, (start + n_draws - 1) // n + 1
+        per_block = max(_BLOCK_SIZE // n, 1)
+        blocks = []
+        for block in range(first // per_block, (last - 1) // per_block + 1):
+            rng = np.random.RandomState([self.seed, c, block])
+            blocks.append(np.argsort(rng.random_sample((per_block, n)), axis=1))
+        permutations = np.concatenate(blocks)[first - (first // per_block) * per_block:][:last - first]
+        offset = start - first * n
+        return indices[permutations].ravel()[offset:offset + n_draws]
+
+    def _stream_starts(self, epoch, total_batches):
+        # draws of every class in the epochs before, where this epoch continues each class stream
+        starts = np.zeros(len(self.class_indices), dtype=np.int64)
+        for previous in range(epoch):
+            starts += self._class_counts(np.random.RandomState(self.seed + previous), total_batches).sum(axis=0)
+        return starts
+
+    def __iter__(self):
+        # every replica draws the same batches and keeps its own share, so batches stay stratified per replica
+        rng = np.random.RandomState(self.seed + self.epoch)
+        total_batches = self.num_batches * self.num_replicas
+        counts = self._class_counts(rng, total_batches)
+        starts = self._stream_starts(self.epoch, total_batches)
+
+        samples = []
+        batch_ids = []
+        for c in range(len(self.class_indices)):
+            n_draws = counts[:, c].sum()
+            if n_draws == 0:
+                continue
+            samples.append(self._class_stream(c, starts[c], n_draws))
+            batch_ids.append(np.repeat(np.arange(total_batches), counts[:, c]))
+        samples = np.concatenate(samples)
+        batch_ids = np.concatenate(batch_ids)
+
+        # group by batch, in random order within each batch
+        order = np.lexsort((rng.random_sample(len(samples)), batch_ids))
+        batches = samples[order].reshape(total_batches, self.batch_size)
+        for batch in batches[self.rank::self.num_replicas]:
+            yield batch.tolist()
+
+    def __len__(self):
+        return self.num_batches
@@ -0,0 +1,128 @@
+# Pre-decoded training images packed into fixed-size uint8 shards, read through np.memmap
+#
+# A packed split directory holds:
+#   meta.json          -- class names, image size and shard size
+#   index.npz          -- label, shard number and offset within the shard of every image
+#   paths.txt          -- source image path of every image
+#   shard_00000.npy    -- (n_images, size, size, 3) uint8 array, memory-mapped when read
+
+import json
+import os
+
+import numpy as np
+import torch
+import torch.utils.data as data
+from PIL import Image
+
+
+def center_crop_array(image, size):
+    """
+    Center crops an (H, W, 3) array to (size, size, 3), zero padding images that are smaller, with the same rounding
+    as torchvision's CenterCrop so packed images line up with the ones the transforms would have produced.
+    """
+    height, width = image.shape[:2]
+    out = np.zeros((size, size, 3), dtype=np.uint8)
+
+    def offsets(length):
+        if length >= size:
+            return int(round((length - size) / 2.0)), 0, size
+        return 0, (size - length) // 2, length
+
+    src_y, dst_y, h = offsets(height)
+    src_x, dst_x, w = offsets(width)
+    out[dst_y:dst_y + h, dst_x:dst_x + w] = image[src_y:src_y + h, src_x:src_x + w]
+    return out
+
+
+def packed_size(input_size, crop_scale=1.5):
+    """
+    Smallest packed image that still holds everything train_classifier.py's augmentation can see: a rotated
+    crop_scale * input_size center crop reaches sqrt(2) times further out than the unrotated one.
+
+    :param input_size: int -- model input size
+    :return: int -- side length of packed images
+    """
+    return int(np.ceil(input_size * crop_scale * np.sqrt(2)))
+
+
+class PackedImageFolder(data.Dataset):
+    """
+    Dataset over a split packed by pack_training_set.py. Workers share the decoded pixels through the OS page cache
+    instead of decoding JPEGs on every epoch.
+
+    Args:
+        root (string): Packed split directory, e.g. packed/training_set_13_MAY_18/training
+        transform (callable, optional): A function/transform that takes in a PIL image, or a (3, H, W) uint8 tensor
+            if to_pil is False, and returns a transformed version.
+        target_transform (callable, optional): A function/transform that takes in the target and transforms it.
+        to_pil (bool): Whether samples are handed to the transform as PIL images or as uint8 tensors.
+     Attributes:
+        classes (list): List of the class names.
+        class_to_idx (dict): Dict with items (class_name, class_index).
+        imgs (list): List of (source image path, class_index) tuples
+    """
+
+    def __init__(self, root, transform=None, target_transform=None, to_pil=True):
+        with open(os.path.join(root, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        index = np.load(os.path.join(root, 'index.npz'))
+        with open(os.path.join(root, 'paths.txt'), 'r') as f:
+            paths = f.read().splitlines()
+
+        self.root = root
+        self.classes = meta['classes']
+        self.class_to_idx = {self.classes[i]: i for i in range(len(self.classes))}
+        self.size = meta['size']
+        self.targets = index['labels']
+        self.shards = index['shards']
+        self.offsets = index['offsets']
+        self.imgs = list(zip(paths, self.targets.tolist()))
+        self.samples = self.imgs
+
+        self.transform = transform
+        self.target_transform = target_transform
+        self.to_pil = to_pil
+
+        # opened lazily, so every worker process maps the shards itself after fork
+        self._shards = {}
+
+    def _shard(self, shard):
+        if shard not in self._shards:
+            self._shards[shard] = np.load(os.path.join(self.root, 'shard_{:05d}.npy'.format(shard)), mmap_mode='r')
+        return self._shards[shard]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
+
+    def __getitem__(self, index):
+        """
+        Args:
+            index (int): Index
+        Returns:
+            tuple: (sample, target) where target is class_index of the target class.
+        """
+        pixels = self._shard(int(self.shards[index]))[int(self.offsets[index])]
+        if self.to_pil:
+            sample = Image.fromarray(np.asarray(pixels))
+        else:
+            sample = torch.from_numpy(np.ascontiguousarray(pixels.transpose(2, 0, 1)))
+        target = int(self.targets[index])
+
+        if self.transform is not None:
+            sample = self.transform(sample)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        return sample, target
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __repr__(self):
+        fmt_str = 'Dataset ' + self.__class__.__name__ + '\n'
+        fmt_str += '    Number of datapoints: {}\n'.format(self.__len__())
+        fmt_str += '    Root Location: {}\n'.format(self.root)
+        tmp = '    Transforms (if any): '
+        fmt_str += '{0}{1}\n'.format(tmp, self.transform.__repr__().replace('\n', '\n' + ' ' * len(tmp)))
+        return fmt_str
@@ -0,0 +1,54 @@
+# Memory-bounded cache of transformed samples for datasets with deterministic transforms, e.g. the center cropped
+# validation split, so every pass after the first one skips decoding
+#
+# Samples go into one preallocated shared memory tensor, so what a DataLoader worker caches is visible to the other
+# workers and to later epochs (workers are forked, or receive the shared storage when pickled).
+
+import torch
+import torch.utils.data as data
+
+
+class CachedDataset(data.Dataset):
+    """
+    Wraps a dataset returning (sample, target) tuples with same shaped sample tensors. The first samples, as many as
+    fit into max_mb, are cached the first time they are loaded, the rest are loaded from the wrapped dataset every time.
+
+    Args:
+        dataset (Dataset): Dataset whose transform gives the same output every time for a given index.
+        max_mb (float): Memory bound of the cache in megabytes.
+     Attributes:
+        capacity (int): Number of samples that fit into the cache.
+    """
+
+    def __init__(self, dataset, max_mb):
+        self.dataset = dataset
+        sample, _ = dataset[0]
+        if not torch.is_tensor(sample):
+            raise Exception("Only tensor samples can be cached, got {}".format(type(sample).__name__))
+        sample_bytes = sample.numel() * sample.element_size()
+        self.capacity = min(len(dataset), int(max_mb * 2 ** 20) // sample_bytes)
+
+        self.cached_samples = torch.empty((self.capacity,) + tuple(sample.shape), dtype=sample.dtype).share_memory_()
+        self.cached_targets = torch.zeros(self.capacity, dtype=torch.int64).share_memory_()
+        # set after the sample is written, so a worker never reads a half written sample
+        self.filled = torch.zeros(self.capacity, dtype=torch.uint8).share_memory_()
+
+    def __getitem__(self, index):
+        if index < self.capacity and self.filled[index]:
+            return self.cached_samples[index], int(self.cached_targets[index])
+
+        sample, target = self.dataset[index]
+        if index < self.capacity:
+            self.cached_samples[index] = sample
+            self.cached_targets[index] = target
+            self.filled[index] = 1
+        return sample, target
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getattr__(self, name):
+        # classes, imgs, samples etc. of the wrapped dataset
+        if name == 'dataset':
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
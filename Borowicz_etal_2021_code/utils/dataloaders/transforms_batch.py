@@ -0,0 +1,114 @@
+# Augmentation of whole collated uint8 batches as tensor ops, on the GPU if there is one
+#
+# train_classifier.py's per image PIL pipeline (flips, RandomRotation(180, expand=True), CenterCrop(1.5 * input_size),
+# RandomResizedCrop, ColorJitter, ToTensor, Normalize) becomes: workers only center crop to packed_size(input_size) and
+# hand over uint8 tensors, then BatchAugment folds flips, rotation and both crops into a single affine warp per image,
+# applied to the whole batch by one grid_sample, followed by batched jitter and normalization.
+
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class BatchNormalize(nn.Module):
+    """
+    Normalizes collated uint8 batches, the /255 of ToTensor and Normalize folded into one multiply-add, so workers can
+    hand over uint8 tensors a quarter the size of float ones.
+
+    :param mean: list -- per channel normalization mean
+    :param std: list -- per channel normalization standard deviation
+    """
+
+    def __init__(self, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)):
+        super(BatchNormalize, self).__init__()
+        std = torch.tensor(std, dtype=torch.float32).view(1, -1, 1, 1)
+        self.register_buffer('scale', 1.0 / (255.0 * std))
+        self.register_buffer('bias', -torch.tensor(mean, dtype=torch.float32).view(1, -1, 1, 1) / std)
+
+    def forward(self, batch):
+        return batch.float() * self.scale + self.bias
+
+
+class BatchAugment(nn.Module):
+    """
+    :param input_size: int -- model input size, side length of the output images
+    :param augment: bool -- apply random augmentation, otherwise only normalize
+    :param crop_scale: float -- side of the center crop the random resized crop is taken from, relative to input_size
+    :param scale: tuple -- range of the random resized crop's area, relative to the center crop
+    :param ratio: tuple -- range of the random resized crop's aspect ratio
+    :param brightness: float -- brightness jitter, factors are drawn from [1 - brightness, 1 + brightness]
+    :param contrast: float -- contrast jitter, factors are drawn from [1 - contrast, 1 + contrast]
+    :param mean: list -- per channel normalization mean
+    :param std: list -- per channel normalization standard deviation
+    """
+
+    def __init__(self, input_size, augment=True, crop_scale=1.5, scale=(0.8, 1), ratio=(0.95, 1.05), brightness=0,
+                 contrast=0, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)):
+        super(BatchAugment, self).__init__()
+        self.input_size = input_size
+        self.augment = augment
+        self.crop_size = int(input_size * crop_scale)
+        self.scale = scale
+        self.ratio = ratio
+        self.brightness = brightness
+        self.contrast = contrast
+        self.normalize = BatchNormalize(mean, std)
+
+    def _theta(self, batch_size, height, width, device):
+        """
+        Affine matrices mapping normalized output coordinates to normalized input coordinates.
+        """
+        uniform = lambda low, high: torch.empty(batch_size, device=device).uniform_(low, high)
+
+        # random resized crop inside the crop_size center crop of the rotated image, in pixels from its center
+        area = self.crop_size ** 2 * uniform(*self.scale)
+        log_ratio = uniform(math.log(self.ratio[0]), math.log(self.ratio[1]))
+        crop_w = torch.sqrt(area * torch.exp(log_ratio)).clamp(max=self.crop_size)
+        crop_h = torch.sqrt(area / torch.exp(log_ratio)).clamp(max=self.crop_size)
+        center_x = (torch.rand(batch_size, device=device) - 0.5) * (self.crop_size - crop_w)
+        center_y = (torch.rand(batch_size, device=device) - 0.5) * (self.crop_size - crop_h)
+
+        # rotation about the image center, counter-clockwise like PIL
+        angle = uniform(-math.pi, math.pi)
+        cos, sin = torch.cos(angle), torch.sin(angle)
+
+        # flips are applied before the rotation, i.e. last when mapping back to input coordinates
+        flip_x = torch.where(torch.rand(batch_size, device=device) < 0.5, -1.0, 1.0)
+        flip_y = torch.where(torch.rand(batch_size, device=device) < 0.5, -1.0, 1.0)
+
+        # output (u, v) in [-1, 1] -> crop pixels (x, y) -> rotated back -> flipped -> normalized input coordinates
+        sx, sy = flip_x / (width / 2.0), flip_y / (height / 2.0)
+        theta = torch.stack([
+            torch.stack([sx * cos * crop_w / 2, sx * -sin * crop_h / 2, sx * (cos * center_x - sin * center_y)], 1),
+            torch.stack([sy * sin * crop_w / 2, sy * cos * crop_h / 2, sy * (sin * center_x + cos * center_y)], 1),
+        ], 1)
+        return theta
+
+    def _jitter(self, batch):
+        factor = lambda amount: torch.empty(batch.size(0), 1, 1, 1, device=batch.device).uniform_(1 - amount,
+                                                                                                   1 + amount)
+        if self.brightness > 0:
+            batch = (batch * factor(self.brightness)).clamp_(0, 255)
+        if self.contrast > 0:
+            gray = (0.299 * batch[:, 0] + 0.587 * batch[:, 1] + 0.114 * batch[:, 2]).mean(dim=(1, 2))
+            contrast = factor(self.contrast)
+            batch = (batch * contrast + (1 - contrast) * gray.view(-1, 1, 1, 1)).clamp_(0, 255)
+        return batch
+
+    def forward(self, batch):
+        """
+        :param batch: torch.Tensor -- (B, 3, H, W) uint8 images, center cropped to at least
+                      packed_size(input_size) when training
+        :return: torch.Tensor -- (B, 3, input_size, input_size) normalized float images
+        """
+        with torch.no_grad():
+            batch = batch.float()
+            if self.augment:
+                theta = self._theta(batch.size(0), batch.size(2), batch.size(3), batch.device)
+                grid = F.affine_grid(theta, [batch.size(0), 3, self.input_size, self.input_size], align_corners=False)
+                # zero padding matches the black corners of PIL's expanding rotation
+                batch = F.grid_sample(batch, grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+                batch = self._jitter(batch)
+            return self.normalize(batch)
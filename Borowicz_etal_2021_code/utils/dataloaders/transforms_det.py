@@ -1,48 +1,125 @@
 import torchvision.transforms.functional as TF
 from torchvision import transforms
 import numpy as np
+import math
+
+
+def rotate_points(points, angle, size):
+    """
+    Maps continuous (x, y) coordinates through the same expanding rotation PIL's Image.rotate applies to the image.
+
+    :param points: np.array -- (N, 2) float (x, y) coordinates, pixel centers at +0.5
+    :param angle: float -- counter-clockwise rotation in degrees
+    :param size: tuple -- (width, height) of the image before rotation
+    :return: tuple -- rotated (N, 2) coordinates and (width, height) of the expanded image
+    """
+    w, h = size
+    # inverse affine matrix from output to input coordinates, built exactly as in PIL
+    theta = -math.radians(angle % 360.0)
+    a, b, d, e = (round(math.cos(theta), 15), round(math.sin(theta), 15),
+                  round(-math.sin(theta), 15), round(math.cos(theta), 15))
+    c = a * -w / 2.0 + b * -h / 2.0 + w / 2.0
+    f = d * -w / 2.0 + e * -h / 2.0 + h / 2.0
+    corners = np.array([[0, 0], [w, 0], [w, h], [0, h]], dtype=np.float64)
+    xx = a * corners[:, 0] + b * corners[:, 1] + c
+    yy = d * corners[:, 0] + e * corners[:, 1] + f
+    nw = int(math.ceil(xx.max()) - math.floor(xx.min()))
+    nh = int(math.ceil(yy.max()) - math.floor(yy.min()))
+    c, f = a * -(nw - w) / 2.0 + b * -(nh - h) / 2.0 + c, d * -(nw - w) / 2.0 + e * -(nh - h) / 2.0 + f
+
+    # invert [[a, b], [d, e]] to go from input to output coordinates
+    det = a * e - b * d
+    inverse = np.array([[e, -b], [-d, a]], dtype=np.float64) / det
+    return (points - [c, f]).dot(inverse.T), (nw, nh)
+
+
+def center_crop_offsets(size, output_size):
+    """
+    :param size: tuple -- (width, height) of the image
+    :param output_size: int -- side length of the crop
+    :return: tuple -- (x, y) shift torchvision's CenterCrop applies to coordinates, including padding of small images
+    """
+    offsets = []
+    for length in size:
+        pad = (output_size - length) // 2 if output_size > length else 0
+        length = max(length, output_size)
+        offsets.append(pad - int(round((length - output_size) / 2.0)))
+    return offsets
 
 
 class ShapeTransform(object):
     """
     Class to ensure image and locations get the same transformations during training
+
+    With points=True locations are an (N, 2) array of (row, col) pixel coordinates instead of a mask image. They go
+    through the same random flips, rotation and crops as the image analytically, so no mask is rasterized and no seal
+    is dropped or merged by nearest neighbour resampling. Locations that end up outside the crop are removed.
     """
-    def __init__(self, output_size, train):
+    def __init__(self, output_size, train, points=False):
         self.output_size = output_size
         self.train = train
+        self.points = points
 
     # random rotation
     def __call__(self, image, locations):
+        if self.points:
+            # continuous (x, y) coordinates of pixel centers
+            xy = np.asarray(locations, dtype=np.float64).reshape(-1, 2)[:, ::-1] + 0.5
+
         if self.train:
             #  left-right mirroring
             if np.random.random() > 0.5:
+                if self.points:
+                    xy[:, 0] = image.size[0] - xy[:, 0]
+                else:
+                    locations = TF.hflip(locations)
                 image = TF.hflip(image)
-                locations = TF.hflip(locations)
 
             #  left-right mirroring
             if np.random.random() > 0.5:
+                if self.points:
+                    xy[:, 1] = image.size[1] - xy[:, 1]
+                else:
+                    locations = TF.vflip(locations)
                 image = TF.vflip(image)
-                locations = TF.vflip(locations)
 
             # random rotation
             angle = np.random.uniform(-180, 180)
+            if self.points:
+                xy, _ = rotate_points(xy, angle, image.size)
+            else:
+                locations = TF.rotate(locations, angle, expand=True)
             image = TF.rotate(image, angle, expand=True)
-            locations = TF.rotate(locations, angle, expand=True)
 
             # center crop
             center_crop = transforms.CenterCrop(self.output_size * 1.5)
+            if self.points:
+                xy += center_crop_offsets(image.size, int(self.output_size * 1.5))
+            else:
+                locations = center_crop(locations)
             image = center_crop(image)
-            locations = center_crop(locations)
 
             # random crop
             i, j, h, w = transforms.RandomCrop.get_params(image, output_size=(self.output_size, self.output_size))
             image = TF.crop(image, i, j, h, w)
-            locations = TF.crop(locations, i, j, h, w)
+            if self.points:
+                xy -= [j, i]
+            else:
+                locations = TF.crop(locations, i, j, h, w)
 
         else:
             center_crop = transforms.CenterCrop(self.output_size)
+            if self.points:
+                xy += center_crop_offsets(image.size, self.output_size)
+            else:
+                locations = center_crop(locations)
             image = center_crop(image)
-            locations = center_crop(locations)
+
+        if self.points:
+            # back to (row, col) pixels, keeping the ones inside the crop
+            rows_cols = np.floor(xy[:, ::-1]).astype(np.int64)
+            inside = np.all((rows_cols >= 0) & (rows_cols < self.output_size), axis=1)
+            return image, rows_cols[inside]
 
         # change locations to tensor
         locations = TF.to_tensor(locations)
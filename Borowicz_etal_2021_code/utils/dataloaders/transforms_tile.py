@@ -0,0 +1,79 @@
+import math
+
+import torch
+import torch.nn.functional as F
+
+
+def tile_starts(length, tile_size, overlap):
+    """
+    Evenly spaced tile offsets along one image axis, the first tile flush with the start and the last with the end.
+
+    :param length: int -- image length along the axis
+    :param tile_size: int -- tile side length
+    :param overlap: float -- minimum fraction of a tile shared with its neighbour
+    :return: list of int -- tile offsets
+    """
+    if length <= tile_size:
+        return [0]
+    stride = max(1, int(tile_size * (1 - overlap)))
+    n_tiles = int(math.ceil((length - tile_size) / float(stride))) + 1
+    return [int(round(i * (length - tile_size) / float(n_tiles - 1))) for i in range(n_tiles)]
+
+
+class TileTransform(object):
+    """
+    Cuts a decoded (C, H, W) image tensor into overlapping square tiles, so the whole image is classified instead of
+    a single center crop. Images smaller than a tile are zero padded on the bottom/right.
+
+    :param tile_size: int -- tile side length, the model input size
+    :param overlap: float -- minimum fraction of a tile shared with its neighbour
+    """
+    def __init__(self, tile_size, overlap=0.25):
+        self.tile_size = tile_size
+        self.overlap = overlap
+
+    def __call__(self, image):
+        _, height, width = image.shape
+        pad_h = max(0, self.tile_size - height)
+        pad_w = max(0, self.tile_size - width)
+        if pad_h or pad_w:
+            image = F.pad(image, (0, pad_w, 0, pad_h))
+
+        ys = tile_starts(image.shape[1], self.tile_size, self.overlap)
+        xs = tile_starts(image.shape[2], self.tile_size, self.overlap)
+        return torch.stack([image[:, y:y + self.tile_size, x:x + self.tile_size] for y in ys for x in xs])
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(tile_size={0}, overlap={1})'.format(self.tile_size, self.overlap)
+
+
+def collate_tiles(batch):
+    """
+    Collates (tiles, target, path) samples from a dataset using TileTransform into one big batch of tiles.
+
+    :param batch: list of (tiles, target, path) tuples, tiles being (n_tiles, C, H, W)
+    :return: tuple -- (all tiles, targets, paths, number of tiles per image)
+    """
+    tiles, targets, paths = zip(*batch)
+    tile_counts = torch.LongTensor([len(ele) for ele in tiles])
+    return torch.cat(tiles), torch.LongTensor(targets), list(paths), tile_counts
+
+
+def reduce_tiles(tile_probs, tile_counts, reduction='max'):
+    """
+    Combines per-tile class probabilities into one probability vector per image.
+
+    :param tile_probs: torch.Tensor -- (total_tiles, n_classes) softmax probabilities
+    :param tile_counts: torch.LongTensor -- number of consecutive tiles belonging to each image
+    :param reduction: str -- 'mean' averages tiles, 'max' keeps the highest probability of each class across tiles, so
+                      an animal seen in a single tile is not averaged away
+    :return: torch.Tensor -- (n_images, n_classes) probabilities, normalized to sum to one
+    """
+    per_image = torch.split(tile_probs, tile_counts.tolist())
+    if reduction == 'mean':
+        probs = torch.stack([ele.mean(0) for ele in per_image])
+    elif reduction == 'max':
+        probs = torch.stack([ele.max(0)[0] for ele in per_image])
+    else:
+        raise Exception("Unsupported tile reduction {}".format(reduction))
+    return probs / probs.sum(1, keepdim=True)
@@ -0,0 +1,121 @@
+# Helpers for data-parallel training with torch.distributed
+#
+# Processes are configured through the environment variables torchrun sets (RANK, WORLD_SIZE, LOCAL_RANK,
+# LOCAL_WORLD_SIZE, MASTER_ADDR, MASTER_PORT), so a script runs the same whether it was started by torchrun on several
+# nodes or by launch_local on a single one:
+#
+#   torchrun --nnodes 2 --node_rank 0 --nproc_per_node 8 --master_addr node0 --master_port 29500 train_classifier.py ...
+#   python train_classifier.py --nprocs 8 ...
+
+import os
+import subprocess
+import sys
+import time
+
+import torch
+import torch.distributed as dist
+
+
+def distributed_env():
+    """
+    :return: tuple -- (world_size, rank, local_rank, local_world_size) of this process, (1, 0, 0, 1) if it was not
+             started as part of a distributed job
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    rank = int(os.environ.get('RANK', 0))
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', world_size))
+    return world_size, rank, local_rank, local_world_size
+
+
+def launch_local(nprocs, master_port=29500):
+    """
+    Starts nprocs copies of the running script on this machine, one per rank, and waits for them.
+
+    :param nprocs: int -- number of processes
+    :param master_port: int -- free port rank 0 listens on for the process group rendezvous
+    :return: int -- 0 if every process succeeded, else the first non-zero exit code
+    """
+    processes = []
+    for rank in range(nprocs):
+        env = dict(os.environ, WORLD_SIZE=str(nprocs), RANK=str(rank), LOCAL_RANK=str(rank),
+                   LOCAL_WORLD_SIZE=str(nprocs), MASTER_ADDR='127.0.0.1', MASTER_PORT=str(master_port))
+        processes.append(subprocess.Popen([sys.executable] + sys.argv, env=env))
+
+    exit_code = 0
+    running = list(processes)
+    while running:
+        time.sleep(1)
+        for process in list(running):
+            code = process.poll()
+            if code is None:
+                continue
+            running.remove(process)
+            if code != 0 and exit_code == 0:
+                exit_code = code
+                # the remaining ranks would block forever in their next collective
+                for other in running:
+                    other.terminate()
+    return exit_code
+
+
+def init_distributed(backend='gloo'):
+    """
+    Joins the process group described by the environment, and splits the cores of the node between its processes.
+
+    :param backend: str -- torch.distributed backend, gloo runs on CPUs
+    :return: tuple -- (world_size, rank, local_rank, local_world_size), see distributed_env
+    """
+    world_size, rank, local_rank, local_world_size = distributed_env()
+    if world_size > 1 and not dist.is_initialized():
+        dist.init_process_group(backend=backend, init_method='env://', world_size=world_size, rank=rank)
+        # otherwise every process starts one intra-op thread per core
+        cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+        torch.set_num_threads(max(cores // local_world_size, 1))
+    return world_size, rank, local_rank, local_world_size
+
+
+def all_reduce_sum(values):
+    """
+    :param values: list -- numbers to add up over all processes
+    :return: list -- sums as floats, the values themselves outside a distributed job
+    """
+    if not dist.is_initialized():
+        return [float(value) for value in values]
+    totals = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(totals, op=dist.ReduceOp.SUM)
+    return totals.tolist()
+
+
+def broadcast_values(values):
+    """
+    :param values: list -- picklable objects, only the ones of rank 0 are used
+    :return: list -- values of rank 0
+    """
+    if not dist.is_initialized():
+        return values
+    values = list(values)
+    dist.broadcast_object_list(values, src=0)
+    return values
+
+
+def gather_values(value):
+    """
+    :param value: picklable object of this process
+    :return: list -- values of every process, by rank
+    """
+    if not dist.is_initialized():
+        return [value]
+    values = [None] * dist.get_world_size()
+    dist.all_gather_object(values, value)
+    return values
+
+
+def cleanup_distributed():
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
+
+def barrier():
+    if dist.is_initialized():
+        dist.barrier()
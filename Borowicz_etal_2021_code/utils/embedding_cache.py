@@ -0,0 +1,116 @@
+# Penultimate layer embeddings of frozen pretrained backbones, cached on disk for head-only training
+#
+# For every image the cache holds one row per augmented view, float16 embeddings in a memory-mapped .npy file with
+# the class indices in a second one:
+#   <cache_dir>/<name>_embeddings.npy  -- (n_views * n_images, embedding size), view after view
+#   <cache_dir>/<name>_targets.npy     -- (n_views * n_images,) class indices
+
+import os
+
+import numpy as np
+import torch
+
+# module holding the final linear layer of each architecture, Squeezenet11 classifies with a convolution instead
+HEAD_MODULES = {'Resnet18': 'fc', 'Resnet34': 'fc', 'Resnet50': 'fc', 'Densenet121': 'classifier',
+                'Densenet169': 'classifier', 'Alexnet': 'classifier.6', 'VGG16': 'classifier.6'}
+
+
+def _parent_module(model, model_architecture):
+    if model_architecture not in HEAD_MODULES:
+        raise Exception("Head-only training is not supported for {}".format(model_architecture))
+    path = HEAD_MODULES[model_architecture].split('.')
+    parent = model
+    for name in path[:-1]:
+        parent = parent._modules[name]
+    return parent, path[-1]
+
+
+def get_head(model, model_architecture):
+    """
+    :param model: torch.nn.Module -- model instance of model_architecture
+    :param model_architecture: str -- model architecture, member of HEAD_MODULES
+    :return: torch.nn.Linear -- final layer of the model
+    """
+    parent, name = _parent_module(model, model_architecture)
+    return parent._modules[name]
+
+
+def set_head(model, model_architecture, head):
+    """
+    Replaces the final layer of a model, nn.Identity() turns the model into an embedding backbone.
+
+    :param model: torch.nn.Module -- model instance of model_architecture
+    :param model_architecture: str -- model architecture, member of HEAD_MODULES
+    :param head: torch.nn.Module -- new final layer
+    """
+    parent, name = _parent_module(model, model_architecture)
+    parent._modules[name] = head
+
+
+def cache_paths(cache_dir, name):
+    """
+    :return: tuple -- paths of the embeddings and targets files of the cache called name
+    """
+    return (os.path.join(cache_dir, '{}_embeddings.npy'.format(name)),
+            os.path.join(cache_dir, '{}_targets.npy'.format(name)))
+
+
+def load_embeddings(cache_dir, name):
+    """
+    :return: tuple -- memory-mapped embeddings and targets, None if the cache does not exist yet
+    """
+    embeddings_file, targets_file = cache_paths(cache_dir, name)
+    if not os.path.exists(embeddings_file) or not os.path.exists(targets_file):
+        return None
+    return np.load(embeddings_file, mmap_mode='r'), np.load(targets_file)
+
+
+def build_embeddings(backbone, make_loader, n_images, n_views, cache_dir, name, normalize=None, use_gpu=False):
+    """
+    Runs the backbone over n_views passes of a dataset and writes the embeddings cache, replacing the files only
+    once every row was written.
+
+    :param backbone: torch.nn.Module -- model with its head replaced by nn.Identity()
+    :param make_loader: function -- returns the DataLoader for a given view, in dataset order
+    :param n_images: int -- number of images in the dataset
+    :param n_views: int -- number of passes over the dataset
+    :param cache_dir: str -- directory holding the caches, created if missing
+    :param name: str -- name of the cache
+    :param normalize: callable, optional -- applied to every batch after the device copy
+    :param use_gpu: bool -- whether the backbone is on the GPU
+    :return: tuple -- memory-mapped embeddings and targets
+    """
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    embeddings_file, targets_file = cache_paths(cache_dir, name)
+    if os.path.exists(targets_file):
+        os.remove(targets_file)
+
+    backbone.train(False)
+    embeddings = None
+    targets = np.empty(n_views * n_images, dtype=np.int64)
+    row = 0
+    with torch.no_grad():
+        for view in range(n_views):
+            for inputs, labels in make_loader(view):
+                if use_gpu:
+                    inputs = inputs.cuda(non_blocking=True)
+                if normalize is not None:
+                    inputs = normalize(inputs)
+                outputs = backbone(inputs).cpu().numpy()
+                if embeddings is None:
+                    embeddings = np.lib.format.open_memmap(embeddings_file + '.tmp', mode='w+', dtype=np.float16,
+                                                           shape=(n_views * n_images, outputs.shape[1]))
+                embeddings[row:row + len(outputs)] = outputs
+                targets[row:row + len(outputs)] = labels.numpy()
+                row += len(outputs)
+
+    if row != n_views * n_images:
+        raise Exception("Expected {} embeddings, got {}".format(n_views * n_images, row))
+    embeddings.flush()
+    del embeddings
+    # the targets file last, load_embeddings only sees complete caches
+    os.replace(embeddings_file + '.tmp', embeddings_file)
+    np.save(targets_file + '.tmp.npy', targets)
+    os.replace(targets_file + '.tmp.npy', targets_file)
+    return load_embeddings(cache_dir, name)
@@ -0,0 +1,41 @@
+# Combines several trained checkpoints into a single model that shares one decoded and normalized input batch
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class Ensemble(nn.Module):
+    """
+    Runs every member model on the same input batch and combines their outputs with a weighted average.
+
+    :param members: list of torch.nn.Module -- trained models with the same input size and classes
+    :param weights: list of float, optional -- weight of each member, equal weights by default
+    :param combine: str -- 'probs' averages softmax probabilities, 'logits' averages raw logits. Either way the output
+                    is a logit tensor, so a softmax over it gives the combined class probabilities
+    """
+
+    def __init__(self, members, weights=None, combine='probs'):
+        super(Ensemble, self).__init__()
+        if weights is None:
+            weights = [1.] * len(members)
+        if len(weights) != len(members):
+            raise Exception("Got {} ensemble weights for {} models".format(len(weights), len(members)))
+        if combine not in ['probs', 'logits']:
+            raise Exception("Unsupported ensemble combination {}".format(combine))
+
+        self.members = nn.ModuleList(members)
+        weights = torch.Tensor(weights)
+        self.register_buffer('weights', weights / weights.sum())
+        self.combine = combine
+
+    def forward(self, inputs):
+        outputs = torch.stack([member(inputs) for member in self.members])
+        # members may sit on another device than the wrapper, e.g. loaded to the GPU by load_model
+        weights = self.weights.to(outputs.device).view(-1, 1, 1)
+        if self.combine == 'logits':
+            return (outputs * weights).sum(0)
+
+        # the log of the averaged probabilities softmaxes back to the averaged probabilities
+        probs = (F.softmax(outputs, dim=2) * weights).sum(0)
+        return torch.log(probs.clamp(min=1e-12))
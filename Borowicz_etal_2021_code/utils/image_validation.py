@@ -0,0 +1,152 @@
+# Pre-flight validation of images: every file is verified and fully decoded once in a process pool, failures are
+# recorded in a skiplist the dataloaders leave out and can be moved to a quarantine directory
+#
+# The skiplist is a text file with one tab separated absolute path and failure reason per line, appended to and
+# fsynced as failures come in.
+
+import os
+import shutil
+from multiprocessing import Pool
+
+from PIL import Image, ImageFile
+
+
+def _strict_decoding():
+    # the scripts tolerate truncated images, the validation pass must not
+    ImageFile.LOAD_TRUNCATED_IMAGES = False
+
+
+def check_image(path):
+    """
+    :param path: str -- image file
+    :return: str -- reason the image is unusable, None if it decodes cleanly
+    """
+    try:
+        with open(path, 'rb') as f:
+            Image.open(f).verify()
+        # verify() leaves the image unusable and does not decode pixel data, so open it again and decode it fully
+        with open(path, 'rb') as f:
+            image = Image.open(f)
+            image.load()
+            if image.size[0] == 0 or image.size[1] == 0:
+                return 'empty image'
+    except Exception as e:
+        return '{}: {}'.format(type(e).__name__, e)
+    return None
+
+
+def _check(args):
+    check, path = args
+    return path, check(path)
+
+
+def validate_images(paths, num_workers=8, check=check_image, chunksize=16):
+    """
+    :param paths: list -- image files
+    :param num_workers: int -- number of validation processes
+    :param check: callable -- top level function taking a path and returning a failure reason or None
+    :param chunksize: int -- paths handed to a process at a time
+    :return: generator -- (path, reason) for every failed image, in completion order
+    """
+    pool = Pool(num_workers, initializer=_strict_decoding)
+    try:
+        for path, reason in pool.imap_unordered(_check, [(check, path) for path in paths], chunksize=chunksize):
+            if reason is not None:
+                yield path, reason
+    finally:
+        pool.close()
+        pool.join()
+
+
+def load_skiplist(skiplist_file):
+    """
+    :param skiplist_file: str -- skiplist written by Skiplist, may be None or not exist yet
+    :return: set -- absolute paths of images to leave out
+    """
+    if skiplist_file is None or not os.path.isfile(skiplist_file):
+        return set()
+    with open(skiplist_file, 'r') as f:
+        return set(line.split('\t', 1)[0] for line in f.read().splitlines() if line)
+
+
+def is_skipped(path, skiplist):
+    """
+    :param path: str -- image path as found by a dataloader, relative or absolute
+    :param skiplist: set -- absolute paths from load_skiplist, may be None
+    :return: bool -- whether the image should be left out
+    """
+    return bool(skiplist) and os.path.abspath(path) in skiplist
+
+
+class SkiplistFilter(object):
+    """
+    Picklable is_valid_file for torchvision's ImageFolder, keeping allowed extensions that are not skiplisted.
+
+    :param skiplist: set -- absolute paths from load_skiplist
+    :param extensions: list -- allowed file extensions
+    """
+
+    def __init__(self, skiplist, extensions):
+        self.skiplist = skiplist
+        self.extensions = tuple(extensions)
+
+    def __call__(self, path):
+        return path.lower().endswith(self.extensions) and not is_skipped(path, self.skiplist)
+
+
+class Skiplist(object):
+    """
+    Append-only skiplist, see load_skiplist for reading it.
+
+    :param skiplist_file: str -- skiplist file, created with its directory if missing
+    """
+
+    def __init__(self, skiplist_file):
+        skiplist_dir = os.path.dirname(os.path.abspath(skiplist_file))
+        if not os.path.isdir(skiplist_dir):
+            os.makedirs(skiplist_dir)
+        self.paths = load_skiplist(skiplist_file)
+        self.f = open(skiplist_file, 'a')
+
+    def add(self, path, reason):
+        path = os.path.abspath(path)
+        if path in self.paths:
+            return
+        # reasons are single line, tabs would break the format
+        self.f.write('{}\t{}\n'.format(path, ' '.join(str(reason).split())))
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.paths.add(path)
+
+    def close(self):
+        self.f.close()
+
+
+def quarantine(path, root, quarantine_dir):
+    """
+    Moves path into quarantine_dir, keeping its location relative to root so files with the same name do not collide.
+
+    :return: str -- new location of the file
+    """
+    rel_path = os.path.relpath(os.path.abspath(path), os.path.abspath(root))
+    if rel_path.startswith(os.pardir):
+        rel_path = os.path.basename(path)
+    destination = os.path.join(quarantine_dir, rel_path)
+    if not os.path.isdir(os.path.dirname(destination)):
+        os.makedirs(os.path.dirname(destination))
+    shutil.move(path, destination)
+    return destination
+
+
+def list_files(root, extensions=None):
+    """
+    :param root: str -- directory to search recursively
+    :param extensions: list, optional -- allowed file extensions, every file if not given
+    :return: list -- files below root, sorted
+    """
+    extensions = tuple(extensions) if extensions is not None else None
+    paths = []
+    for path, _, files in sorted(os.walk(root)):
+        paths.extend(os.path.join(path, filename) for filename in sorted(files)
+                     if extensions is None or filename.lower().endswith(extensions))
+    return paths
@@ -0,0 +1,67 @@
+# Durable record of the images a prediction run has already finished, used to resume interrupted runs
+
+import os
+
+
+class CompletedManifest(object):
+    """
+    Append-only text file with one finished image path per line. The first line ties the manifest to the model that
+    produced the results, so a run is never resumed with a different model or architecture.
+
+    :param manifest_file: str -- path to manifest file
+    :param model_name: str -- name of the trained model
+    :param model_architecture: str -- model architecture, member of model_archs
+    :param resume: bool -- whether to continue an existing manifest instead of starting a new one
+    """
+
+    def __init__(self, manifest_file, model_name, model_architecture, resume=False):
+        self.manifest_file = manifest_file
+        self.header = '# model_name={} model_architecture={}'.format(model_name, model_architecture)
+        self.completed = set()
+
+        manifest_dir = os.path.dirname(manifest_file)
+        if manifest_dir and not os.path.isdir(manifest_dir):
+            os.makedirs(manifest_dir)
+
+        if resume and os.path.isfile(manifest_file):
+            with open(manifest_file, 'r') as f:
+                header = f.readline().rstrip('\n')
+                if header != self.header:
+                    raise Exception("Manifest {} was written by a different model ({})".format(manifest_file,
+                                                                                               header[2:]))
+                for line in f:
+                    line = line.rstrip('\n')
+                    if line:
+                        self.completed.add(line)
+            self._file = open(manifest_file, 'a')
+        else:
+            self._file = open(manifest_file, 'w')
+            self._file.write(self.header + '\n')
+            self._sync()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def __contains__(self, path):
+        return path in self.completed
+
+    def __len__(self):
+        return len(self.completed)
+
+    def add(self, paths):
+        """
+        Records finished images. Only call this once their results are on stable storage.
+
+        :param paths: iterable of str -- image paths
+        """
+        new_paths = [path for path in paths if path not in self.completed]
+        if not new_paths:
+            return
+        self._file.write(''.join(path + '\n' for path in new_paths))
+        self._sync()
+        self.completed.update(new_paths)
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
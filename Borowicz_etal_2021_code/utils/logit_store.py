@@ -0,0 +1,132 @@
+# Compact binary store of per-image class probabilities, so predictions can be re-thresholded without the model
+
+import csv
+import json
+import os
+
+import numpy as np
+
+
+class LogitStore(object):
+    """
+    Appends softmax probabilities and top-k classes for each image to flat binary files that can be memory-mapped
+    later with load_logit_store. The store directory holds:
+        meta.json  -- class names, probability dtype and k
+        probs.bin  -- (n_images, n_classes) probabilities
+        topk.bin   -- (n_images, k) int16 class indices, most likely first
+        index.csv  -- image path (and ground truth, if given) for each row
+
+    :param out_dir: str -- store directory, created if missing
+    :param class_names: list -- class names, in model output order
+    :param dtype: str -- 'float16' or 'float32', dtype of stored probabilities
+    :param top_k: int -- number of most likely classes stored per image
+    :param append: bool -- whether to continue an existing store instead of starting a new one
+    :param ground_truth: bool -- whether rows carry a ground truth label in index.csv
+    """
+
+    def __init__(self, out_dir, class_names, dtype='float16', top_k=3, append=False, ground_truth=False):
+        if dtype not in ['float16', 'float32']:
+            raise Exception("Unsupported probability dtype {}".format(dtype))
+
+        self.out_dir = out_dir
+        self.class_names = list(class_names)
+        self.dtype = np.dtype(dtype)
+        self.top_k = min(top_k, len(self.class_names))
+        self.columns = ['path', 'ground_truth'] if ground_truth else ['path']
+        self.paths = set()
+
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+
+        meta = {'class_names': self.class_names, 'dtype': dtype, 'top_k': self.top_k, 'columns': self.columns}
+        meta_file = os.path.join(out_dir, 'meta.json')
+        if append and os.path.isfile(meta_file):
+            with open(meta_file, 'r') as f:
+                if json.load(f) != meta:
+                    raise Exception("Logit store {} was written with different settings".format(out_dir))
+            self._truncate_partial_rows()
+            mode = 'a'
+        else:
+            with open(meta_file, 'w') as f:
+                json.dump(meta, f)
+            mode = 'w'
+
+        self._probs = open(os.path.join(out_dir, 'probs.bin'), mode + 'b')
+        self._topk = open(os.path.join(out_dir, 'topk.bin'), mode + 'b')
+        self._index = open(os.path.join(out_dir, 'index.csv'), mode, newline='')
+        self._index_writer = csv.writer(self._index)
+        if mode == 'w':
+            self._index_writer.writerow(self.columns)
+
+    def _truncate_partial_rows(self):
+        # an interrupted run can leave the three files with different numbers of rows, keep the rows all of them have
+        probs_file = os.path.join(self.out_dir, 'probs.bin')
+        topk_file = os.path.join(self.out_dir, 'topk.bin')
+        index_file = os.path.join(self.out_dir, 'index.csv')
+
+        with open(index_file, 'r', newline='') as f:
+            rows = list(csv.reader(f))[1:]
+        n_rows = min(os.path.getsize(probs_file) // (self.dtype.itemsize * len(self.class_names)),
+                     os.path.getsize(topk_file) // (2 * self.top_k), len(rows))
+
+        os.truncate(probs_file, n_rows * self.dtype.itemsize * len(self.class_names))
+        os.truncate(topk_file, n_rows * 2 * self.top_k)
+        with open(index_file, 'w', newline='') as f:
+            index_writer = csv.writer(f)
+            index_writer.writerow(self.columns)
+            index_writer.writerows(rows[:n_rows])
+        self.paths.update(row[0] for row in rows[:n_rows])
+
+    def write(self, paths, probs, ground_truth=None):
+        """
+        :param paths: list of str -- image paths
+        :param probs: np.ndarray -- (n_images, n_classes) softmax probabilities
+        :param ground_truth: list of str, optional -- true class name of each image
+        """
+        keep = [idx for idx, path in enumerate(paths) if path not in self.paths]
+        if not keep:
+            return
+        probs = np.asarray(probs, dtype=np.float32)[keep]
+        top_k = np.argsort(-probs, axis=1, kind='stable')[:, :self.top_k].astype(np.int16)
+
+        self._probs.write(probs.astype(self.dtype).tobytes())
+        self._topk.write(top_k.tobytes())
+        if ground_truth is None:
+            self._index_writer.writerows([paths[idx]] for idx in keep)
+        else:
+            self._index_writer.writerows([paths[idx], ground_truth[idx]] for idx in keep)
+        self.paths.update(paths[idx] for idx in keep)
+
+    def close(self):
+        for f in [self._probs, self._topk, self._index]:
+            if not f.closed:
+                f.flush()
+                os.fsync(f.fileno())
+                f.close()
+
+
+def load_logit_store(store_dir):
+    """
+    Memory-maps a store written by LogitStore, e.g. to re-threshold predictions with
+    probs[:, class_names.index('seal')] > 0.8
+
+    :param store_dir: str -- store directory
+    :return: dict -- {'class_names': list, 'index': list of index.csv rows, 'probs': np.memmap (n_images, n_classes),
+                      'topk': np.memmap (n_images, k)}
+    """
+    with open(os.path.join(store_dir, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    with open(os.path.join(store_dir, 'index.csv'), 'r', newline='') as f:
+        index = list(csv.DictReader(f))
+
+    n_rows = len(index)
+    n_classes = len(meta['class_names'])
+    if n_rows == 0:
+        # empty files cannot be memory-mapped
+        probs = np.zeros((0, n_classes), dtype=meta['dtype'])
+        topk = np.zeros((0, meta['top_k']), dtype=np.int16)
+    else:
+        probs = np.memmap(os.path.join(store_dir, 'probs.bin'), dtype=meta['dtype'], mode='r',
+                          shape=(n_rows, n_classes))
+        topk = np.memmap(os.path.join(store_dir, 'topk.bin'), dtype=np.int16, mode='r', shape=(n_rows, meta['top_k']))
+    return {'class_names': meta['class_names'], 'index': index, 'probs': probs, 'topk': topk}
@@ -0,0 +1,113 @@
+# Gathers single-image classification requests into micro-batches for a long-lived model
+
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+class MicroBatcher(object):
+    """
+    Runs a model on a background thread. Callers submit preprocessed image tensors one at a time and get a Future with
+    the predicted label and class probabilities. Pending requests are grouped into batches of at most max_batch_size
+    images, and no request waits more than max_latency_ms for its batch to fill up.
+
+    :param model: pyTorch model in evaluation mode
+    :param class_names: list -- class names, in model output order
+    :param max_batch_size: int -- maximum number of images per forward pass
+    :param max_latency_ms: float -- maximum time the first image of a batch waits for more images
+    :param use_gpu: bool -- whether batches are moved to the GPU
+    :param history: int -- number of recent batches kept for latency metrics
+    """
+
+    def __init__(self, model, class_names, max_batch_size=32, max_latency_ms=20, use_gpu=False, history=1000):
+        self.model = model
+        self.class_names = class_names
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000.
+        self.use_gpu = use_gpu
+
+        self.requests = queue.Queue()
+        self.batch_latencies = deque(maxlen=history)
+        self.batch_sizes = deque(maxlen=history)
+        self.n_batches = 0
+        self.n_images = 0
+        self.lock = threading.Lock()
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, image):
+        """
+        :param image: torch.Tensor -- normalized (C, H, W) image
+        :return: concurrent.futures.Future -- resolves to {'label': str, 'probs': {class name: probability}}
+        """
+        future = Future()
+        self.requests.put((image, future, time.time()))
+        return future
+
+    def queue_depth(self):
+        return self.requests.qsize()
+
+    def _next_batch(self):
+        # block until there is work, then keep gathering until the batch is full or the oldest request is due
+        batch = [self.requests.get()]
+        deadline = batch[0][2] + self.max_latency
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            images, futures, _ = zip(*batch)
+            since = time.time()
+            try:
+                inputs = torch.stack(images)
+                if self.use_gpu:
+                    inputs = inputs.cuda()
+                with torch.no_grad():
+                    probs = F.softmax(self.model(inputs), dim=1).cpu().numpy()
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+
+            for future, prob in zip(futures, probs):
+                future.set_result({'label': self.class_names[int(np.argmax(prob))],
+                                   'probs': dict(zip(self.class_names, prob.astype(float).tolist()))})
+
+            with self.lock:
+                self.batch_latencies.append(time.time() - since)
+                self.batch_sizes.append(len(batch))
+                self.n_batches += 1
+                self.n_images += len(batch)
+
+    def metrics(self):
+        """
+        :return: dict -- queue depth, totals and recent per-batch latency (ms) and size statistics
+        """
+        with self.lock:
+            latencies = np.array(self.batch_latencies) * 1000.
+            sizes = np.array(self.batch_sizes)
+            n_batches, n_images = self.n_batches, self.n_images
+
+        metrics = {'queue_depth': self.queue_depth(), 'batches': n_batches, 'images': n_images}
+        if len(latencies):
+            metrics.update({'batch_latency_ms_mean': float(latencies.mean()),
+                            'batch_latency_ms_p50': float(np.percentile(latencies, 50)),
+                            'batch_latency_ms_p95': float(np.percentile(latencies, 95)),
+                            'batch_size_mean': float(sizes.mean())})
+        return metrics
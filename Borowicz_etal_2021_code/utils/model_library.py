@@ -17,17 +17,28 @@ model_archs = {'Resnet18': {'input_size': 224},
 training_sets = {'training_set_13_MAY_18': {'num_classes': 9}}
 
 
-# hyperparameter sets
+# hyperparameter sets, including loader settings (see utils/dataloaders/loader_config.py). The loader settings are the
+# ones of a plain DataLoader, switch them on in a set to opt in to the faster input pipeline
 hyperparameters = {'A': {'learning_rate': 1E-3, 'batch_size_train': 64, 'batch_size_val': 8, 'batch_size_test': 64,
-                         'step_size': 1, 'gamma': 0.95, 'epochs': 5, 'num_workers_train': 8, 'num_workers_val': 1},
+                         'step_size': 1, 'gamma': 0.95, 'epochs': 5, 'num_workers_train': 8, 'num_workers_val': 1,
+                         'pin_memory': False, 'persistent_workers': False, 'prefetch_factor': 2,
+                         'uint8_transfer': False, 'worker_affinity': False},
                    'B': {'learning_rate': 1E-3, 'batch_size_train': 16, 'batch_size_val': 1, 'batch_size_test': 8,
-                         'step_size': 1, 'gamma': 0.95, 'epochs': 5, 'num_workers_train': 4, 'num_workers_val': 1},
+                         'step_size': 1, 'gamma': 0.95, 'epochs': 5, 'num_workers_train': 4, 'num_workers_val': 1,
+                         'pin_memory': False, 'persistent_workers': False, 'prefetch_factor': 2,
+                         'uint8_transfer': False, 'worker_affinity': False},
                    'C': {'learning_rate': 1E-3, 'batch_size_train': 64, 'batch_size_val': 8, 'batch_size_test': 64,
-                         'step_size': 1, 'gamma': 0.95, 'epochs': 30, 'num_workers_train': 16, 'num_workers_val': 8},
+                         'step_size': 1, 'gamma': 0.95, 'epochs': 30, 'num_workers_train': 16, 'num_workers_val': 8,
+                         'pin_memory': False, 'persistent_workers': False, 'prefetch_factor': 2,
+                         'uint8_transfer': False, 'worker_affinity': False},
                    'D': {'learning_rate': 1E-3, 'batch_size_train': 32, 'batch_size_val': 16, 'batch_size_test': 16,
-                         'step_size': 1, 'gamma': 0.95, 'epochs': 20, 'num_workers_train': 16, 'num_workers_val': 16},
+                         'step_size': 1, 'gamma': 0.95, 'epochs': 20, 'num_workers_train': 16, 'num_workers_val': 16,
+                         'pin_memory': False, 'persistent_workers': False, 'prefetch_factor': 2,
+                         'uint8_transfer': False, 'worker_affinity': False},
                    'E': {'learning_rate': 1E-3, 'batch_size_train': 16, 'batch_size_val': 1, 'batch_size_test': 8,
-                         'step_size': 1, 'gamma': 0.95, 'epochs': 2, 'num_workers_train': 8, 'num_workers_val': 1}
+                         'step_size': 1, 'gamma': 0.95, 'epochs': 2, 'num_workers_train': 8, 'num_workers_val': 1,
+                         'pin_memory': False, 'persistent_workers': False, 'prefetch_factor': 2,
+                         'uint8_transfer': False, 'worker_affinity': False}
                    }
 
 
@@ -0,0 +1,136 @@
+# Builds model instances for the architectures in model_library and loads trained weights into them
+
+import torch
+import torch.nn as nn
+from torchvision import models
+
+
+def build_model(model_architecture, num_classes):
+    """
+    :param model_architecture: str -- model architecture, member of model_archs
+    :param num_classes: int -- number of output classes
+    :return: torch.nn.Module -- untrained model instance
+    """
+    if model_architecture == "Resnet18":
+        return models.resnet18(num_classes=num_classes)
+
+    elif model_architecture == "Resnet34":
+        return models.resnet34(num_classes=num_classes)
+
+    elif model_architecture == "Resnet50":
+        return models.resnet50(num_classes=num_classes)
+
+    elif model_architecture == "Squeezenet11":
+        return models.squeezenet1_1(num_classes=num_classes)
+
+    elif model_architecture == "Densenet121":
+        return models.densenet121(num_classes=num_classes)
+
+    elif model_architecture == "Densenet169":
+        return models.densenet169(num_classes=num_classes)
+
+    elif model_architecture == "Alexnet":
+        return models.alexnet(num_classes=num_classes)
+
+    else:
+        return models.vgg16_bn(num_classes=num_classes)
+
+
+def get_partial_weights(model_dict, pretrained_dict):
+    """
+    :param model_dict: python dictionary for CNN features with empty weights {feature: weight}
+    :param pretrained_dict: python dictionary with CNN features and pretrained weights {feature: weight}
+    :return: python dictionary with the weights that can be loaded to model_dict and empty weights for features that
+    cannot be loaded.
+    """
+    pretrained_features = {par: val for par, val in pretrained_dict.items() if val.size() ==
+                           model_dict[par].size()}
+
+    for key in model_dict:
+        if key not in pretrained_features:
+            pretrained_features[key] = model_dict[key]
+
+    return pretrained_features
+
+
+def build_pretrained_model(model_architecture, num_classes, pretrained=True):
+    """
+    :param model_architecture: str -- model architecture, member of model_archs
+    :param num_classes: int -- number of output classes
+    :param pretrained: bool -- whether to start from ImageNet weights, the final layer is always new
+    :return: torch.nn.Module -- model instance to train
+    """
+    if model_architecture == "Resnet18":
+        model_ft = models.resnet18(pretrained=pretrained)
+        num_ftrs = model_ft.fc.in_features
+        model_ft.fc = nn.Linear(num_ftrs, num_classes)
+
+    elif model_architecture == "Resnet34":
+        model_ft = models.resnet34(pretrained=pretrained)
+        num_ftrs = model_ft.fc.in_features
+        model_ft.fc = nn.Linear(num_ftrs, num_classes)
+
+    elif model_architecture == "Resnet50":
+        model_ft = models.resnet50(pretrained=pretrained)
+        num_ftrs = model_ft.fc.in_features
+        model_ft.fc = nn.Linear(num_ftrs, num_classes)
+
+    elif model_architecture == "Squeezenet11":
+        model_ft = models.squeezenet1_1(pretrained=False, num_classes=num_classes)
+        features = model_ft.state_dict()
+        pretrained_features = get_partial_weights(features, models.squeezenet1_1(pretrained=pretrained).state_dict())
+        model_ft.load_state_dict(pretrained_features)
+
+    elif model_architecture == "Densenet121":
+        model_ft = models.densenet121(pretrained=False, num_classes=num_classes)
+        features = model_ft.state_dict()
+        pretrained_features = get_partial_weights(features, models.densenet121(pretrained=pretrained).state_dict())
+        model_ft.load_state_dict(pretrained_features)
+
+    elif model_architecture == "Densenet169":
+        model_ft = models.densenet169(pretrained=False, num_classes=num_classes)
+        features = model_ft.state_dict()
+        pretrained_features = get_partial_weights(features, models.densenet169(pretrained=pretrained).state_dict())
+        model_ft.load_state_dict(pretrained_features)
+
+    elif model_architecture == "Alexnet":
+        model_ft = models.alexnet(pretrained=False, num_classes=num_classes)
+        features = model_ft.state_dict()
+        pretrained_features = get_partial_weights(features, models.alexnet(pretrained=pretrained).state_dict())
+        model_ft.load_state_dict(pretrained_features)
+
+    elif model_architecture == "VGG16":
+        model_ft = models.vgg16_bn(pretrained=False, num_classes=num_classes)
+        features = model_ft.state_dict()
+        pretrained_features = get_partial_weights(features, models.vgg16_bn(pretrained=pretrained).state_dict())
+        model_ft.load_state_dict(pretrained_features)
+
+    return model_ft
+
+
+def weights_path(model_name):
+    """
+    :param model_name: str -- name of the model given at training time
+    :return: str -- path to the weights saved by train_classifier.py
+    """
+    return "./saved_models/{}/{}.tar".format(model_name, model_name)
+
+
+def load_model(model_name, model_architecture, num_classes, use_gpu=False):
+    """
+    Creates a model instance, loads its trained weights and sets it to evaluation mode
+
+    :param model_name: str -- name of the model given at training time
+    :param model_architecture: str -- model architecture, member of model_archs
+    :param num_classes: int -- number of output classes
+    :param use_gpu: bool -- whether to move the model to the GPU
+    :return: torch.nn.Module -- trained model in evaluation mode
+    """
+    model = build_model(model_architecture, num_classes)
+    if use_gpu:
+        model.cuda()
+    model.eval()
+
+    # load saved model weights from train_classifier.py
+    model.load_state_dict(torch.load(weights_path(model_name), map_location='cuda' if use_gpu else 'cpu'))
+    return model
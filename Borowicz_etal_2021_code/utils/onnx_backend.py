@@ -0,0 +1,101 @@
+# ONNX export of trained classifiers and an onnxruntime execution backend for CPU inference
+
+import inspect
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+def onnx_path(model_name):
+    """
+    :param model_name: str -- name of the model given at training time
+    :return: str -- path to the exported ONNX model, next to the weights saved by train_classifier.py
+    """
+    return "./saved_models/{}/{}.onnx".format(model_name, model_name)
+
+
+def export_onnx(model, out_file, input_size=224, opset_version=13):
+    """
+    Exports a model with a dynamic batch dimension.
+
+    :param model: pyTorch model in evaluation mode, on the CPU
+    :param out_file: str -- path to .onnx file
+    :param input_size: int -- model input size
+    :param opset_version: int -- ONNX opset
+    """
+    kwargs = {}
+    # newer pyTorch defaults to the torch.export based exporter, which handles dynamic axes differently
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        kwargs['dynamo'] = False
+
+    with torch.no_grad():
+        torch.onnx.export(model, (torch.zeros(1, 3, input_size, input_size),), out_file, input_names=['input'],
+                          output_names=['logits'], dynamic_axes={'input': {0: 'batch'}, 'logits': {0: 'batch'}},
+                          opset_version=opset_version, **kwargs)
+
+
+class OnnxClassifier(nn.Module):
+    """
+    Runs an exported model with onnxruntime on the CPU. It takes and returns torch tensors, so it can replace the
+    pyTorch model in the prediction and validation loops.
+
+    :param model_file: str -- path to .onnx file
+    :param intra_op_threads: int -- threads used inside an operator, 0 lets onnxruntime decide
+    :param inter_op_threads: int -- threads used to run independent operators in parallel, 0 lets onnxruntime decide
+    """
+
+    def __init__(self, model_file, intra_op_threads=0, inter_op_threads=0):
+        super(OnnxClassifier, self).__init__()
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        if inter_op_threads > 1:
+            options.execution_mode = onnxruntime.ExecutionMode.ORT_PARALLEL
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        self.model_file = model_file
+        self.session = onnxruntime.InferenceSession(model_file, sess_options=options,
+                                                    providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def forward(self, inputs):
+        outputs = self.session.run(None, {self.input_name: inputs.detach().cpu().numpy().astype(np.float32)})
+        return torch.from_numpy(outputs[0])
+
+    def num_params(self):
+        """
+        :return: int -- number of weights stored in the ONNX graph
+        """
+        import onnx
+        from onnx import numpy_helper
+
+        graph = onnx.load(self.model_file).graph
+        return int(sum(numpy_helper.to_array(ele).size for ele in graph.initializer))
+
+
+def parity_check(model, onnx_model, dataloader, max_batches=None):
+    """
+    Compares pyTorch and onnxruntime logits on the same images.
+
+    :param model: pyTorch model in evaluation mode, on the CPU
+    :param onnx_model: OnnxClassifier -- the exported model
+    :param dataloader: torch.utils.data.DataLoader -- yields (inputs, labels) batches
+    :param max_batches: int, optional -- number of batches compared, all by default
+    :return: dict -- maximum absolute logit difference and fraction of images with the same predicted class
+    """
+    max_diff = 0.
+    agree = 0
+    n_images = 0
+    with torch.no_grad():
+        for batch_idx, (inputs, _) in enumerate(dataloader):
+            if max_batches is not None and batch_idx >= max_batches:
+                break
+            torch_logits = model(inputs)
+            onnx_logits = onnx_model(inputs)
+            max_diff = max(max_diff, (torch_logits - onnx_logits).abs().max().item())
+            agree += torch.sum(torch_logits.argmax(1) == onnx_logits.argmax(1)).item()
+            n_images += len(inputs)
+    return {'max_abs_diff': max_diff, 'argmax_agreement': agree / float(max(n_images, 1)), 'n_images': n_images}
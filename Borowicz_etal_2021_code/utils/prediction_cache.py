@@ -0,0 +1,132 @@
+# On-disk cache of predictions keyed by image content and model weights, shared across crawls
+
+import hashlib
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """
+    :param path: str -- path to file
+    :param chunk_size: int -- number of bytes read at a time
+    :return: str -- sha1 hex digest of the file contents
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_digests(paths, num_threads=8):
+    """
+    Hashes many files concurrently; hashing is I/O bound and hashlib releases the GIL.
+
+    :param paths: list of str -- paths to files
+    :param num_threads: int -- number of hashing threads
+    :return: list of str -- sha1 hex digests, in the same order as paths
+    """
+    with ThreadPoolExecutor(max_workers=max(1, num_threads)) as pool:
+        return list(pool.map(file_digest, paths))
+
+
+def model_fingerprint(weights_file):
+    """
+    :param weights_file: str -- path to saved model weights, e.g. saved_models/<name>/<name>.tar
+    :return: str -- fingerprint that changes whenever the weights change
+    """
+    return file_digest(weights_file)
+
+
+class PredictionCache(object):
+    """
+    SQLite-backed map from (image digest, model fingerprint) to predicted label and, optionally, the float32 softmax
+    probabilities behind it. Duplicate photos brought back by
+    different crawlers or search engines are classified once. When closed, the cache evicts the least recently used
+    predictions beyond max_entries.
+
+    :param cache_file: str -- path to SQLite database, created if missing
+    :param fingerprint: str -- fingerprint of the model weights, see model_fingerprint
+    :param max_entries: int -- maximum number of cached predictions, across all models
+    """
+
+    def __init__(self, cache_file, fingerprint, max_entries=1000000):
+        cache_dir = os.path.dirname(cache_file)
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        self.fingerprint = fingerprint
+        self.max_entries = max_entries
+        self.conn = sqlite3.connect(cache_file, timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS predictions (digest TEXT, model TEXT, label TEXT, '
+                          'last_used REAL, probs BLOB, PRIMARY KEY (digest, model))')
+        # caches created before probabilities were stored lack the probs column
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(predictions)')]
+        if 'probs' not in columns:
+            self.conn.execute('ALTER TABLE predictions ADD COLUMN probs BLOB')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used)')
+        self.conn.commit()
+
+    def lookup(self, digests, with_probs=False, chunk_size=500):
+        """
+        :param digests: iterable of str -- image digests
+        :param with_probs: bool -- whether to only return predictions that were cached with their probabilities
+        :return: dict -- {digest: (label, probs)} for the digests that are cached for this model, where probs is a
+                 float32 np.ndarray or None
+        """
+        digests = list(set(digests))
+        hits = {}
+        for i in range(0, len(digests), chunk_size):
+            chunk = digests[i:i + chunk_size]
+            query = 'SELECT digest, label, probs FROM predictions WHERE model = ? AND digest IN ({})'.format(
+                ','.join('?' * len(chunk)))
+            for digest, label, probs in self.conn.execute(query, [self.fingerprint] + chunk):
+                if probs is not None:
+                    probs = np.frombuffer(probs, dtype=np.float32)
+                elif with_probs:
+                    continue
+                hits[digest] = (label, probs)
+
+        # refresh hits so they are evicted last
+        now = time.time()
+        self.conn.executemany('UPDATE predictions SET last_used = ? WHERE digest = ? AND model = ?',
+                              [(now, digest, self.fingerprint) for digest in hits])
+        self.conn.commit()
+        return hits
+
+    def add(self, predictions):
+        """
+        :param predictions: iterable of (digest, label, probs) tuples, where probs is an array of class probabilities
+                            or None
+        """
+        now = time.time()
+        self.conn.executemany('INSERT OR REPLACE INTO predictions (digest, model, label, last_used, probs) '
+                              'VALUES (?, ?, ?, ?, ?)',
+                              [(digest, self.fingerprint, label, now,
+                                None if probs is None else np.asarray(probs, dtype=np.float32).tobytes())
+                               for digest, label, probs in predictions])
+        self.conn.commit()
+
+    def evict(self):
+        """
+        Drops the least recently used predictions until at most max_entries remain.
+
+        :return: int -- number of evicted predictions
+        """
+        count = self.conn.execute('SELECT COUNT(*) FROM predictions').fetchone()[0]
+        excess = count - self.max_entries
+        if excess <= 0:
+            return 0
+        self.conn.execute('DELETE FROM predictions WHERE rowid IN '
+                          '(SELECT rowid FROM predictions ORDER BY last_used LIMIT ?)', (excess,))
+        self.conn.commit()
+        return excess
+
+    def close(self):
+        self.evict()
+        self.conn.close()
@@ -0,0 +1,136 @@
+# Int8 quantized CPU inference for the architectures in model_library, cached next to the fp32 weights
+
+import json
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+from torchvision import datasets, transforms
+
+from utils.model_loader import load_model, weights_path
+from utils.prediction_cache import model_fingerprint
+
+
+def quantized_path(model_name, mode):
+    """
+    :param model_name: str -- name of the model given at training time
+    :param mode: str -- 'dynamic' or 'static'
+    :return: str -- path to the cached TorchScript int8 model, next to the fp32 weights
+    """
+    return "./saved_models/{}/{}_int8_{}.pt".format(model_name, model_name, mode)
+
+
+def validation_loader(training_dir, input_size, batch_size=16, num_workers=1, max_images=None, seed=0):
+    """
+    :param training_dir: str -- training set, member of training_sets
+    :param input_size: int -- model input size
+    :param max_images: int, optional -- size of a random sample of the validation images, all images by default
+    :return: torch.utils.data.DataLoader -- loader over the center cropped validation images
+    """
+    data_transforms = transforms.Compose([
+        transforms.CenterCrop(input_size),
+        transforms.ToTensor(),
+        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+    ])
+    dataset = datasets.ImageFolder('./training_sets/{}/validation'.format(training_dir), data_transforms)
+    if max_images is not None and max_images < len(dataset):
+        indices = np.random.RandomState(seed).choice(len(dataset), max_images, replace=False)
+        dataset = torch.utils.data.Subset(dataset, sorted(indices.tolist()))
+    return torch.utils.data.DataLoader(dataset, batch_size=batch_size, num_workers=num_workers)
+
+
+def quantize_model(model, mode, calibration_loader=None, input_size=224):
+    """
+    :param model: pyTorch model in evaluation mode, on the CPU
+    :param mode: str -- 'dynamic' quantizes the weights of linear layers only, 'static' quantizes weights and
+                 activations of the whole network after observing activation ranges on calibration_loader
+    :param calibration_loader: torch.utils.data.DataLoader -- representative images, required for 'static'
+    :param input_size: int -- model input size
+    :return: torch.jit.ScriptModule -- traced int8 model
+    """
+    example_inputs = torch.zeros(1, 3, input_size, input_size)
+    if mode == 'dynamic':
+        model = quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+    elif mode == 'static':
+        qconfig_mapping = get_default_qconfig_mapping(torch.backends.quantized.engine)
+        model = prepare_fx(model, qconfig_mapping, (example_inputs,))
+        with torch.no_grad():
+            for inputs, _ in calibration_loader:
+                model(inputs)
+        model = convert_fx(model)
+
+    else:
+        raise Exception("Unsupported quantization mode {}".format(mode))
+
+    with torch.no_grad():
+        return torch.jit.freeze(torch.jit.trace(model.eval(), example_inputs))
+
+
+def evaluate_accuracy(model, dataloader):
+    """
+    :return: tuple -- (accuracy, seconds per image) of model on dataloader
+    """
+    running_corrects = 0
+    n_images = 0
+    since = time.time()
+    with torch.no_grad():
+        for inputs, labels in dataloader:
+            _, preds = torch.max(model(inputs), 1)
+            running_corrects += torch.sum(preds == labels).item()
+            n_images += len(labels)
+    return running_corrects / float(n_images), (time.time() - since) / n_images
+
+
+def load_quantized_model(model_name, model_architecture, training_dir, input_size, num_classes, mode='dynamic',
+                         calibration_images=256, batch_size=16, num_workers=1):
+    """
+    Loads the cached int8 version of a trained model, quantizing and caching it first if it is missing or older than
+    the fp32 weights. Quantizing also measures fp32 and int8 accuracy on the validation images of training_dir and
+    stores them in a .json report next to the int8 model.
+
+    :param model_name: str -- name of the model given at training time
+    :param model_architecture: str -- model architecture, member of model_archs
+    :param training_dir: str -- training set the model was trained on, used for calibration and accuracy
+    :param input_size: int -- model input size
+    :param num_classes: int -- number of output classes
+    :param mode: str -- 'dynamic' or 'static', see quantize_model
+    :param calibration_images: int -- number of validation images used to calibrate 'static' quantization
+    :return: tuple -- (int8 torch.jit.ScriptModule, report dictionary)
+    """
+    out_file = quantized_path(model_name, mode)
+    report_file = os.path.splitext(out_file)[0] + '.json'
+    fingerprint = model_fingerprint(weights_path(model_name))
+
+    if os.path.isfile(out_file) and os.path.isfile(report_file):
+        with open(report_file, 'r') as f:
+            report = json.load(f)
+        if report['fingerprint'] == fingerprint:
+            return torch.jit.load(out_file, map_location='cpu'), report
+
+    # quantized kernels only run on the CPU
+    model = load_model(model_name, model_architecture, num_classes, use_gpu=False)
+    calibration_loader = None
+    if mode == 'static':
+        calibration_loader = validation_loader(training_dir, input_size, batch_size=batch_size,
+                                               num_workers=num_workers, max_images=calibration_images)
+    quantized_model = quantize_model(model, mode, calibration_loader=calibration_loader, input_size=input_size)
+
+    # compare against fp32 so we can decide whether int8 is good enough for this model
+    eval_loader = validation_loader(training_dir, input_size, batch_size=batch_size, num_workers=num_workers)
+    fp32_acc, fp32_time = evaluate_accuracy(model, eval_loader)
+    int8_acc, int8_time = evaluate_accuracy(quantized_model, eval_loader)
+    report = {'fingerprint': fingerprint, 'mode': mode, 'engine': torch.backends.quantized.engine,
+              'fp32_accuracy': fp32_acc, 'int8_accuracy': int8_acc, 'accuracy_delta': int8_acc - fp32_acc,
+              'fp32_seconds_per_image': fp32_time, 'int8_seconds_per_image': int8_time}
+
+    # write to a temporary file first so an interrupted run never leaves a truncated model behind
+    torch.jit.save(quantized_model, out_file + '.tmp')
+    os.replace(out_file + '.tmp', out_file)
+    with open(report_file, 'w') as f:
+        json.dump(report, f, indent=2)
+    return quantized_model, report
@@ -0,0 +1,105 @@
+# Append-only, streaming writer for per-image classification results
+
+import csv
+import os
+
+
+class ResultWriter(object):
+    """
+    Streams classification results to a .csv file without ever re-reading or rewriting it. Rows are buffered in
+    memory and appended to disk in bounded chunks, while a key -> row index keeps lookups constant time, so the cost
+    of writing results grows linearly with the number of images.
+
+    :param out_file: str -- path to output .csv file
+    :param columns: list -- column names, written as the header of a new file
+    :param key: str -- column used to index rows, must be unique per image
+    :param chunk_size: int -- maximum number of rows kept in memory before they are appended to disk
+    :param append: bool -- whether to continue an existing file (re-indexing its rows) instead of starting a new one
+    :param on_flush: callable, optional -- called with the keys of each chunk once it is on stable storage
+    """
+
+    def __init__(self, out_file, columns, key='file', chunk_size=1024, append=False, on_flush=None):
+        if key not in columns:
+            raise Exception("Index key {} is not a result column".format(key))
+
+        self.out_file = out_file
+        self.columns = list(columns)
+        self.key = key
+        self.chunk_size = chunk_size
+        self.on_flush = on_flush
+
+        # key -> row number in out_file
+        self.index = {}
+        self.buffer = []
+
+        out_dir = os.path.dirname(out_file)
+        if out_dir and not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+
+        if append and os.path.isfile(out_file) and os.path.getsize(out_file) > 0:
+            self._load_index()
+            self._file = open(out_file, 'a', newline='')
+            self._writer = csv.DictWriter(self._file, fieldnames=self.columns, extrasaction='ignore')
+        else:
+            self._file = open(out_file, 'w', newline='')
+            self._writer = csv.DictWriter(self._file, fieldnames=self.columns, extrasaction='ignore')
+            self._writer.writeheader()
+
+    def _load_index(self):
+        with open(self.out_file, 'r', newline='') as f:
+            reader = csv.DictReader(f)
+            if reader.fieldnames != self.columns:
+                raise Exception("Columns in {} do not match {}".format(self.out_file, self.columns))
+            for row in reader:
+                self.index[row[self.key]] = len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def write(self, rows):
+        """
+        Queues a batch of result rows, appending them to disk once the buffer reaches chunk_size. Rows whose key was
+        already written are skipped.
+
+        :param rows: iterable of dict -- one {column: value} dictionary per image
+        :return: list -- keys of the rows that were queued
+        """
+        written = []
+        for row in rows:
+            key = row[self.key]
+            if key in self.index:
+                continue
+            self.index[key] = len(self.index)
+            self.buffer.append(row)
+            written.append(key)
+
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+        return written
+
+    def flush(self):
+        """
+        Appends buffered rows to disk and forces them to stable storage.
+        """
+        rows = self.buffer
+        self.buffer = []
+        if rows:
+            self._writer.writerows(rows)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        if rows and self.on_flush is not None:
+            self.on_flush([row[self.key] for row in rows])
+
+    def close(self):
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,132 @@
+# Per-step timing of the training loop, to tell whether a run waits on the DataLoader or on compute
+#
+# The loop calls mark(section) right after each part of a step, so every section is timed from the previous mark:
+#   data       -- waiting for the DataLoader to hand over the next batch
+#   copy       -- host to device copy
+#   transform  -- batch level transforms, see utils/dataloaders/transforms_batch.py
+#   forward, backward, optimizer
+#   metrics    -- loss and accuracy bookkeeping
+# Work between steps that is not part of training, like logging the timings, goes between end_step and resume, so it
+# does not count as waiting for data. A disabled timer returns right away from every call.
+
+import os
+import resource
+import time
+
+import torch
+
+SECTIONS = ['data', 'copy', 'transform', 'forward', 'backward', 'optimizer', 'metrics']
+
+
+def rss_mb(pid='self'):
+    """
+    :param pid: int or str -- process id, the calling process by default
+    :return: float -- resident set size in megabytes, peak size of the calling process where /proc is missing
+    """
+    try:
+        with open('/proc/{}/statm'.format(pid), 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (IOError, OSError):
+        if pid != 'self':
+            return 0.0
+        # kilobytes on linux, bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def worker_rss_mb(loader_iter):
+    """
+    :param loader_iter: iterator of a DataLoader
+    :return: float -- summed resident set size of its worker processes in megabytes, shared pages counted by each
+    """
+    return sum(rss_mb(worker.pid) for worker in getattr(loader_iter, '_workers', []))
+
+
+def loader_queue_depth(loader_iter):
+    """
+    :param loader_iter: iterator of a DataLoader
+    :return: int -- batches loaded by workers and not consumed yet, None without worker processes
+    """
+    if not hasattr(loader_iter, '_data_queue'):
+        return None
+    # batches that arrived out of order wait in _task_info together with the index of their worker
+    depth = sum(1 for info in loader_iter._task_info.values() if len(info) == 2)
+    try:
+        depth += loader_iter._data_queue.qsize()
+    except NotImplementedError:
+        # multiprocessing queues on macOS
+        pass
+    return depth
+
+
+class StepTimer(object):
+    """
+    :param enabled: bool -- whether to time anything at all
+    :param sync_cuda: bool -- wait for queued GPU work at every mark, so sections get the GPU time they caused instead
+                      of the section that happens to wait for it
+    """
+
+    def __init__(self, enabled=True, sync_cuda=False):
+        self.enabled = enabled
+        self.sync_cuda = sync_cuda and torch.cuda.is_available()
+        self.last = None
+        self.step_times = {}
+        self.start_epoch()
+
+    def start_epoch(self):
+        self.epoch_times = {section: 0.0 for section in SECTIONS}
+        self.epoch_steps = 0
+        self.epoch_images = 0
+        self.epoch_queue_depth = 0
+        self.step_times = {}
+        self.epoch_start = self.last = time.perf_counter()
+
+    def mark(self, section):
+        """
+        Attributes the time since the previous mark to section.
+        """
+        if not self.enabled:
+            return
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        now = time.perf_counter()
+        self.step_times[section] = self.step_times.get(section, 0.0) + now - self.last
+        self.last = now
+
+    def resume(self):
+        """
+        Restarts timing from now, leaving the time since the last mark out of every section, e.g. time spent logging.
+        """
+        if self.enabled:
+            self.last = time.perf_counter()
+
+    def end_step(self, n_images, queue_depth=None):
+        """
+        :param n_images: int -- images in the step's batch
+        :param queue_depth: int, optional -- loaded batches waiting after the step, see loader_queue_depth
+        :return: dict -- seconds spent in every section of the step, None if disabled
+        """
+        if not self.enabled:
+            return None
+        step_times = self.step_times
+        self.step_times = {}
+        for section, seconds in step_times.items():
+            self.epoch_times[section] = self.epoch_times.get(section, 0.0) + seconds
+        self.epoch_steps += 1
+        self.epoch_images += n_images
+        self.epoch_queue_depth += queue_depth or 0
+        return step_times
+
+    def epoch_summary(self):
+        """
+        :return: dict -- mean milliseconds per step of every section, share of the epoch spent waiting for data, images
+                 per second and mean loader queue depth, None if disabled or nothing was timed
+        """
+        if not self.enabled or self.epoch_steps == 0:
+            return None
+        elapsed = time.perf_counter() - self.epoch_start
+        summary = {'{}_ms'.format(section): 1000. * seconds / self.epoch_steps
+                   for section, seconds in self.epoch_times.items()}
+        summary['data_wait_fraction'] = self.epoch_times['data'] / elapsed
+        summary['images_per_sec'] = self.epoch_images / elapsed
+        summary['queue_depth'] = self.epoch_queue_depth / float(self.epoch_steps)
+        return summary
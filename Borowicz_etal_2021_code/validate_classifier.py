@@ -1,11 +1,18 @@
 import torch
+import torch.nn.functional as F
 import pandas as pd
-from torchvision import datasets, transforms, models
+from torchvision import datasets, transforms
 from torch.autograd import Variable
 import time
 import warnings
 import argparse
 from utils.model_library import *
+from utils.logit_store import LogitStore
+from utils.dataloaders.dataset_index import DatasetIndex, IndexedImageFolder
+from utils.dataloaders.loader_config import loader_settings, make_dataloader, uint8_transfer
+from utils.image_validation import SkiplistFilter, load_skiplist
+from utils.model_loader import load_model
+from utils.onnx_backend import OnnxClassifier, onnx_path
 
 # image transforms seem to cause truncated images, so we need this
 from PIL import ImageFile
@@ -22,6 +29,23 @@ parser.add_argument('--hyperparameter_set', type=str, help='combination of hyper
                                                            'hyperparameters dictionary')
 parser.add_argument('--model_name', type=str, help='name of input model file from training, this name will also be used'
                                                    'in subsequent steps of the pipeline')
+parser.add_argument('--save_probs', type=str, default=None, help='directory where softmax probabilities and top-k '
+                                                                 'classes are stored for every validation image')
+parser.add_argument('--top_k', type=int, default=3, help='number of most likely classes stored with --save_probs')
+parser.add_argument('--probs_dtype', type=str, default='float16', choices=['float16', 'float32'],
+                    help='dtype of probabilities stored with --save_probs')
+parser.add_argument('--backend', type=str, default='torch', choices=['torch', 'onnx'],
+                    help='run the model with pyTorch or with onnxruntime on the CPU, the latter requires exporting it '
+                         'with export_onnx.py first')
+parser.add_argument('--intra_op_threads', type=int, default=0, help='threads used inside an operator, 0 keeps the '
+                                                                    'backend default')
+parser.add_argument('--inter_op_threads', type=int, default=0, help='threads used to run independent operators in '
+                                                                    'parallel, 0 keeps the backend default')
+parser.add_argument('--dataset_index', type=str, default=None, help='SQLite file indexing the validation set, only '
+                                                                     'directories changed since the last run are '
+                                                                     'listed again')
+parser.add_argument('--skiplist', type=str, default=None, help='skiplist written by preflight_images.py, images '
+                                                               'on it are left out')
 args = parser.parse_args()
 
 # check for invalid inputs
@@ -35,7 +59,8 @@ if args.hyperparameter_set not in hyperparameters:
     raise Exception("Invalid hyperparameter combination")
 
 
-def validate_model(model, val_dir, out_file, batch_size=8, input_size=299, num_workers=1):
+def validate_model(model, val_dir, out_file, batch_size=8, input_size=299, num_workers=1, probs_dir=None, top_k=3,
+                   probs_dtype='float16', index_file=None, loader_config=None, skiplist=None):
     """
     Generates a confusion matrix from a PyTorch model and validation images
 
@@ -44,11 +69,22 @@ def validate_model(model, val_dir, out_file, batch_size=8, input_size=299, num_w
     :param batch_size: int -- number of images per batch
     :param input_size: int -- size of input images
     :param to_csv : whether or not pandas dataframe gets saved as a .csv table
+    :param probs_dir: str -- optional directory where softmax probabilities and top-k classes are stored per image
+    :param top_k: int -- number of most likely classes stored in probs_dir
+    :param probs_dtype: str -- 'float16' or 'float32', dtype of probabilities stored in probs_dir
+    :param index_file: str -- optional SQLite file indexing the validation images, see
+                       utils/dataloaders/dataset_index.py
+    :param loader_config: dict -- loader settings of a hyperparameter set, defaults from
+                          utils/dataloaders/loader_config.py
+    :param skiplist: set -- absolute paths of images to leave out, see utils/image_validation.py
     :return: pd.data.frame -- data frame with predictions and labels by validation batch
     """
 
     # get total number of tunable parameters
-    total_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
+    if isinstance(model, OnnxClassifier):
+        total_params = model.num_params()
+    else:
+        total_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
 
     # crop and normalize images
     data_transforms = transforms.Compose([
@@ -56,15 +92,30 @@ def validate_model(model, val_dir, out_file, batch_size=8, input_size=299, num_w
         transforms.ToTensor(),
         transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
     ])
+    if loader_config is None:
+        loader_config = loader_settings({})
+    normalize = None
+    if loader_config['uint8_transfer']:
+        # workers hand over uint8 images, normalized after collation
+        data_transforms, normalize = uint8_transfer(data_transforms)
 
     # load dataset
-    dataset = datasets.ImageFolder('./training_sets/{}/validation'.format(val_dir), data_transforms)
-    dataloader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, num_workers=num_workers)
+    if index_file is not None:
+        index = DatasetIndex(index_file, './training_sets/{}/validation'.format(val_dir))
+        dataset = IndexedImageFolder(index, data_transforms, skiplist=skiplist)
+        index.close()
+    else:
+        is_valid_file = SkiplistFilter(skiplist, datasets.folder.IMG_EXTENSIONS) if skiplist else None
+        dataset = datasets.ImageFolder('./training_sets/{}/validation'.format(val_dir), data_transforms,
+                                       is_valid_file=is_valid_file)
+    dataloader = make_dataloader(dataset, batch_size=batch_size, num_workers=num_workers, settings=loader_config)
 
     class_names = dataset.classes
 
-    # check for GPU support
-    use_gpu = torch.cuda.is_available()
+    # check for GPU support, onnxruntime runs on the CPU
+    use_gpu = torch.cuda.is_available() and not isinstance(model, OnnxClassifier)
+    if use_gpu and normalize is not None:
+        normalize = normalize.cuda()
 
     # create pandas data.frame for confusion matrix
     conf_matrix = pd.DataFrame(columns=['predicted', 'ground_truth'])
@@ -75,6 +126,12 @@ def validate_model(model, val_dir, out_file, batch_size=8, input_size=299, num_w
     # keep track of correct answers to get accuracy
     running_corrects = 0
 
+    # keep class probabilities so predictions can be re-thresholded without another forward pass
+    store = None
+    if probs_dir is not None:
+        store = LogitStore(probs_dir, class_names, dtype=probs_dtype, top_k=top_k, ground_truth=True)
+    n_seen = 0
+
     # keep track of running time
     since = time.time()
 
@@ -84,10 +141,12 @@ def validate_model(model, val_dir, out_file, batch_size=8, input_size=299, num_w
 
         # wrap them in Variable
         if use_gpu:
-            inputs = Variable(inputs.cuda())
-            labels = Variable(labels.cuda())
+            inputs = Variable(inputs.cuda(non_blocking=True))
+            labels = Variable(labels.cuda(non_blocking=True))
         else:
             inputs, labels = Variable(inputs), Variable(labels)
+        if normalize is not None:
+            inputs = normalize(inputs)
 
         # do a forward pass to get predictions
         outputs = model(inputs)
@@ -96,6 +155,13 @@ def validate_model(model, val_dir, out_file, batch_size=8, input_size=299, num_w
         # keep track of correct answers to get accuracy
         running_corrects += torch.sum(preds == labels.data).item()
 
+        # the validation loader is not shuffled, so batches follow dataset.samples
+        if store is not None:
+            batch_samples = dataset.samples[n_seen:n_seen + len(preds)]
+            store.write([path for path, _ in batch_samples], F.softmax(outputs.data, dim=1).cpu().numpy(),
+                        ground_truth=[class_names[target] for _, target in batch_samples])
+        n_seen += len(preds)
+
         # add current predictions to conf_matrix
         conf_matrix_batch = pd.DataFrame(data=[[class_names[int(ele)] for ele in preds],
                                                [class_names[int(ele)] for ele in labels.data]])
@@ -104,6 +170,8 @@ def validate_model(model, val_dir, out_file, batch_size=8, input_size=299, num_w
         conf_matrix = conf_matrix.append(conf_matrix_batch, ignore_index=True)
 
     time_elapsed = time.time() - since
+    if store is not None:
+        store.close()
 
     # print output
     print('Validation complete in {}h {:.0f}m {:.0f}s'.format(
@@ -121,45 +189,28 @@ def main():
     # create model instance
     num_classes = training_sets[args.training_dir]['num_classes']
 
-    # loading the pretrained model and adding new classes to it
-    if args.model_architecture == "Resnet18":
-        model_ft = models.resnet18(num_classes=num_classes)
-
-    elif args.model_architecture == "Resnet34":
-        model_ft = models.resnet34(num_classes=num_classes)
-
-    elif args.model_architecture == "Resnet50":
-        model_ft = models.resnet50(num_classes=num_classes)
-
-    elif args.model_architecture == "Squeezenet11":
-        model_ft = models.squeezenet1_1(num_classes=num_classes)
-
-    elif args.model_architecture == "Densenet121":
-        model_ft = models.densenet121(num_classes=num_classes)
-
-    elif args.model_architecture == "Densenet169":
-        model_ft = models.densenet169(num_classes=num_classes)
-
-    elif args.model_architecture == "Alexnet":
-        model_ft = models.alexnet(num_classes=num_classes)
-
+    if args.backend == 'onnx':
+        model_ft = OnnxClassifier(onnx_path(args.model_name), intra_op_threads=args.intra_op_threads,
+                                  inter_op_threads=args.inter_op_threads)
     else:
-        model_ft = models.vgg16_bn(num_classes=num_classes)
-
-    # check for GPU support and set model to evaluation mode
-    use_gpu = torch.cuda.is_available()
-    if use_gpu:
-        model_ft.cuda()
-    model_ft.eval()
+        if args.intra_op_threads > 0:
+            torch.set_num_threads(args.intra_op_threads)
+        if args.inter_op_threads > 0:
+            torch.set_num_interop_threads(args.inter_op_threads)
 
-    # load saved model weights from pt_train.py
-    model_ft.load_state_dict(torch.load("./saved_models/{}/{}.tar".format(args.model_name, args.model_name)))
+        # load saved model weights from train_classifier.py, using the GPU if there is one
+        model_ft = load_model(args.model_name, args.model_architecture, num_classes,
+                              use_gpu=torch.cuda.is_available())
 
     # run validation to get confusion matrix
     validate_model(model=model_ft, input_size=model_archs[args.model_architecture]['input_size'],
                    batch_size=hyperparameters[args.hyperparameter_set]['batch_size_val'],
                    val_dir=args.training_dir, out_file=args.model_name,
-                   num_workers=hyperparameters[args.hyperparameter_set]['num_workers_val'])
+                   num_workers=hyperparameters[args.hyperparameter_set]['num_workers_val'],
+                   probs_dir=args.save_probs, top_k=args.top_k, probs_dtype=args.probs_dtype,
+                   index_file=args.dataset_index,
+                   loader_config=loader_settings(hyperparameters[args.hyperparameter_set]),
+                   skiplist=load_skiplist(args.skiplist))
 
 
 if __name__ == '__main__':